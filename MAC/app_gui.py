@@ -4,10 +4,17 @@ import os
 import sys
 import time
 import json
+import uuid
 from p2p_core import (
     DiscoveryService, ChatService, FileTransferService, SettingsManager, get_local_ip,
-    MSG_TYPE_SCREEN_REQUEST, MSG_TYPE_SCREEN_ACCEPT, MSG_TYPE_SCREEN_REJECT
+    MSG_TYPE_CHAT, MSG_TYPE_CLIPBOARD, MSG_TYPE_SCREEN_REQUEST, MSG_TYPE_SCREEN_ACCEPT, MSG_TYPE_SCREEN_REJECT,
+    PEER_UNVERIFIED, PEER_REMOVED, KnownPeers
 )
+from net_core import NetworkCore
+from chat_history import HistoryStore, HISTORY_PAGE_SIZE
+from outbox import Outbox
+from clipboard_sync import ClipboardSync, CLIP_TEXT
+from rendezvous import RendezvousClient
 from screen_share_service import ScreenShareManager, ScreenShareProtocol
 
 # Global services
@@ -17,6 +24,11 @@ file_service = None
 settings_manager = None
 screen_manager = None
 screen_protocol = None
+network_core = None
+history = None
+outbox = None
+clipboard_sync = None
+rendezvous_client = None
 
 # Custom Colors
 COLOR_BG = "#0F172A"       # Slate 900
@@ -27,6 +39,10 @@ COLOR_TEXT = "#F8FAFC"     # Slate 50
 COLOR_BUBBLE_ME = "#3B82F6"
 COLOR_BUBBLE_PEER = "#334155" # Slate 700
 
+CHAT_WINDOW = 4 * HISTORY_PAGE_SIZE # Messages kept as controls; the rest stays on disk
+ALL_PEERS = "*" # Conversation key for messages broadcast to every discovered peer
+GROUP_PREFIX = "group:" # Group conversations are keyed "group:<id>"
+
 def main(page: ft.Page):
     page.title = "P2P Transfer & Chat"
     page.theme_mode = ft.ThemeMode.DARK
@@ -47,17 +63,27 @@ def main(page: ft.Page):
 
     # State
     current_target_ip = None
-    peers = {} # IP -> Peer Info
-    last_clipboard_content = ""
+    current_conversation = None # Peer IP, group key or ALL_PEERS
+    peers = {} # IP -> Peer Info, kept after a peer leaves so its history still shows its nick
+    peer_cards = {} # IP -> sidebar card of a live peer
     
     # Initialize Settings
-    global settings_manager
+    global settings_manager, history
     settings_manager = SettingsManager()
+    history = HistoryStore()
 
     # --- UI Components ---
 
     # 1. Sidebar (Peers)
     peers_column = ft.Column(spacing=10, scroll=ft.ScrollMode.AUTO)
+    groups_column = ft.Column(spacing=10)
+    search_input = ft.TextField(
+        hint_text="Buscar en el historial...",
+        prefix_icon=ft.Icons.SEARCH,
+        border_radius=8,
+        dense=True,
+        on_submit=lambda e: open_search_results(e.control.value)
+    )
     
     sidebar = ft.Container(
         width=280,
@@ -75,9 +101,16 @@ def main(page: ft.Page):
                 border_radius=8,
                 on_click=lambda _: open_settings_modal()
             ),
+            search_input,
             ft.Divider(color=ft.Colors.GREY_700),
             ft.Text("DISPONIBLES", size=12, color=ft.Colors.GREY_500, weight=ft.FontWeight.BOLD),
             peers_column,
+            ft.Row([
+                ft.Text("GRUPOS", size=12, color=ft.Colors.GREY_500, weight=ft.FontWeight.BOLD),
+                ft.IconButton(ft.Icons.GROUP_ADD, icon_size=16, icon_color=ft.Colors.GREY_500,
+                              tooltip="Nuevo grupo", on_click=lambda _: open_new_group_modal())
+            ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
+            groups_column,
             ft.Container(expand=True), # Spacer
             ft.ElevatedButton(
                 "Configuración", 
@@ -98,11 +131,17 @@ def main(page: ft.Page):
 
     def quit_app():
         # Force exit immediately without trying to update UI
+        history.flush()
+        discovery_service.stop() # Saves the known-peer cache
         os._exit(0)
 
 
     # 2. Chat Area
     chat_list = ft.ListView(expand=True, spacing=15, auto_scroll=True, padding=20)
+    older_btn = ft.TextButton("Mensajes anteriores", icon=ft.Icons.EXPAND_LESS, visible=False,
+                              on_click=lambda _: load_older())
+    newer_btn = ft.TextButton("Mensajes recientes", icon=ft.Icons.EXPAND_MORE, visible=False,
+                              on_click=lambda _: load_newer())
     
     # 3. Input Area
     msg_input = ft.TextField(
@@ -181,7 +220,11 @@ def main(page: ft.Page):
                     progress_bar
                 ])
             ),
-            ft.Container(expand=True, content=chat_list),
+            ft.Container(expand=True, content=ft.Column([
+                ft.Row([older_btn], alignment=ft.MainAxisAlignment.CENTER),
+                chat_list,
+                ft.Row([newer_btn], alignment=ft.MainAxisAlignment.CENTER)
+            ], spacing=0)),
             input_bar
         ])
     )
@@ -191,11 +234,14 @@ def main(page: ft.Page):
         nick_input = ft.TextField(label="Nickname", value=settings_manager.get("nickname"))
         download_path_text = ft.Text(settings_manager.get("download_dir"), size=12, color=ft.Colors.GREY_400)
         clipboard_switch = ft.Switch(label="Compartir Portapapeles", value=settings_manager.get("clipboard_share"))
+        rendezvous_input = ft.TextField(label="Servidor de encuentro (opcional)", hint_text="host:puerto",
+                                        value=settings_manager.get("rendezvous"))
         
         def save_settings(e):
             settings_manager.save_settings({
                 "nickname": nick_input.value,
-                "clipboard_share": clipboard_switch.value
+                "clipboard_share": clipboard_switch.value,
+                "rendezvous": rendezvous_input.value.strip()
             })
             page.close(dlg)
             add_system_msg("Configuración guardada.", ft.Colors.GREEN)
@@ -214,7 +260,10 @@ def main(page: ft.Page):
                 ]),
                 ft.Divider(),
                 clipboard_switch,
-                ft.Text("Si activas el portapapeles, lo que copies se enviará al usuario conectado.", size=12, color=ft.Colors.GREY_500)
+                ft.Text("Si activas el portapapeles, lo que copies se enviará al usuario conectado.", size=12, color=ft.Colors.GREY_500),
+                ft.Divider(),
+                rendezvous_input,
+                ft.Text("Para encontrar usuarios de otras subredes. Vacío: solo la red local.", size=12, color=ft.Colors.GREY_500)
             ], tight=True),
             actions=[
                 ft.TextButton("Cancelar", on_click=lambda e: page.close(dlg)),
@@ -233,7 +282,7 @@ def main(page: ft.Page):
 
     # --- Logic ---
 
-    def add_chat_bubble(msg, is_me, sender_ip=""):
+    def chat_bubble(msg, is_me, sender_ip="", message_id=None):
         align = ft.MainAxisAlignment.END if is_me else ft.MainAxisAlignment.START
         bg = COLOR_BUBBLE_ME if is_me else COLOR_BUBBLE_PEER
         
@@ -255,9 +304,65 @@ def main(page: ft.Page):
             # constraints=ft.BoxConstraints(max_width=500) # Removed for compatibility
         )
         
-        chat_list.controls.append(ft.Row([bubble], alignment=align))
+        return ft.Row([bubble], alignment=align, data=message_id)
+
+    # --- History paging: chat_list only ever holds a window of the open conversation ---
+    def message_ids():
+        return [c.data for c in chat_list.controls if c.data is not None]
+
+    def show_messages(rows, prepend=False):
+        bubbles = [chat_bubble(m.body, m.outgoing, m.sender or m.peer, m.id) for m in rows]
+        if prepend:
+            chat_list.controls[:0] = bubbles
+            if len(chat_list.controls) > CHAT_WINDOW:
+                del chat_list.controls[CHAT_WINDOW:]
+                newer_btn.visible = True
+        else:
+            chat_list.controls.extend(bubbles)
+            if len(chat_list.controls) > CHAT_WINDOW:
+                del chat_list.controls[:-CHAT_WINDOW]
+                older_btn.visible = True
         page.update()
 
+    def open_conversation(key, around=None):
+        """Shows the latest page, or with `around` the page ending at that message id."""
+        chat_list.controls.clear()
+        rows = history.page(key, before=None if around is None else around + 1, kind=MSG_TYPE_CHAT)
+        older_btn.visible = len(rows) == HISTORY_PAGE_SIZE
+        newer_btn.visible = around is not None
+        show_messages(rows)
+
+    def load_older():
+        ids = message_ids()
+        if not current_conversation or not ids:
+            return
+        rows = history.page(current_conversation, before=ids[0], kind=MSG_TYPE_CHAT)
+        older_btn.visible = len(rows) == HISTORY_PAGE_SIZE
+        show_messages(rows, prepend=True)
+
+    def load_newer():
+        ids = message_ids()
+        if not current_conversation:
+            return
+        rows = history.page(current_conversation, after=ids[-1] if ids else None, kind=MSG_TYPE_CHAT)
+        newer_btn.visible = len(rows) == HISTORY_PAGE_SIZE
+        show_messages(rows)
+
+    def add_chat_bubble(msg, is_me, sender_ip="", conversation=None):
+        """Stores a message and shows it if its conversation is open at the latest page."""
+        key = conversation or (current_conversation if is_me else sender_ip)
+        sender = None if is_me or key == sender_ip else sender_ip
+        history.append(key, MSG_TYPE_CHAT, msg, outgoing=is_me, sender=sender)
+        if key != current_conversation:
+            nick = peers.get(sender_ip, {}).get("nick", sender_ip)
+            where = f" en {conversation_title(key)}" if sender else ""
+            add_system_msg(f"💬 Nuevo mensaje de {nick}{where}", ft.Colors.BLUE)
+        elif newer_btn.visible:
+            page.update() # Scrolled back; the message is picked up by "Mensajes recientes"
+        else:
+            ids = message_ids()
+            show_messages(history.page(key, after=ids[-1] if ids else 0, kind=MSG_TYPE_CHAT))
+
     def add_system_msg(msg, color=ft.Colors.YELLOW):
         chat_list.controls.append(
             ft.Row([
@@ -271,9 +376,11 @@ def main(page: ft.Page):
         )
         page.update()
 
-    def select_peer(ip):
-        nonlocal current_target_ip
+    def select_peer(ip, around=None):
+        nonlocal current_target_ip, current_conversation
         current_target_ip = ip
+        current_conversation = ip
+        open_conversation(ip, around)
         nick = peers.get(ip, {}).get("nick", ip)
         target_header.value = f"Chat con {nick}"
         target_header.color = ft.Colors.WHITE
@@ -282,45 +389,169 @@ def main(page: ft.Page):
         screen_share_btn.visible = True
         screen_share_btn.icon_color = ft.Colors.GREY_400
         
-        # Update sidebar selection visual
-        for control in peers_column.controls:
+        highlight_selection()
+        page.update()
+
+    def highlight_selection():
+        for control in peers_column.controls + groups_column.controls:
             if isinstance(control, ft.Container):
                 control.bgcolor = COLOR_SIDEBAR # Reset
-                if control.data == ip:
+                if control.data == current_conversation:
                     control.bgcolor = ft.Colors.with_opacity(0.2, COLOR_PRIMARY)
-        
+
+    # --- Groups & Broadcast ---
+    def conversation_title(key):
+        if key == ALL_PEERS:
+            return "Todos"
+        if key.startswith(GROUP_PREFIX):
+            return settings_manager.get("groups").get(key[len(GROUP_PREFIX):], {}).get("name", "Grupo")
+        return peers.get(key, {}).get("nick", key)
+
+    def conversation_targets(key):
+        """Peers a message in a broadcast or group conversation fans out to."""
+        if key == ALL_PEERS:
+            return list(discovery_service.peers.snapshot())
+        members = settings_manager.get("groups").get(key[len(GROUP_PREFIX):], {}).get("members", [])
+        return [ip for ip in members if ip != get_local_ip()]
+
+    def select_group(key, around=None):
+        nonlocal current_target_ip, current_conversation
+        current_target_ip = None # File and screen share actions need a single peer
+        current_conversation = key
+        open_conversation(key, around)
+        if key == ALL_PEERS:
+            target_header.value = "Mensaje a todos los disponibles"
+        else:
+            target_header.value = f"Grupo {conversation_title(key)} ({len(conversation_targets(key)) + 1} miembros)"
+        target_header.color = ft.Colors.WHITE
+        screen_share_btn.visible = False
+        highlight_selection()
         page.update()
 
-    def on_peer_found(peer_info):
+    def open_chat(key, around=None):
+        if key == ALL_PEERS or key.startswith(GROUP_PREFIX):
+            select_group(key, around)
+        else:
+            select_peer(key, around)
+
+    def group_card(key, icon, title, subtitle):
+        return ft.Container(
+            data=key,
+            padding=10,
+            border_radius=8,
+            bgcolor=COLOR_SIDEBAR,
+            on_click=lambda e: select_group(key),
+            content=ft.Row([
+                ft.Text(icon, size=24),
+                ft.Column([
+                    ft.Text(title, weight=ft.FontWeight.BOLD),
+                    ft.Text(subtitle, size=10, color=ft.Colors.GREY_500)
+                ], spacing=2)
+            ])
+        )
+
+    def refresh_groups():
+        groups_column.controls = [group_card(ALL_PEERS, "📢", "Todos", "Difusión a los disponibles")] + [
+            group_card(GROUP_PREFIX + group_id, "👥", group["name"], f"{len(group['members'])} miembros")
+            for group_id, group in settings_manager.get("groups").items()
+        ]
+        highlight_selection()
+
+    def save_group(group_id, name, members):
+        groups = dict(settings_manager.get("groups"))
+        groups[group_id] = {"name": name, "members": members}
+        settings_manager.save_settings({"groups": groups})
+        refresh_groups()
+
+    def open_new_group_modal():
+        name_input = ft.TextField(label="Nombre del grupo")
+        checks = [ft.Checkbox(label=info.get("nick", ip), data=ip) for ip, info in peers.items()]
+
+        def create_group(e):
+            members = [c.data for c in checks if c.value]
+            if not name_input.value or not members:
+                name_input.error_text = "Escribe un nombre y elige al menos un usuario"
+                page.update()
+                return
+            page.close(dlg)
+            group_id = uuid.uuid4().hex[:12]
+            save_group(group_id, name_input.value, [get_local_ip()] + members)
+            select_group(GROUP_PREFIX + group_id)
+
+        dlg = ft.AlertDialog(
+            title=ft.Text("Nuevo grupo"),
+            content=ft.Column([
+                name_input,
+                ft.Text("Miembros:"),
+                *(checks or [ft.Text("No hay usuarios disponibles", color=ft.Colors.GREY_500)])
+            ], tight=True, scroll=ft.ScrollMode.AUTO),
+            actions=[
+                ft.TextButton("Cancelar", on_click=lambda e: page.close(dlg)),
+                ft.TextButton("Crear", on_click=create_group),
+            ],
+        )
+        page.open(dlg)
+
+    def on_group_message(ip, group, text):
+        key = GROUP_PREFIX + group["id"]
+        known = settings_manager.get("groups").get(group["id"])
+        if known != {"name": group["name"], "members": group["members"]}:
+            save_group(group["id"], group["name"], group["members"])
+            page.update()
+        add_chat_bubble(text, is_me=False, sender_ip=ip, conversation=key)
+
+    def report_delivery(delivery):
+        """Runs on the peer links' threads; speaks up once every peer has an outcome."""
+        if not delivery.done:
+            return
+        failed = delivery.failed()
+        if failed:
+            nicks = ", ".join(peers.get(ip, {}).get("nick", ip) for ip in failed)
+            add_system_msg(f"⏳ Entregado a {len(delivery.status) - len(failed)}/{len(delivery.status)}. "
+                           f"Pendiente para {nicks}: se enviará cuando vuelvan a conectarse", ft.Colors.ORANGE)
+        else:
+            add_system_msg(f"✓ Entregado a {len(delivery.status)} usuarios", ft.Colors.GREY_500)
+
+    def on_peer_event(event, peer_info):
+        # Discovery only calls this when a peer appears, changes or times out, not for every beacon
         ip = peer_info['ip']
         nick = peer_info.get('nick', ip)
         avatar = peer_info.get('avatar', '👤')
-        
+        unverified = event == PEER_UNVERIFIED # Known from an earlier run, being probed
+
+        if event == PEER_REMOVED:
+            card = peer_cards.pop(ip, None)
+            if card in peers_column.controls:
+                peers_column.controls.remove(card)
+            page.update()
+            return
+
         peers[ip] = peer_info
-        
-        found = False
-        for control in peers_column.controls:
-            if isinstance(control, ft.Container) and control.data == ip:
-                control.content.controls[1].controls[0].value = nick
-                found = True
-                break
-        
-        if not found:
+        card = peer_cards.get(ip)
+        if card:
+            card.opacity = 1
+            card.content.controls[0].value = avatar
+            card.content.controls[1].controls[0].value = nick
+            card.content.controls[1].controls[1].value = ip
+        else:
             card = ft.Container(
                 data=ip,
                 padding=10,
                 border_radius=8,
                 bgcolor=COLOR_SIDEBAR,
+                opacity=0.5 if unverified else 1,
                 on_click=lambda e: select_peer(ip),
                 content=ft.Row([
                     ft.Text(avatar, size=24),
                     ft.Column([
                         ft.Text(nick, weight=ft.FontWeight.BOLD),
-                        ft.Text(ip, size=10, color=ft.Colors.GREY_500)
+                        ft.Text(f"{ip} · sin verificar" if unverified else ip, size=10, color=ft.Colors.GREY_500)
                     ], spacing=2)
                 ])
             )
+            peer_cards[ip] = card
             peers_column.controls.append(card)
+            highlight_selection()
         
         page.update()
 
@@ -328,9 +559,16 @@ def main(page: ft.Page):
         add_chat_bubble(msg, is_me=False, sender_ip=ip)
 
     def on_clipboard_received(ip, content):
-        if settings_manager.get("clipboard_share"):
-            page.set_clipboard(content)
-            add_system_msg(f"📋 Portapapeles actualizado desde {peers.get(ip, {}).get('nick', ip)}", ft.Colors.PURPLE)
+        # Plain-text clipboard from peers running an older version
+        clipboard_sync.handle_text(ip, content)
+
+    def on_clipboard_synced(ip, kind, data):
+        nick = peers.get(ip, {}).get('nick', ip)
+        if kind == CLIP_TEXT:
+            history.append(ip, MSG_TYPE_CLIPBOARD, data.decode('utf-8'))
+            add_system_msg(f"📋 Portapapeles actualizado desde {nick}", ft.Colors.PURPLE)
+        else:
+            add_system_msg(f"🖼️ Imagen copiada al portapapeles desde {nick}", ft.Colors.PURPLE)
 
     def on_file_progress(filename, sent, total):
         progress = sent / total
@@ -346,6 +584,44 @@ def main(page: ft.Page):
         
         page.update()
 
+    # --- History Search ---
+    def open_search_results(text):
+        if not text or not text.strip():
+            return
+        results = history.search(text)
+
+        def open_result(message):
+            page.close(dlg)
+            if message.kind == MSG_TYPE_CLIPBOARD:
+                page.set_clipboard(message.body)
+                add_system_msg("📋 Copiado al portapapeles", ft.Colors.PURPLE)
+            else:
+                open_chat(message.peer, around=message.id)
+
+        items = []
+        for message in results:
+            nick = "Yo" if message.outgoing else peers.get(message.sender or message.peer, {}).get("nick", message.sender or message.peer)
+            if message.peer == ALL_PEERS or message.peer.startswith(GROUP_PREFIX):
+                nick += f" en {conversation_title(message.peer)}"
+            when = time.strftime("%d/%m/%Y %H:%M", time.localtime(message.ts))
+            items.append(ft.ListTile(
+                leading=ft.Icon(ft.Icons.CONTENT_PASTE if message.kind == MSG_TYPE_CLIPBOARD else ft.Icons.CHAT_BUBBLE_OUTLINE),
+                title=ft.Text(message.body[:200], max_lines=2),
+                subtitle=ft.Text(f"{nick} · {when}", size=10, color=ft.Colors.GREY_500),
+                on_click=lambda e, m=message: open_result(m)
+            ))
+
+        dlg = ft.AlertDialog(
+            title=ft.Text(f"Resultados para \"{text.strip()}\""),
+            content=ft.Container(
+                width=500,
+                height=400,
+                content=ft.ListView(items, spacing=5) if items else ft.Text("Sin resultados", color=ft.Colors.GREY_500)
+            ),
+            actions=[ft.TextButton("Cerrar", on_click=lambda e: page.close(dlg))],
+        )
+        page.open(dlg)
+
     # --- Screen Share Handlers ---
     def request_screen_share():
         """Request to view the current peer's screen."""
@@ -435,59 +711,62 @@ def main(page: ft.Page):
             screen_share_btn.icon_color = ft.Colors.GREY_400
         page.update()
 
-    # --- Clipboard Polling ---
-    def get_clipboard_content():
-        try:
-            if sys.platform == "darwin":
-                return subprocess.check_output("pbpaste", text=True).strip()
-            elif sys.platform == "win32":
-                # PowerShell is slower, but works without dependencies
-                cmd = "powershell -command Get-Clipboard"
-                return subprocess.check_output(cmd, shell=True, text=True).strip()
-        except:
-            return ""
-        return ""
-
-    def clipboard_loop():
-        nonlocal last_clipboard_content
-        while True:
-            if settings_manager.get("clipboard_share") and current_target_ip:
-                try:
-                    content = get_clipboard_content()
-                    if content and content != last_clipboard_content:
-                        last_clipboard_content = content
-                        # Avoid sending if we just received it (loopback prevention could be added here)
-                        # For now, just send.
-                        chat_service.send_clipboard(current_target_ip, content)
-                        # add_system_msg(f"📋 Portapapeles enviado", ft.Colors.GREY_500) # Optional log
-                except Exception as e:
-                    print(f"Clipboard error: {e}")
-            time.sleep(2) # Poll every 2 seconds
-
-    threading.Thread(target=clipboard_loop, daemon=True).start()
-    
     # --- Drag & Drop ---
     def on_file_drop_handler(e: ft.FilePickerResultEvent):
         if not current_target_ip:
             add_system_msg("⚠️ Selecciona un usuario primero", ft.Colors.ORANGE)
             return
         
-        for f in e.files:
-            path = f.path
-            add_system_msg(f"Enviando: {f.name}...", ft.Colors.YELLOW)
-            threading.Thread(target=file_service.send_file, args=(current_target_ip, path)).start()
+        if len(e.files) == 1:
+            add_system_msg(f"Enviando: {e.files[0].name}...", ft.Colors.YELLOW)
+        else:
+            add_system_msg(f"Enviando {len(e.files)} archivos...", ft.Colors.YELLOW)
+        paths = [f.path for f in e.files]
+        send_files_async(current_target_ip, paths)
 
     page.on_file_drop = on_file_drop_handler
 
+    # --- Outbox: sends to offline peers wait on disk until discovery sees them again ---
+    def notify_queued(ip, what):
+        nick = peers.get(ip, {}).get("nick", ip)
+        add_system_msg(f"⏳ {nick} no está conectado: {what} se enviará cuando vuelva", ft.Colors.ORANGE)
+
+    def send_files_async(ip, paths):
+        if not ip:
+            add_system_msg("Selecciona un usuario primero", ft.Colors.RED)
+            return
+
+        def run():
+            if not outbox.send_files(ip, paths):
+                notify_queued(ip, "el envío")
+        threading.Thread(target=run, daemon=True).start()
+
+    def on_outbox_flushed(ip, delivered):
+        nick = peers.get(ip, {}).get("nick", ip)
+        add_system_msg(f"📬 {delivered} envío(s) pendiente(s) entregado(s) a {nick}", ft.Colors.GREEN)
+
     # --- Handlers ---
     def send_message_click(e):
-        if not current_target_ip:
+        if not current_conversation:
             add_system_msg("Selecciona un usuario primero", ft.Colors.RED)
             return
         if not msg_input.value: return
         
         msg = msg_input.value
-        chat_service.send_message(current_target_ip, msg)
+        if current_target_ip:
+            ip = current_target_ip
+            outbox.send_message(ip, MSG_TYPE_CHAT, msg, lambda sent: sent or notify_queued(ip, "el mensaje"))
+        else:
+            targets = conversation_targets(current_conversation)
+            if not targets:
+                add_system_msg("No hay usuarios disponibles", ft.Colors.ORANGE)
+                return
+            group = None
+            if current_conversation != ALL_PEERS:
+                group_id = current_conversation[len(GROUP_PREFIX):]
+                group = {"id": group_id, **settings_manager.get("groups")[group_id]}
+            # Each peer has its own link and queue: this returns at once, however many peers
+            outbox.broadcast(targets, msg, group=group, on_update=report_delivery)
         add_chat_bubble(msg, is_me=True)
         msg_input.value = ""
         msg_input.focus()
@@ -500,7 +779,7 @@ def main(page: ft.Page):
         if e.files:
             filepath = e.files[0].path
             add_system_msg(f"Enviando archivo: {os.path.basename(filepath)}...", ft.Colors.YELLOW)
-            threading.Thread(target=file_service.send_file, args=(current_target_ip, filepath)).start()
+            send_files_async(current_target_ip, [filepath])
 
     def on_folder_picked(e: ft.FilePickerResultEvent):
         if not current_target_ip:
@@ -509,7 +788,7 @@ def main(page: ft.Page):
         if e.path:
             folderpath = e.path
             add_system_msg(f"Enviando carpeta: {os.path.basename(folderpath)}...", ft.Colors.YELLOW)
-            threading.Thread(target=file_service.send_file, args=(current_target_ip, folderpath)).start()
+            send_files_async(current_target_ip, [folderpath])
 
     # macOS Workaround Handlers
     def pick_file_click(e):
@@ -522,7 +801,7 @@ def main(page: ft.Page):
                     path = result.stdout.strip()
                     if path:
                         add_system_msg(f"Enviando archivo: {os.path.basename(path)}...", ft.Colors.YELLOW)
-                        threading.Thread(target=file_service.send_file, args=(current_target_ip, path)).start()
+                        send_files_async(current_target_ip, [path])
             except Exception as e:
                 print(f"Error macOS picker: {e}")
         else:
@@ -538,7 +817,7 @@ def main(page: ft.Page):
                     path = result.stdout.strip()
                     if path:
                         add_system_msg(f"Enviando carpeta: {os.path.basename(path)}...", ft.Colors.YELLOW)
-                        threading.Thread(target=file_service.send_file, args=(current_target_ip, path)).start()
+                        send_files_async(current_target_ip, [path])
             except Exception as e:
                 print(f"Error macOS picker: {e}")
         else:
@@ -549,21 +828,30 @@ def main(page: ft.Page):
     folder_picker = ft.FilePicker(on_result=on_folder_picked)
     
     # Init Services
-    global discovery_service, chat_service, file_service, screen_manager, screen_protocol
+    global discovery_service, chat_service, file_service, screen_manager, screen_protocol, network_core, outbox, clipboard_sync, rendezvous_client
     
-    discovery_service = DiscoveryService(settings_manager, on_peer_found)
-    chat_service = ChatService(on_message_received, on_clipboard_received, on_screen_message)
+    discovery_service = DiscoveryService(settings_manager, on_peer_event, on_peer_seen=lambda ip: outbox.peer_seen(ip),
+                                         known_peers=KnownPeers())
+    chat_service = ChatService(on_message_received, on_clipboard_received, on_screen_message, on_group_message,
+                               lambda ip, data: clipboard_sync.handle_packet(ip, data))
     file_service = FileTransferService(settings_manager, on_progress_callback=on_file_progress)
+    outbox = Outbox(chat_service, file_service, on_flushed=on_outbox_flushed)
     
     # Init Screen Share
     screen_manager = ScreenShareManager(on_status_callback=on_screen_status)
     screen_protocol = ScreenShareProtocol(chat_service, screen_manager)
 
-    discovery_service.start()
-    chat_service.start_server()
-    file_service.start_server()
+    # Clipboard: mirrored to the selected peer while sharing is on, only read when it changes
+    clipboard_sync = ClipboardSync(
+        chat_service,
+        get_target=lambda: current_target_ip if settings_manager.get("clipboard_share") else None,
+        is_enabled=lambda: settings_manager.get("clipboard_share"),
+        on_received=on_clipboard_synced
+    )
+    clipboard_sync.start()
 
     # Final Layout
+    refresh_groups()
     page.add(
         file_picker,
         folder_picker,
@@ -573,5 +861,14 @@ def main(page: ft.Page):
         ], expand=True, spacing=0)
     )
 
+    # One event loop serves the chat, file and discovery ports; started once the layout
+    # is up, since cached peers are listed as soon as discovery starts
+    network_core = NetworkCore(chat_service, file_service, discovery_service)
+    network_core.start()
+
+    # Peers on other subnets, through the rendezvous server if one is configured (idle otherwise)
+    rendezvous_client = RendezvousClient(settings_manager, discovery_service)
+    rendezvous_client.start()
+
 if __name__ == "__main__":
     ft.app(target=main)
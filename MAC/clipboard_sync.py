@@ -0,0 +1,263 @@
+"""
+Clipboard Sync Module
+Mirrors the local clipboard to the selected peer and applies what peers send.
+
+Changes are detected with the platform's clipboard change counter where there is
+one (NSPasteboard.changeCount, GetClipboardSequenceNumber), so the clipboard is
+only read when it actually changed; elsewhere the content is read and hashed on
+a slower timer. Text and PNG images travel as MSG_TYPE_CLIPBOARD_DATA over the
+peer link, compressed when it pays off and fragmented by the link like any
+large message. Content we just received is never echoed back: the change
+counter right after our own write is remembered and skipped, and so is the
+content's digest where there is no counter. The digest alone isn't enough, since
+an image written to the Windows clipboard as a DIB reads back as a different PNG.
+"""
+
+import hashlib
+import io
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from p2p_core import (
+    CHUNK_FRAME, CODEC_FAST, CODEC_RAW, MSG_TYPE_CLIPBOARD_DATA,
+    decompress_chunk, pack_frame
+)
+
+CLIPBOARD_POLL_INTERVAL = 0.5 # Seconds between change-counter checks, a cheap native call
+CLIPBOARD_HASH_INTERVAL = 2 # Seconds between reads where the platform has no change counter
+CLIPBOARD_MAX_SIZE = 32 * 1024 * 1024 # Larger clipboard contents aren't synced
+
+# MSG_TYPE_CLIPBOARD_DATA content: kind (1 byte) + SHA-256 of the content + its size, then a codec frame
+CLIPBOARD_HEADER = struct.Struct("!B32sI")
+CLIP_TEXT = 0 # UTF-8
+CLIP_PNG = 1
+
+
+def pack_clipboard(kind, data, digest):
+    return CLIPBOARD_HEADER.pack(kind, digest, len(data)) + pack_frame(data, [CODEC_FAST], None)
+
+
+def unpack_clipboard(content):
+    """(kind, data, digest) from a MSG_TYPE_CLIPBOARD_DATA payload; ValueError if it doesn't verify."""
+    kind, digest, size = CLIPBOARD_HEADER.unpack_from(content)
+    codec, wire_len = CHUNK_FRAME.unpack_from(content, CLIPBOARD_HEADER.size)
+    payload = content[CLIPBOARD_HEADER.size + CHUNK_FRAME.size:]
+    if len(payload) != wire_len or size > CLIPBOARD_MAX_SIZE:
+        raise ValueError("Truncated or oversized clipboard payload")
+    data = bytes(payload) if codec == CODEC_RAW else decompress_chunk(codec, payload, size)
+    if len(data) != size or hashlib.sha256(data).digest() != digest:
+        raise ValueError("Clipboard payload failed verification")
+    return kind, data, digest
+
+
+class MacClipboard:
+    """NSPasteboard through PyObjC when installed (counter + images); pbpaste/pbcopy text otherwise."""
+
+    def __init__(self):
+        try:
+            import AppKit
+            self._appkit = AppKit
+            self._board = AppKit.NSPasteboard.generalPasteboard()
+        except ImportError:
+            self._appkit = None
+
+    def change_count(self):
+        return self._board.changeCount() if self._appkit else None
+
+    def read(self):
+        if not self._appkit:
+            text = subprocess.run(["pbpaste"], capture_output=True).stdout
+            return (CLIP_TEXT, text) if text else None
+        # Text wins when both are offered (a spreadsheet range also comes as a picture)
+        text = self._board.stringForType_(self._appkit.NSPasteboardTypeString)
+        if text:
+            return CLIP_TEXT, text.encode('utf-8')
+        png = self._board.dataForType_(self._appkit.NSPasteboardTypePNG)
+        return (CLIP_PNG, bytes(png)) if png is not None else None
+
+    def write(self, kind, data):
+        if not self._appkit:
+            if kind != CLIP_TEXT:
+                return False
+            subprocess.run(["pbcopy"], input=data)
+            return True
+        self._board.clearContents()
+        if kind == CLIP_PNG:
+            ns_data = self._appkit.NSData.dataWithBytes_length_(data, len(data))
+            return bool(self._board.setData_forType_(ns_data, self._appkit.NSPasteboardTypePNG))
+        return bool(self._board.setString_forType_(data.decode('utf-8'), self._appkit.NSPasteboardTypeString))
+
+
+class WindowsClipboard:
+    """Win32 clipboard through ctypes; images need Pillow."""
+    CF_DIB = 8
+    CF_UNICODETEXT = 13
+    GMEM_MOVEABLE = 0x0002
+
+    def __init__(self):
+        import ctypes
+        from ctypes import wintypes
+        self._ctypes = ctypes
+        self._user32 = ctypes.windll.user32
+        self._kernel32 = ctypes.windll.kernel32
+        self._user32.GetClipboardData.restype = wintypes.HANDLE
+        self._user32.SetClipboardData.argtypes = [wintypes.UINT, wintypes.HANDLE]
+        self._user32.SetClipboardData.restype = wintypes.HANDLE
+        self._user32.OpenClipboard.argtypes = [wintypes.HWND]
+        self._kernel32.GlobalAlloc.argtypes = [wintypes.UINT, ctypes.c_size_t]
+        self._kernel32.GlobalAlloc.restype = wintypes.HGLOBAL
+        self._kernel32.GlobalLock.argtypes = [wintypes.HGLOBAL]
+        self._kernel32.GlobalLock.restype = ctypes.c_void_p
+        self._kernel32.GlobalUnlock.argtypes = [wintypes.HGLOBAL]
+
+    def change_count(self):
+        return self._user32.GetClipboardSequenceNumber()
+
+    def read(self):
+        # Text wins when both are offered (a spreadsheet range also comes as a picture)
+        if not self._user32.IsClipboardFormatAvailable(self.CF_UNICODETEXT):
+            return self._read_image()
+        if not self._user32.OpenClipboard(None):
+            return None
+        try:
+            handle = self._user32.GetClipboardData(self.CF_UNICODETEXT)
+            if not handle:
+                return None
+            text = self._ctypes.wstring_at(self._kernel32.GlobalLock(handle))
+            self._kernel32.GlobalUnlock(handle)
+        finally:
+            self._user32.CloseClipboard()
+        return (CLIP_TEXT, text.encode('utf-8')) if text else None
+
+    def _read_image(self):
+        if not self._user32.IsClipboardFormatAvailable(self.CF_DIB):
+            return None
+        try:
+            from PIL import ImageGrab
+        except ImportError:
+            return None
+        image = ImageGrab.grabclipboard()
+        if image is None or isinstance(image, list): # A list means copied files, not pixels
+            return None
+        out = io.BytesIO()
+        image.save(out, "PNG")
+        return CLIP_PNG, out.getvalue()
+
+    def write(self, kind, data):
+        if kind == CLIP_PNG:
+            try:
+                from PIL import Image
+            except ImportError:
+                return False
+            bmp = io.BytesIO()
+            Image.open(io.BytesIO(data)).convert("RGB").save(bmp, "BMP")
+            fmt, raw = self.CF_DIB, bmp.getvalue()[14:] # A DIB is a BMP file without its 14-byte file header
+        else:
+            fmt, raw = self.CF_UNICODETEXT, data.decode('utf-8').encode('utf-16-le') + b"\0\0"
+        handle = self._kernel32.GlobalAlloc(self.GMEM_MOVEABLE, len(raw))
+        self._ctypes.memmove(self._kernel32.GlobalLock(handle), raw, len(raw))
+        self._kernel32.GlobalUnlock(handle)
+        if not self._user32.OpenClipboard(None):
+            return False
+        try:
+            self._user32.EmptyClipboard()
+            return bool(self._user32.SetClipboardData(fmt, handle)) # The clipboard owns the memory now
+        finally:
+            self._user32.CloseClipboard()
+
+
+def platform_clipboard():
+    """The clipboard backend for this OS, or None where clipboard sync isn't supported."""
+    if sys.platform == "darwin":
+        return MacClipboard()
+    if sys.platform == "win32":
+        return WindowsClipboard()
+    return None
+
+
+class ClipboardSync:
+    def __init__(self, chat_service, get_target, is_enabled=lambda: True, on_received=None, backend=None):
+        self.chat_service = chat_service
+        self.get_target = get_target # -> IP the local clipboard is mirrored to, or None
+        self.is_enabled = is_enabled # Whether clipboards from peers are applied
+        self.on_received = on_received # (ip, kind, data) after a peer's clipboard was applied
+        self.backend = backend or platform_clipboard()
+        self.running = False
+        self._last_digest = None # Content last sent or applied; never sent (again)
+        self._last_count = None # Change counter last seen, including right after our own writes
+        self._lock = threading.Lock() # Keeps the watcher from reading between a write and its counter
+
+    def start(self):
+        if self.backend is None:
+            print("Clipboard sync is not supported on this platform")
+            return
+        self.running = True
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def _watch(self):
+        while self.running:
+            target = self.get_target()
+            try:
+                with self._lock:
+                    count = self.backend.change_count()
+                    if count is None:
+                        if target:
+                            self._check(target)
+                    elif target and count != self._last_count:
+                        self._last_count = count
+                        self._check(target)
+                if count is None:
+                    time.sleep(CLIPBOARD_HASH_INTERVAL)
+                    continue
+            except Exception as e:
+                print(f"Clipboard error: {e}")
+            time.sleep(CLIPBOARD_POLL_INTERVAL)
+
+    def _check(self, target):
+        content = self.backend.read()
+        if not content:
+            return
+        kind, data = content
+        if len(data) > CLIPBOARD_MAX_SIZE:
+            return
+        digest = hashlib.sha256(data).digest()
+        if digest == self._last_digest:
+            return # Unchanged, or what a peer just sent us
+        self._last_digest = digest
+        self.chat_service.send_packet(target, MSG_TYPE_CLIPBOARD_DATA, pack_clipboard(kind, data, digest))
+
+    def handle_packet(self, ip, content):
+        """ChatService callback for MSG_TYPE_CLIPBOARD_DATA."""
+        if not self.is_enabled():
+            return
+        try:
+            kind, data, digest = unpack_clipboard(content)
+        except Exception as e: # struct, zlib and lzma errors as well as failed verification
+            print(f"Invalid clipboard from {ip}: {e}")
+            return
+        self._apply(ip, kind, data, digest)
+
+    def handle_text(self, ip, text):
+        """ChatService callback for the plain MSG_TYPE_CLIPBOARD text of older peers."""
+        if self.is_enabled():
+            data = text.encode('utf-8')
+            self._apply(ip, CLIP_TEXT, data, hashlib.sha256(data).digest())
+
+    def _apply(self, ip, kind, data, digest):
+        if self.backend is None:
+            return
+        with self._lock:
+            self._last_digest = digest
+            written = self.backend.write(kind, data)
+            if written:
+                self._last_count = self.backend.change_count() # Our own write isn't a local change
+        if not written:
+            return
+        if self.on_received:
+            self.on_received(ip, kind, data)
@@ -0,0 +1,121 @@
+"""
+Delta Sync Module
+rsync-style block signatures and delta encoding used by FileTransferService
+when the receiver already holds an older copy of the file.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import zlib
+
+ADLER_MOD = 65521
+LITERAL_MAX = 1024 * 1024 # Literal runs are split so the receiver can stream them
+ROLL_LIMIT = 256 * 1024 # Bytes rolled one at a time after a miss before striding by whole blocks
+
+# Per basis block: weak Adler-32 checksum + strong 128-bit BLAKE2b digest
+SIGNATURE = struct.Struct("!I16s")
+
+# Delta stream ops: kind (1 byte) + block index or literal length (8 bytes)
+OP = struct.Struct("!BQ")
+OP_END = 0
+OP_COPY = 1
+OP_LITERAL = 2
+
+
+def block_size_for(size):
+    """rsync-style block size: about sqrt(size), kept between 4KB and 256KB."""
+    return max(4096, min(256 * 1024, int(size ** 0.5) & ~1023))
+
+
+def strong_hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def compute_signatures(path, block_size):
+    """Returns the packed signature of every block of the basis file at `path`."""
+    out = bytearray()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            out += SIGNATURE.pack(zlib.adler32(block), strong_hash(block))
+    return bytes(out)
+
+
+def parse_signatures(blob):
+    """weak -> {strong -> block index} lookup table from a packed signature blob."""
+    table = {}
+    for index, (weak, strong) in enumerate(SIGNATURE.iter_unpack(blob)):
+        table.setdefault(weak, {}).setdefault(strong, index)
+    return table
+
+
+def iter_delta(path, table, block_size):
+    """
+    Yields (OP_COPY, block_index, length) and (OP_LITERAL, data, length) ops that
+    rebuild `path` from the basis described by `table`.
+
+    Block-aligned windows are checksummed with zlib; after a miss the window
+    rolls byte by byte (pure Python, slow) for at most ROLL_LIMIT bytes, enough
+    to resync after an insertion, then strides block by block until the next match,
+    on the grid of the last match so the blocks after an in-place edit line up again.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return
+
+    def literal(start, end):
+        while start < end:
+            stop = min(end, start + LITERAL_MAX)
+            yield OP_LITERAL, data[start:stop], stop - start
+            start = stop
+
+    def lookup(start, end, weak):
+        candidates = table.get(weak)
+        if candidates:
+            return candidates.get(strong_hash(data[start:end]))
+        return None
+
+    n = block_size
+    roll_limit = max(ROLL_LIMIT, 4 * block_size)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        pos = 0
+        literal_start = 0
+        a = b = None
+        rolled = 0
+        while pos + n <= size:
+            if a is None:
+                weak = zlib.adler32(data[pos:pos + n])
+                a, b = weak & 0xFFFF, weak >> 16
+            index = lookup(pos, pos + n, (b << 16) | a)
+            if index is not None:
+                yield from literal(literal_start, pos)
+                yield OP_COPY, index, n
+                pos += n
+                literal_start = pos
+                a = None
+                rolled = 0
+                continue
+            if pos + n == size:
+                break
+            if rolled >= roll_limit:
+                pos = literal_start + (pos - literal_start) // n * n + n
+                a = None
+                continue
+            rolled += 1
+            out_byte = data[pos]
+            a = (a - out_byte + data[pos + n]) % ADLER_MOD
+            b = (b - n * out_byte + a - 1) % ADLER_MOD
+            pos += 1
+
+        # The basis' last block may be short, so try the remaining tail as one block
+        if pos < size and size - pos < n:
+            index = lookup(pos, size, zlib.adler32(data[pos:size]))
+            if index is not None:
+                yield from literal(literal_start, pos)
+                yield OP_COPY, index, size - pos
+                return
+        yield from literal(literal_start, size)
@@ -0,0 +1,262 @@
+"""
+Network Core Module
+Serves the chat, file and discovery ports from a single asyncio event loop
+instead of one blocking accept/recv thread per connection.
+
+The services keep their callback API: the loop only parses frames and headers,
+then hands chat/discovery callbacks to one ordered callback thread and file
+connections (disk I/O) to bounded thread pools.
+"""
+
+import asyncio
+import json
+import os
+import socket
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import p2p_core
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+LISTEN_BACKLOG = 1024 # Pending connects the kernel queues for us during a burst
+FILE_WORKERS = 16 # Threads running file data, delta and folder streams
+CONTROL_WORKERS = 8 # Threads running transfer control connections, apart so they never starve data streams
+
+
+class NetworkCore:
+    def __init__(self, chat_service=None, file_service=None, discovery_service=None, use_uvloop=True):
+        self.chat_service = chat_service
+        self.file_service = file_service
+        self.discovery_service = discovery_service
+        self.use_uvloop = use_uvloop and uvloop is not None
+        self.loop = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._error = None
+        self._stopping = None
+        self._chat_connections = set()
+        self._callbacks = ThreadPoolExecutor(max_workers=1) # Keeps callbacks in arrival order
+        self._data_pool = ThreadPoolExecutor(max_workers=FILE_WORKERS)
+        self._control_pool = ThreadPoolExecutor(max_workers=CONTROL_WORKERS)
+
+    def start(self):
+        """Starts the loop thread and returns once every port is bound (raising if one isn't)."""
+        self.loop = uvloop.new_event_loop() if self.use_uvloop else asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error:
+            raise self._error
+
+    def stop(self):
+        if self.loop and self._stopping:
+            self.loop.call_soon_threadsafe(self._stopping.set)
+            self._thread.join()
+        for pool in (self._callbacks, self._data_pool, self._control_pool):
+            pool.shutdown(wait=False)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._main())
+        finally:
+            self.loop.close()
+
+    async def _main(self):
+        self._stopping = asyncio.Event()
+        closers = []
+        tasks = []
+        try:
+            if self.chat_service:
+                self.chat_service.running = True
+                server = await self.loop.create_server(lambda: _ChatProtocol(self),
+                                                       sock=self._listen(p2p_core.CHAT_PORT),
+                                                       backlog=LISTEN_BACKLOG)
+                closers.append(server.close)
+            if self.file_service:
+                self.file_service.running = True
+                listener = self._listen(p2p_core.FILE_PORT)
+                tasks.append(asyncio.ensure_future(self._accept_files(listener)))
+                closers.append(listener.close)
+            if self.discovery_service:
+                self.discovery_service.running = True
+                transport, _ = await self.loop.create_datagram_endpoint(
+                    lambda: _DiscoveryProtocol(self), sock=self._discovery_socket())
+                tasks.append(asyncio.ensure_future(self._send_beacons(transport)))
+                closers.append(transport.close)
+        except Exception as e:
+            self._error = e
+        self._ready.set()
+        if not self._error:
+            await self._stopping.wait()
+        for close in closers:
+            close()
+        for connection in list(self._chat_connections):
+            connection.transport.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.sleep(0) # Lets the closed transports call connection_lost
+
+    def _listen(self, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if os.name != "nt": # On Windows SO_REUSEADDR would let another process steal the port
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('0.0.0.0', port))
+        sock.listen(LISTEN_BACKLOG)
+        sock.setblocking(False)
+        return sock
+
+    # --- Files ---
+    async def _accept_files(self, listener):
+        while True:
+            client, addr = await self.loop.sock_accept(listener)
+            asyncio.ensure_future(self._route_file(client))
+
+    async def _route_file(self, client):
+        """Reads the JSON header on the loop, then gives the connection to a worker thread."""
+        try:
+            length = struct.unpack("!I", await self._recv_exact(client, 4))[0]
+            metadata = json.loads((await self._recv_exact(client, length)).decode('utf-8'))
+        except Exception as e:
+            print(f"Error receiving file: {e}")
+            client.close()
+            return
+        client.setblocking(True)
+        pool = self._control_pool if metadata.get('action') == 'offer' else self._data_pool
+        pool.submit(self.file_service.serve, client, metadata)
+
+    async def _recv_exact(self, sock, size):
+        buf = bytearray()
+        while len(buf) < size:
+            data = await asyncio.wait_for(self.loop.sock_recv(sock, size - len(buf)), p2p_core.LINK_TIMEOUT)
+            if not data:
+                raise ConnectionError(f"Connection closed after {len(buf)}/{size} bytes")
+            buf += data
+        return bytes(buf)
+
+    # --- Discovery ---
+    def _discovery_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.bind(('', p2p_core.DISCOVERY_PORT))
+        return sock
+
+    async def _send_beacons(self, transport):
+        discovery = self.discovery_service
+        # Cached peers first: probed twice, then whoever didn't answer is dropped
+        self._send_datagrams(transport, await self.loop.run_in_executor(self._callbacks, discovery.probe_known))
+        await asyncio.sleep(p2p_core.PROBE_RETRY)
+        self._send_datagrams(transport, await self.loop.run_in_executor(self._callbacks, discovery.probes))
+        await asyncio.sleep(p2p_core.PROBE_TIMEOUT - p2p_core.PROBE_RETRY)
+        await self.loop.run_in_executor(self._callbacks, discovery.peers.expire)
+        while True:
+            try:
+                beacons, delay = await self.loop.run_in_executor(self._callbacks, discovery.beacon_round)
+            except OSError:
+                beacons, delay = [], p2p_core.BROADCAST_INTERVAL
+            self._send_datagrams(transport, beacons)
+            await asyncio.sleep(delay)
+
+    def _send_datagrams(self, transport, beacons):
+        for payload, address in beacons:
+            try:
+                transport.sendto(payload, address)
+            except OSError:
+                self.discovery_service.local.invalidate() # The interface may be gone
+
+    def _handle_beacon(self, transport, data):
+        # Runs on the callbacks thread; replies go back through the loop that owns the transport
+        for payload, address in self.discovery_service.handle_beacon(data):
+            self.loop.call_soon_threadsafe(self._send_reply, transport, payload, address)
+
+    @staticmethod
+    def _send_reply(transport, payload, address):
+        try:
+            transport.sendto(payload, address)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _call(fn, *args):
+        try:
+            fn(*args)
+        except Exception as e:
+            print(f"Error in network callback: {e}")
+
+
+class _ChatProtocol(asyncio.BufferedProtocol):
+    """One peer link: the transport reads straight into a FrameDecoder, no stream copies."""
+
+    def __init__(self, core):
+        self.core = core
+        self.decoder = p2p_core.FrameDecoder()
+        self.fragments = {} # inner type -> message received so far
+        self.received = 0 # Frames acknowledged back to the sender
+        self.transport = None
+        self.ip = None
+        self._idle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.ip = transport.get_extra_info('peername')[0]
+        self.core._chat_connections.add(self)
+        self._arm_timeout()
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.decoder.advance(nbytes)
+        try:
+            for msg_type, content in self.decoder.frames():
+                if msg_type in (p2p_core.MSG_TYPE_HEARTBEAT, p2p_core.MSG_TYPE_ACK):
+                    continue
+                self.received += 1
+                # Fragments are put together here, so their size is checked before anything queues up
+                message = p2p_core.reassemble(msg_type, content, self.fragments)
+                if message:
+                    msg_type, content = message
+                    # The view is reused by the next read, so the callback thread gets a copy;
+                    # a reassembled message already is one
+                    self.core._callbacks.submit(self.core._call, self.core.chat_service.deliver, self.ip, msg_type,
+                                                content if isinstance(content, bytearray) else bytes(content))
+        except ValueError as e:
+            # Oversized frame or fragmented message: the stream is corrupt, drop the peer
+            print(f"Dropping chat connection from {self.ip}: {e}")
+            self.transport.abort()
+            return
+        # Every read is acknowledged, heartbeats too, so the sender's link knows we're alive.
+        # The count is cumulative: while a sender isn't reading its acks, skipping some loses nothing.
+        if self.transport.get_write_buffer_size() < p2p_core.LINK_FRAGMENT_SIZE:
+            self.transport.write(p2p_core.PeerLink.frame(p2p_core.MSG_TYPE_ACK, p2p_core.LINK_ACK.pack(self.received)))
+        self._arm_timeout()
+
+    def _arm_timeout(self):
+        # Peer links heartbeat well within LINK_TIMEOUT while they are alive
+        if self._idle:
+            self._idle.cancel()
+        self._idle = self.core.loop.call_later(p2p_core.LINK_TIMEOUT, self.transport.close)
+
+    def connection_lost(self, exc):
+        if self._idle:
+            self._idle.cancel()
+        self.core._chat_connections.discard(self)
+
+
+class _DiscoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, core):
+        self.core = core
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.core._callbacks.submit(self.core._call, self.core._handle_beacon, self.transport, data)
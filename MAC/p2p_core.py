@@ -5,14 +5,115 @@ import json
 import time
 import shutil
 import struct
+import hashlib
+import queue
+import zlib
+import collections
+import functools
+import itertools
+import ipaddress
+import random
+from concurrent.futures import ThreadPoolExecutor
+from delta_sync import (
+    OP, OP_END, OP_COPY, OP_LITERAL, SIGNATURE,
+    block_size_for, compute_signatures, parse_signatures, iter_delta
+)
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import psutil # Optional: enumerates every interface; without it only the default route's address is known
+except ImportError:
+    psutil = None
 
 # Constants
 FILE_PORT = 5001
 DISCOVERY_PORT = 5002
 CHAT_PORT = 5003
 BUFFER_SIZE = 64 * 1024 # 64KB for better performance
+PARALLEL_STREAMS = 4 # Concurrent connections used for large files
+PARALLEL_MIN_SIZE = 32 * 1024 * 1024 # Below 32MB a single stream is faster
+CHUNK_SIZE = 4 * 1024 * 1024 # Resume granularity tracked in the .part manifest
+MANIFEST_INTERVAL = 2 # Seconds between manifest checkpoints while receiving
+TRANSFER_RETRIES = 3 # Reconnect attempts before a send is given up
+SENDFILE_SLICE = 1024 * 1024 # Bytes per sendfile() call, also the progress granularity
+USE_SENDFILE = hasattr(os, "sendfile") # Zero-copy path (Linux/macOS); Windows uses the read loop
+RECV_BUFFER_SIZE = 1024 * 1024 # Pooled receive buffer filled with recv_into
+WRITE_QUEUE_DEPTH = 8 # Buffers in flight per stream between network and disk (8MB)
+USE_SPLICE = False # Linux socket->file splice; bypasses the write-behind queue
+DELTA_MIN_SIZE = 1024 * 1024 # Files this big are delta-synced against an older copy on the receiver
+DIGEST_SIZE = 32 # SHA-256 digest sent after every chunk and folder entry
+COMPRESSION = True # Offer per-chunk compression; each chunk still goes raw when it doesn't pay off
+COMPRESS_WORKERS = os.cpu_count() or 2 # Shared pool compressing chunks ahead of the streams
+COMPRESS_LOOKAHEAD = 2 # Chunks' worth of data per stream compressed ahead of the one on the wire
+HASH_LOOKAHEAD = 2 # Chunks per hash worker digested ahead of the streams asking for them
+BATCH_LOOKAHEAD = 256 # Cap on small files in flight through the compression pool per stream
+BATCH_INLINE_SIZE = 64 * 1024 # Files up to this size are read, hashed and framed inline, not sendfile()d
+BATCH_FLUSH_SIZE = 1024 * 1024 # Coalesced frames are written once this much is buffered
+PROGRESS_INTERVAL = 0.1 # Seconds between progress callbacks while streaming many small files
+COMPRESS_MIN_SIZE = 4096 # Smaller chunks and folder entries are always sent raw
+COMPRESS_SAMPLE = 64 * 1024 # Bytes test-compressed to pick a codec for a chunk
+COMPRESS_MAX_RATIO = 0.9 # Samples that shrink less than this are already compressed
+LINK_RATE_GUESS = 50 * 1024 * 1024 # Bytes/s assumed per stream until the first chunk is timed
+STRONG_COST = 4 # lzma preset 0 is about 4x slower than zlib level 1...
+STRONG_GAIN = 0.8 # ...and its output about 20% smaller on text-like data
+
+# Codec frame in front of every chunk: codec (1 byte) + payload size on the wire (4 bytes)
+CHUNK_FRAME = struct.Struct("!BI")
+CODEC_RAW = 0
+CODEC_FAST = 1 # zlib level 1
+CODEC_STRONG = 2 # lzma preset 0, for links slow enough to pay for it
+CODEC_NAMES = {"zlib": CODEC_FAST, "lzma": CODEC_STRONG}
+SUPPORTED_CODECS = ["zlib", "lzma"] if lzma else ["zlib"]
+
+# Folder stream entries: kind (1 byte) + path length (2 bytes) + payload size (8 bytes)
+TREE_ENTRY = struct.Struct("!BHQ")
+TREE_END = 0
+TREE_FILE = 1
+TREE_DIR = 2
+HEARTBEAT_INTERVAL = 5 # Seconds of idle time before a peer link sends a heartbeat
+LINK_TIMEOUT = 3 * HEARTBEAT_INTERVAL # A link that stays silent this long is considered dead
+LINK_RETRIES = 5 # Reconnect attempts before a peer link gives up and drops its queue
+LINK_QUEUE_LIMIT = 10000 # Frames waiting per peer before new messages are refused
+LINK_FRAGMENT_SIZE = 64 * 1024 # Larger messages are split so they can't hold up other channels
+LINK_BATCH_SIZE = 256 * 1024 # Queued frames coalesced into one send
+FRAME_BUFFER_SIZE = 256 * 1024 # Chat receive buffer; grows for a single larger frame, then shrinks back
+FRAME_MIN_READ = 16 * 1024 # Buffered data is compacted when less free space than this is left
+MAX_FRAME_SIZE = 256 * 1024 * 1024 # Larger chat frames (or reassembled messages) are treated as a corrupt stream
+MAX_OPEN_FRAGMENTS = 8 # Fragmented messages a connection may have half-received at once
 SEPARATOR = "<SEPARATOR>"
 BROADCAST_IP = "255.255.255.255"
+BROADCAST_INTERVAL = 3 # Seconds between JSON beacons of older peers, also how often silent peers are expired
+BEACON_MIN_INTERVAL = 0.5 # Beacon interval at startup and after our info or interfaces change...
+BEACON_MAX_INTERVAL = 20 # ...doubling after every beacon up to this while nothing changes
+BEACON_HELLO_ROUNDS = 3 # Startup beacons that ask peers already settled for an immediate unicast reply
+BEACON_REPLY_RATE = 1 # Unicast replies per second; past that a crowd of newcomers gets an early broadcast
+INTERFACE_REFRESH = 30 # Seconds between checks for added or removed network interfaces
+PEER_MISSED_BEACONS = 3 # Beacons a peer may miss before it is dropped
+PEER_TTL = PEER_MISSED_BEACONS * BROADCAST_INTERVAL + 1 # For JSON beacons, which don't say when the next one comes
+KNOWN_PEERS_FILE = "known_peers.json" # Lives next to settings.json
+KNOWN_PEERS_MAX = 256 # Most recently seen peers probed at startup
+KNOWN_PEERS_MAX_AGE = 30 * 24 * 3600 # Seconds since last seen before a peer is forgotten
+KNOWN_PEERS_SAVE_INTERVAL = 60 # Seconds between writes of the known-peer cache while running
+PROBE_RETRY = 0.04 # Seconds before unanswered startup probes are sent once more...
+PROBE_TIMEOUT = 0.12 # ...and before cached peers that still haven't answered are dropped
+
+# Binary beacon: magic + version + flags + IPv4 + sender's current interval (1/10 s) + nick and avatar
+# lengths, then the UTF-8 nick and avatar. Later versions may append fields after the avatar.
+BEACON_MAGIC = b"\xffD" # Not valid UTF-8, so peers that only know JSON beacons drop it
+BEACON_VERSION = 1
+BEACON_HEADER = struct.Struct("!2sBB4sHBB")
+BEACON_HELLO = 1 # Flag: the sender just started and wants to hear from everyone now
+BEACON_PROBE = 2 # Flag: unicast probe of a cached peer; answered even by peers that are starting
+
+# Peer table events
+PEER_UNVERIFIED = "unverified" # Cached from an earlier run, being probed; "added" or "removed" follows
+PEER_ADDED = "added"
+PEER_CHANGED = "changed"
+PEER_REMOVED = "removed"
 
 # Message Types
 MSG_TYPE_CHAT = 0
@@ -20,12 +121,32 @@ MSG_TYPE_CLIPBOARD = 1
 MSG_TYPE_SCREEN_REQUEST = 2
 MSG_TYPE_SCREEN_ACCEPT = 3
 MSG_TYPE_SCREEN_REJECT = 4
+MSG_TYPE_HEARTBEAT = 5
+MSG_TYPE_FRAGMENT = 6 # Content: inner type (1 byte) + FRAGMENT_* flags (1 byte) + piece
+MSG_TYPE_GROUP = 7 # Content: JSON {"group", "name", "members", "text"}
+MSG_TYPE_CLIPBOARD_DATA = 8 # Binary content, see clipboard_sync.CLIPBOARD_HEADER
+MSG_TYPE_ACK = 9 # Receiver -> sender on a peer link. Content: LINK_ACK
+LINK_ACK = struct.Struct("!Q") # Frames received on this connection so far, heartbeats aside
+FRAGMENT_FIRST = 1
+FRAGMENT_LAST = 2
+
+# Peer link channel priorities, lower goes first
+CHANNEL_PRIORITY = {
+    MSG_TYPE_HEARTBEAT: 0,
+    MSG_TYPE_SCREEN_REQUEST: 0,
+    MSG_TYPE_SCREEN_ACCEPT: 0,
+    MSG_TYPE_SCREEN_REJECT: 0,
+    MSG_TYPE_CHAT: 1,
+    MSG_TYPE_GROUP: 1,
+    MSG_TYPE_CLIPBOARD: 2,
+    MSG_TYPE_CLIPBOARD_DATA: 2
+}
 
-def get_local_ip():
-    """Retrieves the local IP address of the machine."""
+def get_local_ip(target='10.255.255.255'):
+    """Retrieves the local IP address of the machine (the one routed towards `target`)."""
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
-        s.connect(('10.255.255.255', 1))
+        s.connect((target, 1))
         IP = s.getsockname()[0]
     except Exception:
         IP = '127.0.0.1'
@@ -33,6 +154,244 @@ def get_local_ip():
         s.close()
     return IP
 
+def recv_exact(sock, size):
+    """Reads exactly `size` bytes from a socket, raising if the peer hangs up early."""
+    buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < size:
+        n = sock.recv_into(view[pos:], size - pos)
+        if not n:
+            raise ConnectionError(f"Connection closed after {pos}/{size} bytes")
+        pos += n
+    return bytes(buf)
+
+def fadvise(fd, offset, length, advice):
+    """Page-cache hint (e.g. "POSIX_FADV_DONTNEED"); silently skipped where unsupported."""
+    if not hasattr(os, "posix_fadvise") or not hasattr(os, advice):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, getattr(os, advice))
+    except OSError:
+        pass
+
+def preallocate(fd, size):
+    """Reserves disk blocks up front where the filesystem supports it."""
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            pass
+
+def recv_fill(sock, view, size):
+    """recv_into until `size` bytes of `view` are filled."""
+    pos = 0
+    while pos < size:
+        n = sock.recv_into(view[pos:size], size - pos)
+        if not n:
+            raise ConnectionError(f"Connection closed after {pos}/{size} bytes")
+        pos += n
+    return size
+
+def walk_tree(folder):
+    """Yields (kind, relative posix path, absolute path, size) for a folder stream."""
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames.sort()
+        rel_dir = os.path.relpath(dirpath, folder)
+        if rel_dir != ".":
+            yield TREE_DIR, rel_dir.replace(os.sep, "/"), dirpath, 0
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if not os.path.isfile(path):
+                continue
+            rel = name if rel_dir == "." else f"{rel_dir}/{name}"
+            yield TREE_FILE, rel.replace(os.sep, "/"), path, os.path.getsize(path)
+
+def throttled(callback, interval=PROGRESS_INTERVAL):
+    """Wraps an on_progress callback so it fires at most every `interval` seconds, plus on completion."""
+    last = [0.0]
+
+    def call(name, done, total):
+        now = time.monotonic()
+        if done >= total or now - last[0] >= interval:
+            last[0] = now
+            callback(name, done, total)
+    return call
+
+def walk_batch(paths):
+    """walk_tree entries for several files and folders sent together, named under their basenames."""
+    for path in paths:
+        name = os.path.basename(os.path.normpath(path))
+        if os.path.isdir(path):
+            yield TREE_DIR, name, path, 0
+            for kind, rel, abs_path, size in walk_tree(path):
+                yield kind, f"{name}/{rel}", abs_path, size
+        elif os.path.isfile(path):
+            yield TREE_FILE, name, path, os.path.getsize(path)
+
+class BufferedSocket:
+    """recv_into() served from a read-ahead buffer, so a run of small frames costs one recv."""
+
+    def __init__(self, sock, size=RECV_BUFFER_SIZE):
+        self._reader = sock.makefile("rb", buffering=size)
+
+    def recv_into(self, view, nbytes=0):
+        return self._reader.readinto1(view[:nbytes or len(view)])
+
+def safe_join(base, relpath):
+    """Joins a peer-supplied relative path under `base`, rejecting escapes."""
+    parts = [p for p in relpath.replace("\\", "/").split("/") if p not in ("", ".")]
+    if not parts or any(p == ".." or ":" in p for p in parts):
+        raise ValueError(f"Unsafe path in folder stream: {relpath!r}")
+    return os.path.join(base, *parts)
+
+def merkle_root(digests):
+    """Hex root of a binary SHA-256 Merkle tree over chunk digests (odd nodes are carried up)."""
+    level = list(digests) or [hashlib.sha256(b"").digest()]
+    while len(level) > 1:
+        level = [hashlib.sha256(level[i] + level[i + 1]).digest() if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+    return level[0].hex()
+
+def hash_range(path, offset, size, drop=False, digest=None):
+    """
+    SHA-256 of `size` bytes at `offset`, or of everything fed to `digest` so far when
+    continuing one. With `drop` the range is evicted from the page cache afterwards,
+    for data that isn't about to be sent from it.
+    """
+    if digest is None:
+        digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        fadvise(f.fileno(), offset, size, "POSIX_FADV_SEQUENTIAL")
+        f.seek(offset)
+        remaining = size
+        while remaining > 0:
+            data = f.read(min(RECV_BUFFER_SIZE, remaining))
+            if not data:
+                break
+            digest.update(data)
+            remaining -= len(data)
+        if drop:
+            fadvise(f.fileno(), offset, size, "POSIX_FADV_DONTNEED")
+    return digest.digest()
+
+def send_json(sock, obj):
+    """Sends a length-prefixed JSON document (the file transfer control format)."""
+    data = json.dumps(obj).encode('utf-8')
+    sock.sendall(struct.pack("!I", len(data)) + data)
+
+def recv_json(sock):
+    length = struct.unpack("!I", recv_exact(sock, 4))[0]
+    return json.loads(recv_exact(sock, length).decode('utf-8'))
+
+def chunk_runs(indices):
+    """Collapses sorted chunk indices into [first, count] runs."""
+    runs = []
+    for i in indices:
+        if runs and runs[-1][0] + runs[-1][1] == i:
+            runs[-1][1] += 1
+        else:
+            runs.append([i, 1])
+    return runs
+
+def split_ranges(ranges, parts, chunk_size=CHUNK_SIZE):
+    """Splits chunk-aligned [offset, length] ranges into at most `parts` groups of whole chunks."""
+    chunks = []
+    for offset, length in ranges:
+        end = offset + length
+        while offset < end:
+            size = min(chunk_size, end - offset)
+            chunks.append((offset, size))
+            offset += size
+    if not chunks:
+        return []
+    per_group = -(-len(chunks) // max(1, parts))
+    groups = []
+    for i in range(0, len(chunks), per_group):
+        group = []
+        for offset, size in chunks[i:i + per_group]:
+            if group and group[-1][0] + group[-1][1] == offset:
+                group[-1][1] += size
+            else:
+                group.append([offset, size])
+        groups.append(group)
+    return groups
+
+def compress_chunk(codec, data):
+    if codec == CODEC_FAST:
+        return zlib.compress(data, 1)
+    return lzma.compress(data, preset=0)
+
+def decompress_chunk(codec, payload, size):
+    """Inflates one codec frame, refusing anything that doesn't expand to exactly `size` bytes."""
+    if codec == CODEC_FAST:
+        decoder = zlib.decompressobj()
+    elif codec == CODEC_STRONG and lzma:
+        decoder = lzma.LZMADecompressor()
+    else:
+        raise ValueError(f"Unknown codec {codec}")
+    data = decoder.decompress(payload, size + 1)
+    if len(data) != size:
+        raise ValueError(f"Chunk inflated to {len(data)} bytes, expected {size}")
+    return data
+
+def pick_codec(sample, codecs, link_rate, workers):
+    """
+    Picks the codec that gets data like `sample` across fastest; returns (codec, zlib'd sample).
+
+    The sample is compressed with zlib level 1 to estimate ratio and speed. With `workers`
+    threads compressing while the stream sends, a codec costs max(compress, send) time per
+    byte, compared with 1 / link_rate for the raw bytes.
+    """
+    start = time.perf_counter()
+    packed = zlib.compress(sample, 1)
+    ratio = len(packed) / max(1, len(sample))
+    if ratio > COMPRESS_MAX_RATIO:
+        return CODEC_RAW, packed
+    speed = len(sample) / max(time.perf_counter() - start, 1e-6) * workers
+    link_rate = link_rate or LINK_RATE_GUESS
+
+    costs = {CODEC_RAW: 1 / link_rate, CODEC_FAST: max(1 / speed, ratio / link_rate)}
+    if CODEC_STRONG in codecs:
+        costs[CODEC_STRONG] = max(STRONG_COST / speed, ratio * STRONG_GAIN / link_rate)
+    return min((c for c in costs if c == CODEC_RAW or c in codecs), key=costs.get), packed
+
+def pack_chunk(path, offset, size, codecs, link_rate, workers):
+    """(codec, payload) for one file range, payload None meaning "send it raw" (via sendfile)."""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        sample = f.read(min(COMPRESS_SAMPLE, size))
+        codec, _ = pick_codec(sample, codecs, link_rate, workers)
+        if codec == CODEC_RAW:
+            return CODEC_RAW, None
+        f.seek(offset)
+        payload = compress_chunk(codec, f.read(size))
+    if len(payload) >= size:
+        return CODEC_RAW, None
+    return codec, payload
+
+def pack_frame(data, codecs, link_rate):
+    """A whole codec frame for data already in memory, compressed on the calling thread."""
+    if codecs and len(data) >= COMPRESS_MIN_SIZE:
+        codec, packed = pick_codec(data[:COMPRESS_SAMPLE], codecs, link_rate, 1)
+        if codec != CODEC_RAW:
+            payload = packed if codec == CODEC_FAST and len(data) <= COMPRESS_SAMPLE else compress_chunk(codec, data)
+            if len(payload) < len(data):
+                return CHUNK_FRAME.pack(codec, len(payload)) + payload
+    return CHUNK_FRAME.pack(CODEC_RAW, len(data)) + data
+
+class LinkMeter:
+    """Moving average of one stream's throughput, timed around each chunk's sendall."""
+
+    def __init__(self):
+        self.rate = None
+
+    def update(self, nbytes, seconds):
+        if seconds <= 0 or nbytes < COMPRESS_MIN_SIZE:
+            return
+        rate = nbytes / seconds
+        self.rate = rate if self.rate is None else 0.7 * self.rate + 0.3 * rate
+
 class SettingsManager:
     def __init__(self, settings_file="settings.json"):
         self.settings_file = settings_file
@@ -40,7 +399,9 @@ class SettingsManager:
             "nickname": f"User_{get_local_ip().split('.')[-1]}",
             "download_dir": "received_files",
             "avatar": "👤", # Default emoji avatar
-            "clipboard_share": False
+            "clipboard_share": False,
+            "groups": {}, # Group id -> {"name", "members"}
+            "rendezvous": "" # Optional rendezvous server, "host" or "host:port"
         }
         self.settings = self.load_settings()
 
@@ -65,12 +426,313 @@ class SettingsManager:
     def get(self, key):
         return self.settings.get(key, self.default_settings.get(key))
 
+def list_interfaces():
+    """(address, broadcast) for every IPv4 interface that is up, loopback left out."""
+    found = set()
+    if psutil:
+        stats = psutil.net_if_stats()
+        for name, addrs in psutil.net_if_addrs().items():
+            if name in stats and not stats[name].isup:
+                continue
+            for addr in addrs:
+                if addr.family != socket.AF_INET or addr.address.startswith("127."):
+                    continue
+                broadcast = addr.broadcast
+                if not broadcast and addr.netmask:
+                    network = ipaddress.IPv4Network(f"{addr.address}/{addr.netmask}", strict=False)
+                    broadcast = str(network.broadcast_address)
+                # Point-to-point links (e.g. a /32 VPN address) have nowhere to broadcast to
+                found.add((addr.address, broadcast if broadcast and broadcast != addr.address else None))
+    else:
+        # Without psutil there is no telling which interface an address is on: only the
+        # default route's gets beacons (a limited broadcast leaves through it anyway),
+        # the others are still known as ours
+        primary = get_local_ip()
+        addresses = set()
+        try:
+            addresses.update(info[4][0] for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET))
+        except OSError:
+            pass
+        found = {(ip, None) for ip in addresses - {primary} if not ip.startswith("127.")}
+        if not primary.startswith("127."):
+            found.add((primary, BROADCAST_IP))
+    return sorted(found)
+
+def pack_beacon(ip, nick, avatar, interval, flags=0):
+    nick = nick.encode('utf-8')[:255]
+    avatar = avatar.encode('utf-8')[:255]
+    return BEACON_HEADER.pack(BEACON_MAGIC, BEACON_VERSION, flags, socket.inet_aton(ip),
+                              min(int(interval * 10), 0xFFFF), len(nick), len(avatar)) + nick + avatar
+
+def unpack_beacon(data):
+    """(info, flags, interval) from a binary beacon; ValueError if it isn't one."""
+    if len(data) < BEACON_HEADER.size:
+        raise ValueError("Short beacon")
+    magic, version, flags, ip, interval, nick_len, avatar_len = BEACON_HEADER.unpack_from(data)
+    end = BEACON_HEADER.size + nick_len
+    if magic != BEACON_MAGIC or version < 1 or len(data) < end + avatar_len:
+        raise ValueError("Not a beacon")
+    info = {
+        "type": "discovery",
+        "ip": socket.inet_ntoa(ip),
+        "nick": data[BEACON_HEADER.size:end].decode('utf-8', 'ignore'),
+        "avatar": data[end:end + avatar_len].decode('utf-8', 'ignore')
+    }
+    return info, flags, interval / 10
+
+class BeaconTimer:
+    """
+    Trickle-style beacon schedule: the interval starts at BEACON_MIN_INTERVAL, doubles
+    after every beacon up to BEACON_MAX_INTERVAL and drops back on reset(). Each beacon
+    goes out at a random point in the second half of its interval, so peers that
+    started together drift apart instead of broadcasting in lockstep.
+    """
+
+    def __init__(self, low=BEACON_MIN_INTERVAL, high=BEACON_MAX_INTERVAL, now=None):
+        self.low = low
+        self.high = high
+        self.reset(now)
+
+    def reset(self, now=None):
+        self.interval = self.low
+        self.sent_at = time.monotonic() if now is None else now # Last beacon, or when the schedule started
+        self._schedule(self.sent_at)
+
+    def _schedule(self, now):
+        self.next_at = now + random.uniform(self.interval / 2, self.interval)
+
+    def remaining(self, now=None):
+        return max(0.0, self.next_at - (time.monotonic() if now is None else now))
+
+    def due(self, now=None):
+        return self.remaining(now) == 0
+
+    def hurry(self, within, now=None):
+        """
+        Brings the next beacon forward to `within` seconds after the last one at most
+        (at a random point in the second half), keeping the interval. Repeated calls
+        therefore can't make beacons more frequent than that.
+        """
+        now = time.monotonic() if now is None else now
+        self.next_at = min(self.next_at, max(now, self.sent_at + random.uniform(within / 2, within)))
+
+    def sent(self, now=None):
+        """Moves to the next, longer interval; beacons should advertise the new one."""
+        self.interval = min(self.interval * 2, self.high)
+        self.sent_at = time.monotonic() if now is None else now
+        self._schedule(self.sent_at)
+
+class LocalInterfaces:
+    """Cached local addresses, re-enumerated at most every INTERFACE_REFRESH seconds."""
+
+    def __init__(self):
+        self.interfaces = [] # (address, broadcast or None)
+        self.addresses = frozenset(["127.0.0.1"])
+        self._checked = None
+        self.refresh()
+
+    def refresh(self):
+        """Re-enumerates if due; True when the interfaces changed."""
+        now = time.monotonic()
+        if self._checked is not None and now - self._checked < INTERFACE_REFRESH:
+            return False
+        self._checked = now
+        found = list_interfaces()
+        if found == self.interfaces:
+            return False
+        self.interfaces = found
+        self.addresses = frozenset(ip for ip, _ in found) | {"127.0.0.1"}
+        return True
+
+    def invalidate(self):
+        """Forces a re-enumeration on the next refresh(), e.g. after a send failed."""
+        self._checked = None
+
+    def address_for(self, ip):
+        """Our address as `ip` sees it: the only interface's, else the one the route to it leaves from."""
+        if len(self.interfaces) == 1:
+            return self.interfaces[0][0]
+        return get_local_ip(ip)
+
+class PeerTable:
+    """
+    Live peers with the time each one is due to beacon again. Beacons that only confirm
+    a known peer update its timestamp and nothing else; on_event(event, info) runs
+    only when a peer appears, its info changes or it misses beacons for `ttl` seconds.
+    """
+
+    def __init__(self, on_event=None, ttl=PEER_TTL):
+        self.on_event = on_event
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._peers = {} # IP -> Info dict
+        self._deadline = {} # IP -> time.monotonic() after which it counts as gone
+        self._pending = {} # IP -> (info, deadline) of cached peers not heard from yet
+        self._listed = set() # IPs a rendezvous server lists, which stay until released
+
+    def seen(self, info, now=None, ttl=None, listed=False):
+        """
+        Records a beacon, or a rendezvous listing if `listed`; returns the event it caused,
+        or None for a plain heartbeat. `ttl` overrides the table's for this peer, for senders
+        that say when they'll beacon next.
+        """
+        ip = info['ip']
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if listed:
+                # A listing keeps the beacon deadline as it was, for when the server drops the peer
+                self._listed.add(ip)
+                self._deadline.setdefault(ip, now)
+            else:
+                deadline = now + (self.ttl if ttl is None else ttl)
+                self._deadline[ip] = max(deadline, self._deadline.get(ip, deadline))
+            self._pending.pop(ip, None)
+            known = self._peers.get(ip)
+            if known == info:
+                return None
+            self._peers[ip] = info
+            event = PEER_CHANGED if known else PEER_ADDED
+        if self.on_event:
+            self.on_event(event, info)
+        return event
+
+    def expect(self, info, deadline):
+        """Lists a peer from an earlier run as unverified until `deadline`, unless it is already live."""
+        ip = info['ip']
+        with self._lock:
+            if ip in self._peers or ip in self._pending:
+                return
+            self._pending[ip] = (info, deadline)
+        if self.on_event:
+            self.on_event(PEER_UNVERIFIED, info)
+
+    def release(self, ip, ttl=0, now=None):
+        """
+        Ends a rendezvous listing: the peer now lives on beacons alone and expires when its
+        last beacon does, or `ttl` from now if that is later.
+        """
+        with self._lock:
+            self._listed.discard(ip)
+            if ip in self._deadline:
+                self._deadline[ip] = max(self._deadline[ip], (time.monotonic() if now is None else now) + ttl)
+
+    def pending(self):
+        """IPs of unverified peers."""
+        with self._lock:
+            return list(self._pending)
+
+    def expire(self, now=None):
+        """Drops peers silent for longer than their TTL, and unverified ones past their deadline; returns their info."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            gone = [ip for ip, deadline in self._deadline.items() if deadline < now and ip not in self._listed]
+            removed = [self._peers.pop(ip) for ip in gone]
+            for ip in gone:
+                del self._deadline[ip]
+            unanswered = [ip for ip, (_, deadline) in self._pending.items() if deadline < now]
+            removed += [self._pending.pop(ip)[0] for ip in unanswered]
+        if self.on_event:
+            for info in removed:
+                self.on_event(PEER_REMOVED, info)
+        return removed
+
+    def get(self, ip):
+        with self._lock:
+            return self._peers.get(ip)
+
+    def snapshot(self):
+        """IP -> info of every live peer, as a copy."""
+        with self._lock:
+            return dict(self._peers)
+
+    def __contains__(self, ip):
+        return ip in self._peers
+
+    def __len__(self):
+        return len(self._peers)
+
+class KnownPeers:
+    """
+    Peers seen in earlier runs, so the list isn't empty while the first beacons
+    are on their way. Kept in memory while running and written out now and then.
+    """
+
+    def __init__(self, path=KNOWN_PEERS_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._peers = self._load() # IP -> {"nick", "avatar", "last_seen"}
+        self._dirty = False
+        self._saved = time.monotonic()
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                peers = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        oldest = time.time() - KNOWN_PEERS_MAX_AGE
+        return {ip: peer for ip, peer in peers.items() if peer.get("last_seen", 0) >= oldest}
+
+    def recent(self):
+        """Beacon-style info of the most recently seen peers, newest first."""
+        with self._lock:
+            peers = sorted(self._peers.items(), key=lambda item: item[1].get("last_seen", 0), reverse=True)
+        return [{"type": "discovery", "ip": ip, "nick": peer.get("nick", ip), "avatar": peer.get("avatar", "👤")}
+                for ip, peer in peers[:KNOWN_PEERS_MAX]]
+
+    def seen(self, info):
+        with self._lock:
+            self._peers[info['ip']] = {"nick": info.get('nick'), "avatar": info.get('avatar'), "last_seen": time.time()}
+            self._dirty = True
+
+    def save(self, force=False):
+        """Writes the cache if it changed, at most every KNOWN_PEERS_SAVE_INTERVAL unless forced."""
+        with self._lock:
+            if not self._dirty or (not force and time.monotonic() - self._saved < KNOWN_PEERS_SAVE_INTERVAL):
+                return
+            peers = sorted(self._peers.items(), key=lambda item: item[1]["last_seen"], reverse=True)
+            self._peers = dict(peers[:KNOWN_PEERS_MAX])
+            self._dirty = False
+            self._saved = time.monotonic()
+            try:
+                tmp = self.path + ".tmp"
+                with open(tmp, "w") as f:
+                    json.dump(self._peers, f, indent=4)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                print(f"Error saving known peers: {e}")
+
 class DiscoveryService:
-    def __init__(self, settings_manager, on_peer_found_callback):
+    """
+    Finds peers on the LAN. Beacons are compact binary (see BEACON_HEADER) and
+    follow a BeaconTimer, so a stable network settles at one beacon per peer every
+    10-20 seconds; each beacon says how long until the sender's next, which sets
+    its TTL here. A peer that just started flags its first beacons as hello and
+    peers already settled answer it with one unicast beacon, so it learns the
+    network at once without anyone else speeding up; when many start together,
+    each settled peer brings its next broadcast forward instead.
+
+    JSON beacons from older peers are still understood, and while one is around
+    every broadcast also goes out as JSON for it.
+
+    With a KnownPeers cache, peers from earlier runs are listed as unverified
+    right away and probed by unicast; they are confirmed by the reply or dropped
+    after PROBE_TIMEOUT.
+    """
+
+    def __init__(self, settings_manager, on_peer_event, on_peer_seen=None, known_peers=None):
         self.settings_manager = settings_manager
-        self.on_peer_found = on_peer_found_callback
+        self.on_peer_seen = on_peer_seen # (ip) for every beacon of a live peer; must be cheap
         self.running = False
-        self.found_peers = {} # IP -> Info dict
+        self.peers = PeerTable(on_peer_event) # on_peer_event(PEER_UNVERIFIED/ADDED/CHANGED/REMOVED, info)
+        self.known = known_peers
+        self.local = LocalInterfaces()
+        self.timer = BeaconTimer()
+        self._hello = BEACON_HELLO_ROUNDS # Beacons left that ask for replies
+        self._own = None # (nick, avatar) last announced; a change restarts the fast beacons
+        self._legacy_until = 0 # JSON beacons are sent alongside until this time.monotonic()
+        self._replied = {} # IP -> when it last got a unicast reply
+        self._reply_window = (0, 0) # (second started, replies sent in it)
 
     def start(self):
         self.running = True
@@ -79,6 +741,8 @@ class DiscoveryService:
 
     def stop(self):
         self.running = False
+        if self.known:
+            self.known.save(force=True)
 
     def _listen_broadcast(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -92,45 +756,490 @@ class DiscoveryService:
         while self.running:
             try:
                 data, addr = sock.recvfrom(1024)
-                try:
-                    msg = json.loads(data.decode('utf-8'))
-                    if msg.get('type') == 'discovery':
-                        ip = msg.get('ip')
-                        if ip != get_local_ip():
-                            # Update peer info
-                            self.found_peers[ip] = msg
-                            self.on_peer_found(msg)
-                except json.JSONDecodeError:
-                    # Legacy or invalid message
-                    pass
+                for payload, address in self.handle_beacon(data):
+                    sock.sendto(payload, address)
             except Exception:
                 pass
         sock.close()
 
+    def handle_beacon(self, data):
+        """Processes one datagram; returns the (payload, address) replies to send, usually none."""
+        now = time.monotonic()
+        flags = 0
+        ttl = None
+        legacy = False
+        try:
+            if data[:len(BEACON_MAGIC)] == BEACON_MAGIC:
+                msg, flags, interval = unpack_beacon(data)
+                ttl = PEER_MISSED_BEACONS * interval + 1
+            else:
+                msg = json.loads(data.decode('utf-8'))
+                if not isinstance(msg, dict) or msg.get('type') != 'discovery':
+                    return []
+                legacy = 'v' not in msg # Newer peers mark the JSON copy they send for older ones
+                msg.pop('v', None)
+        except (ValueError, struct.error):
+            # Invalid message
+            return []
+
+        ip = msg.get('ip')
+        if not ip or ip in self.local.addresses:
+            return []
+        if legacy:
+            self._legacy_until = now + PEER_TTL
+        event = self.peers.seen(msg, now, ttl)
+        if self.known:
+            self.known.seen(msg)
+        if self.on_peer_seen:
+            self.on_peer_seen(ip)
+
+        # Newcomers hear from settled peers right away; a peer that is starting itself broadcasts soon anyway.
+        # A probe is addressed to us alone, so it is answered even while starting or if we just replied.
+        probe = flags & BEACON_PROBE
+        newcomer = probe or flags & BEACON_HELLO or (legacy and event == PEER_ADDED)
+        if not newcomer:
+            return []
+        if not probe and (self._hello or now - self._replied.get(ip, -BEACON_MAX_INTERVAL) < BEACON_MAX_INTERVAL):
+            return []
+        self._replied[ip] = now
+        started, count = self._reply_window
+        if now - started >= 1:
+            started, count = now, 0
+        if count >= BEACON_REPLY_RATE:
+            self.timer.hurry(BROADCAST_INTERVAL, now) # One broadcast answers all of them
+            return []
+        self._reply_window = (started, count + 1)
+        return [(self.beacon(self.local.address_for(ip), legacy=legacy), (ip, DISCOVERY_PORT))]
+
+    def beacon(self, ip=None, legacy=False, probe=False):
+        nick = self.settings_manager.get("nickname")
+        avatar = self.settings_manager.get("avatar")
+        if legacy:
+            msg = {"type": "discovery", "ip": ip or get_local_ip(), "nick": nick, "avatar": avatar, "v": BEACON_VERSION}
+            return json.dumps(msg).encode('utf-8')
+        flags = (BEACON_HELLO if self._hello else 0) | (BEACON_PROBE if probe else 0)
+        return pack_beacon(ip or get_local_ip(), nick, avatar, self.timer.interval, flags)
+
+    def probe_known(self):
+        """Lists cached peers as unverified and returns the unicast probes to send them."""
+        if not self.known:
+            return []
+        deadline = time.monotonic() + PROBE_TIMEOUT
+        for info in self.known.recent():
+            if info['ip'] not in self.local.addresses:
+                self.peers.expect(info, deadline)
+        return self.probes()
+
+    def remote_peer(self, info):
+        """A peer listed by a rendezvous server (see rendezvous.py), kept until released from the table."""
+        if info['ip'] in self.local.addresses:
+            return
+        self.peers.seen(info, listed=True)
+        if self.known:
+            self.known.seen(info)
+        if self.on_peer_seen:
+            self.on_peer_seen(info['ip'])
+
+    def probes(self):
+        """Probes for the cached peers that haven't answered yet."""
+        return [(self.beacon(self.local.address_for(ip), probe=True), (ip, DISCOVERY_PORT)) for ip in self.peers.pending()]
+
+    def beacons(self):
+        """
+        (payload, address) pairs for one round: a subnet-directed broadcast on every
+        interface, each naming that interface's address so peers reply on a reachable one.
+        """
+        formats = [False, True] if time.monotonic() < self._legacy_until else [False]
+        targets = [(ip, broadcast) for ip, broadcast in self.local.interfaces if broadcast]
+        if not targets:
+            return [(self.beacon(legacy=legacy), (BROADCAST_IP, DISCOVERY_PORT)) for legacy in formats]
+        return [(self.beacon(ip, legacy), (broadcast, DISCOVERY_PORT))
+                for ip, broadcast in targets for legacy in formats]
+
+    def beacon_round(self):
+        """
+        One tick of the sender loop: expires silent peers and returns (beacons due now,
+        seconds until the next tick). Ticks come at least every BROADCAST_INTERVAL for expiry.
+        """
+        now = time.monotonic()
+        self.peers.expire(now)
+        if self.known:
+            self.known.save()
+        for ip in [ip for ip, replied in self._replied.items() if now - replied >= BEACON_MAX_INTERVAL]:
+            del self._replied[ip]
+        own = (self.settings_manager.get("nickname"), self.settings_manager.get("avatar"))
+        if self.local.refresh() or own != self._own:
+            self._own = own
+            self.timer.reset(now)
+
+        beacons = []
+        if self.timer.due(now):
+            self.timer.sent(now) # Beacons advertise the interval until the next one
+            beacons = self.beacons()
+            self._hello = max(0, self._hello - 1)
+        return beacons, min(self.timer.remaining(now), BROADCAST_INTERVAL)
+
     def _send_broadcast(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+        def send(beacons):
+            for payload, address in beacons:
+                try:
+                    sock.sendto(payload, address)
+                except OSError:
+                    self.local.invalidate() # The interface may be gone
+
+        # Cached peers first: probed twice, then whoever didn't answer is dropped
+        send(self.probe_known())
+        time.sleep(PROBE_RETRY)
+        send(self.probes())
+        time.sleep(PROBE_TIMEOUT - PROBE_RETRY)
+        self.peers.expire()
         while self.running:
+            beacons, delay = self.beacon_round()
+            send(beacons)
+            time.sleep(delay)
+        sock.close()
+
+class FrameDecoder:
+    """
+    Chat wire decoder: socket data is recv_into()'d straight into one buffer and complete
+    type+length frames are sliced out of it as memoryviews, so a burst of small messages
+    costs one syscall and a payload of any size arrives whole.
+
+    Yielded payloads point into the buffer and are only valid until the next get_buffer().
+    """
+
+    HEADER = struct.Struct("!BI")
+
+    def __init__(self, size=FRAME_BUFFER_SIZE):
+        self.size = size
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0 # First byte not yet decoded
+        self.end = 0 # End of received data
+
+    def get_buffer(self, sizehint=0):
+        """Free space after the received data, for recv_into() or asyncio's BufferedProtocol."""
+        pending = self.end - self.start
+        wanted = max(FRAME_MIN_READ, self._frame_size() - pending)
+        if len(self.buf) - self.end < wanted:
+            if pending + wanted > len(self.buf):
+                self._resize(pending + wanted)
+            else:
+                # Slide the partial frame to the front (copied first, the ranges may overlap)
+                self.buf[:pending] = bytes(self.view[self.start:self.end])
+                self.start, self.end = 0, pending
+        return self.view[self.end:]
+
+    def advance(self, nbytes):
+        self.end += nbytes
+
+    def frames(self):
+        """Yields (msg_type, payload view) for every complete frame received so far."""
+        header = self.HEADER.size
+        while self.end - self.start >= header:
+            msg_type, length = self.HEADER.unpack_from(self.buf, self.start)
+            frame_end = self.start + header + length
+            if frame_end > self.end:
+                self._frame_size() # Rejects a bogus length before we wait for its payload
+                break
+            yield msg_type, self.view[self.start + header:frame_end]
+            self.start = frame_end
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buf) > self.size:
+                self._resize(self.size)
+
+    def _frame_size(self):
+        """Full size of the frame at the front, once its header is in."""
+        if self.end - self.start < self.HEADER.size:
+            return self.HEADER.size
+        length = self.HEADER.unpack_from(self.buf, self.start)[1]
+        if length > MAX_FRAME_SIZE:
+            raise ValueError(f"Chat frame of {length} bytes exceeds MAX_FRAME_SIZE")
+        return self.HEADER.size + length
+
+    def _resize(self, size):
+        buf = bytearray(size)
+        pending = self.end - self.start
+        buf[:pending] = self.view[self.start:self.end]
+        self.buf, self.view = buf, memoryview(buf)
+        self.start, self.end = 0, pending
+
+def reassemble(msg_type, content, fragments):
+    """
+    (msg_type, content) of the message a frame completes, or None while more pieces are due.
+    `fragments` holds one connection's half-received messages (inner type -> bytearray); past
+    MAX_FRAME_SIZE or MAX_OPEN_FRAGMENTS they are discarded and ValueError drops the connection.
+    """
+    if msg_type != MSG_TYPE_FRAGMENT:
+        return msg_type, content
+    inner_type, flags = content[0], content[1]
+    if flags & FRAGMENT_FIRST:
+        if inner_type not in fragments and len(fragments) >= MAX_OPEN_FRAGMENTS:
+            fragments.clear()
+            raise ValueError(f"More than {MAX_OPEN_FRAGMENTS} fragmented messages open")
+        fragments[inner_type] = bytearray()
+    elif inner_type not in fragments:
+        return None # Head of this message went out on a link that dropped
+    message = fragments[inner_type]
+    if len(message) + len(content) - 2 > MAX_FRAME_SIZE:
+        fragments.clear()
+        raise ValueError("Fragmented message exceeds MAX_FRAME_SIZE")
+    message += content[2:]
+    if not flags & FRAGMENT_LAST:
+        return None
+    return inner_type, fragments.pop(inner_type)
+
+class PeerLink:
+    """
+    One long-lived connection to a peer's chat port, shared by chat, clipboard and
+    screen-share messages. Callers only enqueue; a writer thread connects, sends by channel
+    priority, heartbeats while idle and reconnects with backoff. Messages over
+    LINK_FRAGMENT_SIZE go out in pieces so a big clipboard can't hold up chat behind it.
+
+    The receiver answers every read, heartbeats included, with a MSG_TYPE_ACK counting the
+    frames it got. A message counts as sent only once acknowledged; until then it is kept,
+    and sent again on the next connection if this one fails or falls silent for LINK_TIMEOUT.
+    A write only puts the bytes in our own socket buffer, so without this a peer that went
+    to sleep would go unnoticed for minutes while every message to it "succeeded".
+    """
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.closed = False
+        # Items are (priority, seq, frame, on_sent, head, last): `head` is the seq of a
+        # fragmented message's first piece (None for whole messages), `last` marks its end
+        self.queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._sock = None
+        self._ack_lock = threading.Lock()
+        self._unacked = collections.deque() # Items written on this connection, not acknowledged yet
+        self._acked = 0 # Frames acknowledged on this connection
+        self._last_ack = 0
+        self._answered = False # The current connection has acknowledged something
+        self._partial = {} # head -> acknowledged pieces of a message whose last piece isn't yet
+        threading.Thread(target=self._run, daemon=True).start()
+
+    @staticmethod
+    def frame(msg_type, content):
+        return bytes([msg_type]) + struct.pack("!I", len(content)) + content
+
+    def send(self, msg_type, content, on_sent=None):
+        """
+        Queues a message; False if the link has closed or its queue is full.
+        on_sent(True) runs once the peer has acknowledged the whole message,
+        on_sent(False) if the link gives up on it.
+        """
+        priority = CHANNEL_PRIORITY.get(msg_type, 1)
+        with self._lock:
+            if self.closed:
+                return False
+            if self.queue.qsize() >= LINK_QUEUE_LIMIT:
+                print(f"Send queue to {self.ip} is full, dropping message")
+                return False
+            if len(content) <= LINK_FRAGMENT_SIZE:
+                self.queue.put((priority, next(self._seq), self.frame(msg_type, content), on_sent, None, True))
+                return True
+            head = None
+            for pos in range(0, len(content), LINK_FRAGMENT_SIZE):
+                seq = next(self._seq)
+                head = seq if head is None else head
+                last = pos + LINK_FRAGMENT_SIZE >= len(content)
+                flags = (FRAGMENT_FIRST if pos == 0 else 0) | (FRAGMENT_LAST if last else 0)
+                piece = bytes([msg_type, flags]) + content[pos:pos + LINK_FRAGMENT_SIZE]
+                self.queue.put((priority, seq, self.frame(MSG_TYPE_FRAGMENT, piece), on_sent if last else None, head, last))
+            return True
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+        self.queue.put((-1, -1, None, None, None, True))
+
+    def _next_batch(self):
+        """Blocks for the next frame, then takes whatever else is already queued."""
+        try:
+            batch = [self.queue.get(timeout=HEARTBEAT_INTERVAL)]
+        except queue.Empty:
+            return []
+        size = len(batch[0][2] or b"")
+        while size < LINK_BATCH_SIZE and batch[-1][2] is not None:
             try:
-                msg = {
-                    "type": "discovery",
-                    "ip": get_local_ip(),
-                    "nick": self.settings_manager.get("nickname"),
-                    "avatar": self.settings_manager.get("avatar")
-                }
-                sock.sendto(json.dumps(msg).encode('utf-8'), (BROADCAST_IP, DISCOVERY_PORT))
-            except Exception:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+            size += len(batch[-1][2] or b"")
+        return batch
+
+    def _connect(self):
+        sock = socket.create_connection((self.ip, CHAT_PORT), timeout=LINK_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        with self._ack_lock:
+            self._sock = sock
+            self._acked = 0
+            self._last_ack = time.monotonic()
+            self._answered = False
+        threading.Thread(target=self._read_acks, args=(sock,), daemon=True).start()
+
+    def _read_acks(self, sock):
+        """Reader thread of one connection; ends when it is closed or times out."""
+        decoder = FrameDecoder(FRAME_MIN_READ)
+        try:
+            while True:
+                n = sock.recv_into(decoder.get_buffer())
+                if not n:
+                    return
+                decoder.advance(n)
+                for msg_type, content in decoder.frames():
+                    if msg_type == MSG_TYPE_ACK and len(content) == LINK_ACK.size:
+                        self._acknowledged(sock, LINK_ACK.unpack(content)[0])
+        except (OSError, ValueError):
+            pass
+
+    def _acknowledged(self, sock, count):
+        done = []
+        with self._ack_lock:
+            if sock is not self._sock:
+                return # Late answer on a connection we already gave up on
+            self._last_ack = time.monotonic()
+            self._answered = True
+            while self._acked < count and self._unacked:
+                item = self._unacked.popleft()
+                self._acked += 1
+                head, last = item[4], item[5]
+                if head is not None:
+                    if last:
+                        self._partial.pop(head, None)
+                    else:
+                        # Kept until the whole message is in: the receiver drops a message without its head
+                        self._partial.setdefault(head, []).append(item)
+                        continue
+                if item[3]:
+                    done.append(item[3])
+        for on_sent in done:
+            on_sent(True)
+
+    def _unacknowledged(self):
+        """
+        What a new connection has to send again: everything not acknowledged, plus the
+        acknowledged pieces of messages whose last piece wasn't.
+        """
+        with self._ack_lock:
+            items = [item for pieces in self._partial.values() for item in pieces] + list(self._unacked)
+            self._partial.clear()
+            self._unacked.clear()
+        return items
+
+    def _disconnect(self):
+        with self._ack_lock:
+            sock, self._sock = self._sock, None
+        if sock:
+            try:
+                sock.close()
+            except OSError:
                 pass
-            time.sleep(3) # Broadcast every 3 seconds
-        sock.close()
+
+    def _run(self):
+        failures = 0
+        while True:
+            batch = self._next_batch()
+            if any(item[2] is None for item in batch):
+                break
+            if not batch and self._sock is None and failures == 0:
+                continue # Idle and not connected: nothing to keep alive
+            data = b"".join(item[2] for item in batch) or self.frame(MSG_TYPE_HEARTBEAT, b"")
+            with self._ack_lock:
+                self._unacked.extend(batch)
+            try:
+                if self._sock is None:
+                    self._connect()
+                elif time.monotonic() - self._last_ack > LINK_TIMEOUT:
+                    raise OSError("peer stopped acknowledging")
+                self._sock.sendall(data)
+                if self._answered:
+                    failures = 0 # A peer that accepts but never answers still counts as down
+            except OSError as e:
+                self._disconnect()
+                failures += 1
+                batch = self._unacknowledged()
+                if failures > LINK_RETRIES:
+                    print(f"Peer link to {self.ip} is down ({e}), dropping {len(batch) + self.queue.qsize()} queued frames")
+                    break
+                for item in batch:
+                    self.queue.put(item) # (priority, seq) keys keep the original order
+                time.sleep(min(2 ** failures, 30) * 0.5)
+                continue
+
+        with self._lock:
+            self.closed = True
+        self._disconnect()
+        batch += self._unacknowledged() # Closed with messages the peer hasn't confirmed
+        # Nothing more will be sent; tell whoever is waiting on the dropped messages
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        for item in batch:
+            if item[3]:
+                item[3](False)
+
+class Delivery:
+    """
+    Per-peer outcome of one message fanned out over several peer links. Each link
+    reports on its own writer thread, so a slow or dead peer never holds up the others.
+    """
+
+    def __init__(self, peers, on_update=None):
+        self.status = {ip: None for ip in peers} # ip -> None (queued), True (sent) or False (failed)
+        self.on_update = on_update
+        self._pending = len(self.status)
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        if not self._pending:
+            self._done.set()
+
+    def update(self, ip, sent):
+        with self._lock:
+            if self.status.get(ip, False) is not None:
+                return
+            self.status[ip] = sent
+            self._pending -= 1
+            if not self._pending:
+                self._done.set()
+        if self.on_update:
+            self.on_update(self)
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def sent(self):
+        return [ip for ip, status in self.status.items() if status]
+
+    def failed(self):
+        return [ip for ip, status in self.status.items() if status is False]
+
+    def wait(self, timeout=None):
+        """Blocks until every peer has an outcome; False on timeout."""
+        return self._done.wait(timeout)
 
 class ChatService:
-    def __init__(self, on_message_callback, on_clipboard_callback=None, on_screen_callback=None):
+    def __init__(self, on_message_callback, on_clipboard_callback=None, on_screen_callback=None,
+                 on_group_callback=None, on_clipboard_data_callback=None):
         self.on_message = on_message_callback
         self.on_clipboard = on_clipboard_callback
         self.on_screen = on_screen_callback
+        self.on_group = on_group_callback
+        self.on_clipboard_data = on_clipboard_data_callback
         self.running = False
         self.sock = None
+        self._links = {} # ip -> PeerLink
+        self._links_lock = threading.Lock()
 
     def start_server(self):
         self.running = True
@@ -148,58 +1257,412 @@ class ChatService:
                 break
 
     def _handle_client(self, client, addr):
+        # Peer links stay open; heartbeats arrive well within LINK_TIMEOUT while they are alive
+        client.settimeout(LINK_TIMEOUT)
+        fragments = {} # inner type -> message received so far
+        decoder = FrameDecoder()
+        received = 0
         while self.running:
             try:
                 # Protocol: Type (1 byte) + Length (4 bytes) + Content
-                msg_type_bytes = client.recv(1)
-                if not msg_type_bytes: break
-                msg_type = msg_type_bytes[0]
-
-                length_bytes = client.recv(4)
-                if not length_bytes: break
-                length = struct.unpack("!I", length_bytes)[0]
-                
-                content_bytes = client.recv(length)
-                if not content_bytes: break
-                content = content_bytes.decode('utf-8')
-
-                if msg_type == MSG_TYPE_CHAT:
-                    self.on_message(addr[0], content)
-                elif msg_type == MSG_TYPE_CLIPBOARD:
-                    if self.on_clipboard:
-                        self.on_clipboard(addr[0], content)
-                elif msg_type in (MSG_TYPE_SCREEN_REQUEST, MSG_TYPE_SCREEN_ACCEPT, MSG_TYPE_SCREEN_REJECT):
-                    if self.on_screen:
-                        self.on_screen(msg_type, addr[0], content)
+                n = client.recv_into(decoder.get_buffer())
+                if not n: break
+                decoder.advance(n)
+                for msg_type, content in decoder.frames():
+                    if msg_type in (MSG_TYPE_HEARTBEAT, MSG_TYPE_ACK):
+                        continue
+                    received += 1
+                    self.handle_frame(addr[0], msg_type, content, fragments)
+                client.sendall(PeerLink.frame(MSG_TYPE_ACK, LINK_ACK.pack(received)))
             except Exception:
                 break
         client.close()
 
-    def _send_packet(self, target_ip, msg_type, content):
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((target_ip, CHAT_PORT))
-            
-            type_byte = bytes([msg_type])
-            content_bytes = content.encode('utf-8')
-            length_bytes = struct.pack("!I", len(content_bytes))
-            
-            s.sendall(type_byte + length_bytes + content_bytes)
-            s.close()
-        except Exception as e:
-            print(f"Error sending packet: {e}")
+    def handle_frame(self, ip, msg_type, content_bytes, fragments):
+        """Reassembles fragments and dispatches one frame from a peer's connection; ValueError if it is corrupt."""
+        message = reassemble(msg_type, content_bytes, fragments)
+        if message:
+            self.deliver(ip, *message)
+
+    def deliver(self, ip, msg_type, content_bytes):
+        """Dispatches one whole message from a peer."""
+        if msg_type == MSG_TYPE_CLIPBOARD_DATA:
+            if self.on_clipboard_data:
+                self.on_clipboard_data(ip, bytes(content_bytes))
+            return
+        self._dispatch(ip, msg_type, str(content_bytes, 'utf-8'))
+
+    def _dispatch(self, ip, msg_type, content):
+        if msg_type == MSG_TYPE_CHAT:
+            self.on_message(ip, content)
+        elif msg_type == MSG_TYPE_CLIPBOARD:
+            if self.on_clipboard:
+                self.on_clipboard(ip, content)
+        elif msg_type in (MSG_TYPE_SCREEN_REQUEST, MSG_TYPE_SCREEN_ACCEPT, MSG_TYPE_SCREEN_REJECT):
+            if self.on_screen:
+                self.on_screen(msg_type, ip, content)
+        elif msg_type == MSG_TYPE_GROUP:
+            if self.on_group:
+                try:
+                    msg = json.loads(content)
+                    group = {"id": msg["group"], "name": msg.get("name", ""), "members": msg.get("members", [])}
+                    self.on_group(ip, group, msg["text"])
+                except (ValueError, KeyError, TypeError):
+                    print(f"Invalid group message from {ip}")
+
+    def send_packet(self, target_ip, msg_type, content, on_sent=None):
+        """Queues a message (str, or bytes for binary types) on the peer's link without blocking; False if it can't be queued."""
+        data = content if isinstance(content, bytes) else content.encode('utf-8')
+        for _ in range(2):
+            with self._links_lock:
+                link = self._links.get(target_ip)
+                if link is None or link.closed:
+                    link = self._links[target_ip] = PeerLink(target_ip)
+            if link.send(msg_type, data, on_sent):
+                return True
+            if not link.closed:
+                return False
+        return False
+
+    @staticmethod
+    def group_packet(message, group=None):
+        """(msg_type, content) of a message to a group, or a plain chat message without one."""
+        if group is None:
+            return MSG_TYPE_CHAT, message
+        return MSG_TYPE_GROUP, json.dumps({"group": group["id"], "name": group["name"],
+                                           "members": group["members"], "text": message})
+
+    def broadcast(self, target_ips, message, group=None, on_update=None):
+        """
+        Sends one message to many peers at once and returns its Delivery. Every peer has
+        its own link and queue, so this only enqueues: total time is set by the slowest
+        peer, not the sum. With `group` ({"id", "name", "members"}) the peers receive it
+        as a message in that group conversation instead of a direct one.
+        """
+        msg_type, content = self.group_packet(message, group)
+        delivery = Delivery(target_ips, on_update)
+        for ip in delivery.status:
+            if not self.send_packet(ip, msg_type, content, functools.partial(delivery.update, ip)):
+                delivery.update(ip, False)
+        return delivery
 
     def send_message(self, target_ip, message):
-        self._send_packet(target_ip, MSG_TYPE_CHAT, message)
+        return self.send_packet(target_ip, MSG_TYPE_CHAT, message)
 
     def send_clipboard(self, target_ip, content):
-        self._send_packet(target_ip, MSG_TYPE_CLIPBOARD, content)
+        return self.send_packet(target_ip, MSG_TYPE_CLIPBOARD, content)
+
+class DiskWriter:
+    """Receive pipeline for one stream: network thread -> write stage -> hash stage -> buffer pool.
+
+    The network thread fills pooled buffers, the write stage pwrite()s them and the hash stage
+    digests them before returning them to the pool, so verification overlaps both network and
+    disk I/O. The pool size bounds memory and how far the network may run ahead of a slow disk.
+    """
+
+    def __init__(self, path, depth=WRITE_QUEUE_DEPTH, buffer_size=RECV_BUFFER_SIZE):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+        self.pool = queue.Queue()
+        for _ in range(depth):
+            self.pool.put(bytearray(buffer_size))
+        self.jobs = queue.Queue()
+        self.hash_jobs = queue.Queue()
+        self.error = None
+        self._pipe = None
+        self._digest = hashlib.sha256()
+        self._threads = [
+            threading.Thread(target=self._write_stage, daemon=True),
+            threading.Thread(target=self._hash_stage, daemon=True)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def acquire(self):
+        if self.error:
+            raise self.error
+        return self.pool.get()
+
+    def write(self, offset, buf, size):
+        self.jobs.put(("data", offset, buf, size))
+
+    def write_packed(self, offset, codec, payload, size, token):
+        """Queues a compressed chunk; the write stage inflates it. `token` is a pool buffer
+        held until the chunk is hashed, so compressed chunks count against the queue depth too."""
+        self.jobs.put(("packed", offset, (codec, payload), size, token))
+
+    def call(self, fn, *args):
+        """Runs `fn` once every write queued before it has hit the file and been hashed."""
+        self.jobs.put(("call", fn, args))
+
+    def verify(self, index, expected, on_result, readback=None):
+        """
+        Compares `expected` with the digest of everything written since the previous verify,
+        or of the (offset, size) `readback` range re-read from disk, and reports
+        on_result(index, ok, digest) from the hash stage.
+        """
+        self.jobs.put(("verify", index, expected, on_result, readback))
+
+    def _write_stage(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.hash_jobs.put(None)
+                break
+            try:
+                if job[0] == "packed" and self.error is None:
+                    _, offset, (codec, payload), size, token = job
+                    job = ("packed", offset, decompress_chunk(codec, payload, size), size, token)
+                if job[0] in ("data", "packed") and self.error is None:
+                    self._pwrite(job[1], memoryview(job[2])[:job[3]])
+            except Exception as e:
+                self.error = e
+            self.hash_jobs.put(job)
+
+    def _hash_stage(self):
+        while True:
+            job = self.hash_jobs.get()
+            if job is None:
+                break
+            try:
+                if self.error is not None:
+                    pass
+                elif job[0] in ("data", "packed"):
+                    self._digest.update(memoryview(job[2])[:job[3]])
+                elif job[0] == "call":
+                    job[1](*job[2])
+                elif job[0] == "verify":
+                    _, index, expected, on_result, readback = job
+                    digest = hash_range(self.path, *readback) if readback else self._digest.digest()
+                    self._digest = hashlib.sha256()
+                    on_result(index, digest == expected, digest)
+            except Exception as e:
+                self.error = e
+            finally:
+                if job[0] == "data":
+                    self.pool.put(job[2])
+                elif job[0] == "packed":
+                    self.pool.put(job[4])
+
+    def _pwrite(self, offset, view):
+        while view:
+            if hasattr(os, "pwrite"):
+                n = os.pwrite(self.fd, view, offset)
+            else:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                n = os.write(self.fd, view)
+            view = view[n:]
+            offset += n
+
+    def splice(self, sock, offset, size):
+        """Moves `size` bytes socket -> pipe -> file inside the kernel (Linux only)."""
+        if self._pipe is None:
+            self._pipe = os.pipe()
+        read_end, write_end = self._pipe
+        end = offset + size
+        while offset < end:
+            n = os.splice(sock.fileno(), write_end, min(RECV_BUFFER_SIZE, end - offset))
+            if not n:
+                raise ConnectionError(f"Stream ended at offset {offset}")
+            while n:
+                written = os.splice(read_end, self.fd, n, offset_dst=offset)
+                offset += written
+                n -= written
+        return size
+
+    def close(self):
+        if self._threads[0].is_alive():
+            self.jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self._pipe:
+            for fd in self._pipe:
+                os.close(fd)
+            self._pipe = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.error:
+            raise self.error
+
+class ChunkHasher:
+    """Sender-side hash stage: digests chunks on worker threads, a few ahead of the data streams.
+
+    Chunks listed in `first` are hashed in that order, the order the streams need them, and
+    their pages stay cached for the sendfile() that follows. The remaining chunks are only
+    needed for the Merkle root sent with the commit, so they are dropped from the cache once
+    hashed. At most `lookahead` chunks per worker are hashed before anyone asks for them.
+    """
+
+    def __init__(self, path, filesize, first=(), chunk_size=CHUNK_SIZE, workers=PARALLEL_STREAMS,
+                 lookahead=HASH_LOOKAHEAD):
+        self.path = path
+        self.filesize = filesize
+        self.chunk_size = chunk_size
+        self.chunk_count = -(-filesize // chunk_size)
+        self._sent = set(first)
+        self._order = iter(dict.fromkeys([*first, *range(self.chunk_count)]))
+        self._window = workers * lookahead
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._futures = {}
+        self._ahead = set() # Submitted, but not asked for yet
+        self._lock = threading.Lock()
+        with self._lock:
+            self._fill()
+
+    def _fill(self):
+        while len(self._ahead) < self._window:
+            index = next(self._order, None)
+            if index is None:
+                self._pool.shutdown(wait=False) # Every chunk has been submitted
+                return
+            if index not in self._futures:
+                self._submit(index)
+                self._ahead.add(index)
+
+    def _submit(self, index):
+        future = self._futures[index] = self._pool.submit(self._hash_chunk, index)
+        return future
+
+    def _hash_chunk(self, index):
+        offset = index * self.chunk_size
+        return hash_range(self.path, offset, min(self.chunk_size, self.filesize - offset),
+                          drop=index not in self._sent)
+
+    def digest(self, index):
+        with self._lock:
+            future = self._futures.get(index) or self._submit(index)
+            self._ahead.discard(index)
+            self._fill()
+        return future.result()
+
+    def root(self):
+        return merkle_root(self.digest(i) for i in range(self.chunk_count))
+
+    def cancel(self):
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+            self._pool.shutdown(wait=False)
+
+class IncomingTransfer:
+    """Receiver-side state of a resumable transfer: a .part file plus a chunk manifest."""
+
+    def __init__(self, save_dir, metadata):
+        self.file_id = metadata['file_id']
+        self.filename = os.path.basename(metadata['filename'])
+        self.filesize = metadata['filesize']
+        self.chunk_size = metadata.get('chunk_size', CHUNK_SIZE)
+        self.is_zip = metadata.get('is_zip', False)
+        self.save_dir = save_dir
+        self.path = os.path.join(save_dir, self.filename)
+        self.part_path = self.path + ".part"
+        self.manifest_path = self.part_path + ".json"
+        self.cond = threading.Condition()
+        self.active = 0 # Data streams currently writing
+        self.ended = collections.Counter() # Sender session -> its data streams that have finished
+        self.refs = 0 # Connections referencing this transfer
+        self.digests = {} # chunk index -> hex SHA-256 of verified chunks
+        self._last_save = 0
+        self._load()
+        self.received = sum(self.chunk_length(i) for i in self.digests)
+
+    @property
+    def chunk_count(self):
+        return -(-self.filesize // self.chunk_size)
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.filesize - index * self.chunk_size)
+
+    def _load(self):
+        try:
+            with open(self.manifest_path, "r") as f:
+                manifest = json.load(f)
+            if (manifest.get('file_id') == self.file_id and manifest.get('filesize') == self.filesize
+                    and manifest.get('chunk_size') == self.chunk_size and os.path.exists(self.part_path)):
+                self.digests = {int(i): digest for i, digest in manifest.get('digests', {}).items()}
+                return
+        except (OSError, ValueError):
+            pass
+        with open(self.part_path, "wb") as f:
+            f.truncate(self.filesize)
+            preallocate(f.fileno(), self.filesize)
+        self.save()
+
+    def save(self):
+        with self.cond:
+            manifest = {
+                "file_id": self.file_id,
+                "filesize": self.filesize,
+                "chunk_size": self.chunk_size,
+                "digests": {str(i): digest for i, digest in self.digests.items()}
+            }
+            tmp_path = self.manifest_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, self.manifest_path)
+            self._last_save = time.time()
+
+    def chunk_verified(self, index, ok, digest):
+        """Hash stage callback: only chunks matching the sender's digest count as done."""
+        if not ok:
+            print(f"Chunk {index} of {self.filename} failed verification, will re-request it")
+            return
+        with self.cond:
+            self.digests[index] = digest.hex()
+            if time.time() - self._last_save >= MANIFEST_INTERVAL:
+                self.save()
+
+    def merkle_root(self):
+        return merkle_root([bytes.fromhex(self.digests[i]) for i in range(self.chunk_count)])
+
+    def reset(self):
+        with self.cond:
+            self.digests.clear()
+            self.received = 0
+        self.save()
+
+    def missing_ranges(self):
+        """Byte ranges of chunks not yet verified on disk, coalesced."""
+        missing = [i for i in range(self.chunk_count) if i not in self.digests]
+        return [[first * self.chunk_size, sum(self.chunk_length(i) for i in range(first, first + count))]
+                for first, count in chunk_runs(missing)]
+
+    def begin_stream(self):
+        with self.cond:
+            self.active += 1
+
+    def end_stream(self, session=None):
+        with self.cond:
+            self.active -= 1
+            self.ended[session] += 1
+            self.cond.notify_all()
+
+    def wait_streams(self, session, count, timeout=30):
+        """
+        Waits for the `count` data streams a sender session opened so far to finish. A
+        stream may still be on its way to _join_transfer when the commit arrives, so
+        waiting for the ones already running isn't enough; that is all older senders get.
+        """
+        with self.cond:
+            if session is None or count is None:
+                self.cond.wait_for(lambda: self.active == 0, timeout)
+            else:
+                self.cond.wait_for(lambda: self.ended[session] >= count, timeout)
+
+    def finalize(self):
+        os.replace(self.part_path, self.path)
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
 
 class FileTransferService:
     def __init__(self, settings_manager, on_progress_callback=None):
         self.settings_manager = settings_manager
         self.on_progress = on_progress_callback
         self.running = False
+        self._transfers = {} # file_id -> IncomingTransfer
+        self._lock = threading.Lock()
+        self._compress_pool = None
 
     def start_server(self):
         self.running = True
@@ -218,82 +1681,639 @@ class FileTransferService:
 
     def _receive_file(self, client):
         try:
-            len_bytes = client.recv(4)
-            meta_len = struct.unpack("!I", len_bytes)[0]
-            meta_json = client.recv(meta_len).decode('utf-8')
-            metadata = json.loads(meta_json)
-            
-            filename = metadata['filename']
-            filesize = metadata['filesize']
-            is_zip = metadata.get('is_zip', False)
-
-            save_dir = self.settings_manager.get("download_dir")
-            if not os.path.exists(save_dir):
-                os.makedirs(save_dir)
-
-            save_path = os.path.join(save_dir, filename)
-            
-            received = 0
-            with open(save_path, "wb") as f:
-                while received < filesize:
-                    chunk = client.recv(min(BUFFER_SIZE, filesize - received))
-                    if not chunk: break
-                    f.write(chunk)
-                    received += len(chunk)
-                    if self.on_progress:
-                        self.on_progress(filename, received, filesize)
-
-            if is_zip:
-                extract_path = os.path.join(save_dir, os.path.splitext(filename)[0])
-                shutil.unpack_archive(save_path, extract_path)
-                os.remove(save_path)
+            metadata = recv_json(client)
+        except Exception as e:
+            print(f"Error receiving file: {e}")
+            client.close()
+            return
+        self.serve(client, metadata)
+
+    def serve(self, client, metadata):
+        """Runs one incoming connection whose JSON header has been read; closes it when done."""
+        try:
+            action = metadata.get('action')
+
+            if action == 'offer':
+                self._handle_offer(client, metadata)
+            elif action == 'data':
+                self._receive_data(client, metadata)
+            elif action == 'delta':
+                self._receive_delta(client, metadata)
+            elif action == 'tree':
+                self._receive_tree(client, metadata)
+            else:
+                self._receive_legacy(client, metadata)
 
         except Exception as e:
             print(f"Error receiving file: {e}")
         finally:
             client.close()
 
-    def send_file(self, target_ip, filepath):
-        if not os.path.exists(filepath): return
+    def _save_dir(self):
+        save_dir = self.settings_manager.get("download_dir")
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        return save_dir
+
+    def _receive_legacy(self, client, metadata):
+        """Single-connection protocol: the whole file follows the metadata header."""
+        filename = metadata['filename']
+        filesize = metadata['filesize']
+        is_zip = metadata.get('is_zip', False)
+
+        save_dir = self._save_dir()
+        save_path = os.path.join(save_dir, filename)
+
+        received = 0
+        with open(save_path, "wb") as f:
+            while received < filesize:
+                chunk = client.recv(min(BUFFER_SIZE, filesize - received))
+                if not chunk: break
+                f.write(chunk)
+                received += len(chunk)
+                if self.on_progress:
+                    self.on_progress(filename, received, filesize)
+
+        if is_zip:
+            self._unpack(save_dir, save_path, filename)
+
+    def _unpack(self, save_dir, save_path, filename):
+        extract_path = os.path.join(save_dir, os.path.splitext(filename)[0])
+        shutil.unpack_archive(save_path, extract_path)
+        os.remove(save_path)
+
+    def _acquire_transfer(self, metadata):
+        with self._lock:
+            transfer = self._transfers.get(metadata['file_id'])
+            if transfer is None:
+                transfer = IncomingTransfer(self._save_dir(), metadata)
+                self._transfers[transfer.file_id] = transfer
+            transfer.refs += 1
+            return transfer
 
-        is_folder = os.path.isdir(filepath)
-        final_path = filepath
-        
-        if is_folder:
-            shutil.make_archive(filepath, 'zip', filepath)
-            final_path = filepath + ".zip"
+    def _release_transfer(self, transfer):
+        with self._lock:
+            transfer.refs -= 1
+            if transfer.refs == 0:
+                self._transfers.pop(transfer.file_id, None)
 
-        filesize = os.path.getsize(final_path)
-        filename = os.path.basename(final_path)
+    def _handle_offer(self, client, metadata):
+        """Control connection: reports missing ranges, then verifies each commit round."""
+        transfer = self._acquire_transfer(metadata)
+        try:
+            missing = transfer.missing_ranges()
+            codecs = [name for name in metadata.get('codecs', []) if name in SUPPORTED_CODECS]
+            basis_size = os.path.getsize(transfer.path) if os.path.isfile(transfer.path) else 0
+            if metadata.get('delta') and basis_size and not transfer.digests:
+                # We hold an older copy: let the sender diff against its block signatures
+                block_size = block_size_for(basis_size)
+                signatures = compute_signatures(transfer.path, block_size)
+                send_json(client, {
+                    "missing": missing,
+                    "codecs": codecs,
+                    "delta": {"block_size": block_size, "blocks": len(signatures) // SIGNATURE.size}
+                })
+                client.sendall(signatures)
+            else:
+                send_json(client, {"missing": missing, "codecs": codecs})
+            while True:
+                request = recv_json(client)
+                if request.get('action') != 'commit':
+                    continue
+                transfer.wait_streams(request.get('session'), request.get('streams'))
+                transfer.save()
+                missing = transfer.missing_ranges()
+                if not missing and request.get('merkle_root', transfer.merkle_root()) != transfer.merkle_root():
+                    print(f"Merkle root mismatch for {transfer.filename}, restarting transfer")
+                    transfer.reset()
+                    missing = transfer.missing_ranges()
+                if missing:
+                    send_json(client, {"missing": missing})
+                    continue
+                transfer.finalize()
+                if transfer.is_zip:
+                    self._unpack(transfer.save_dir, transfer.path, transfer.filename)
+                send_json(client, {"status": "complete"})
+                break
+        finally:
+            if os.path.exists(transfer.part_path):
+                transfer.save()
+            self._release_transfer(transfer)
+
+    def _join_transfer(self, file_id):
+        """Attaches a data connection to a transfer opened by its control connection."""
+        with self._lock:
+            transfer = self._transfers.get(file_id)
+            if transfer is None:
+                raise ValueError(f"Unknown transfer {file_id}")
+            transfer.refs += 1
+        transfer.begin_stream()
+        return transfer
+
+    def _receive_data(self, client, metadata):
+        """Data connection: receives chunk-aligned ranges into the .part file."""
+        transfer = self._join_transfer(metadata['file_id'])
+        writer = DiskWriter(transfer.part_path)
+        splice = USE_SPLICE and hasattr(os, "splice")
+        try:
+            for offset, length in metadata['ranges']:
+                if offset % transfer.chunk_size:
+                    raise ValueError(f"Range at {offset} is not chunk aligned")
+                pos = offset
+                end = offset + length
+                while pos < end:
+                    index = pos // transfer.chunk_size
+                    chunk_start = pos
+                    chunk_end = min(chunk_start + transfer.chunk_size, end)
+                    codec, wire_size = CHUNK_FRAME.unpack(recv_exact(client, CHUNK_FRAME.size))
+                    if codec != CODEC_RAW:
+                        token = writer.acquire()
+                        writer.write_packed(pos, codec, recv_exact(client, wire_size), chunk_end - pos, token)
+                        self._report_received(transfer, chunk_end - pos)
+                        pos = chunk_end
+                    elif wire_size != chunk_end - pos:
+                        raise ValueError(f"Raw chunk at {pos} has {wire_size} bytes, expected {chunk_end - pos}")
+                    while pos < chunk_end:
+                        if splice:
+                            n = writer.splice(client, pos, chunk_end - pos)
+                        else:
+                            buf = writer.acquire()
+                            n = recv_fill(client, memoryview(buf), min(len(buf), chunk_end - pos))
+                            writer.write(pos, buf, n)
+                        pos += n
+                        self._report_received(transfer, n)
+                    expected = recv_exact(client, DIGEST_SIZE)
+                    readback = (chunk_start, chunk_end - chunk_start) if splice and codec == CODEC_RAW else None
+                    writer.verify(index, expected, transfer.chunk_verified, readback)
+            writer.close()
+        finally:
+            try:
+                writer.close()
+            finally:
+                transfer.end_stream(metadata.get('session'))
+                transfer.save()
+                self._release_transfer(transfer)
 
+    def _receive_delta(self, client, metadata):
+        """Delta connection: rebuilds the file from basis blocks plus literal data."""
+        transfer = self._join_transfer(metadata['file_id'])
+        block_size = metadata['block_size']
+        writer = DiskWriter(transfer.part_path)
+        pos = 0
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((target_ip, FILE_PORT))
+            with open(transfer.path, "rb") as basis:
+                while True:
+                    kind, value = OP.unpack(recv_exact(client, OP.size))
+                    if kind == OP_END:
+                        break
+                    if kind == OP_COPY:
+                        buf = writer.acquire()
+                        basis.seek(value * block_size)
+                        n = basis.readinto(memoryview(buf)[:block_size])
+                        writer.write(pos, buf, n)
+                        pos += n
+                        self._report_received(transfer, n)
+                    elif kind == OP_LITERAL:
+                        remaining = value
+                        while remaining:
+                            buf = writer.acquire()
+                            n = recv_fill(client, memoryview(buf), min(len(buf), remaining))
+                            writer.write(pos, buf, n)
+                            pos += n
+                            remaining -= n
+                            self._report_received(transfer, n)
+                    else:
+                        raise ValueError(f"Unknown delta op {kind}")
+            if pos != transfer.filesize:
+                raise ValueError(f"Delta rebuilt {pos} of {transfer.filesize} bytes")
+            digests = recv_exact(client, transfer.chunk_count * DIGEST_SIZE)
+            for index in range(transfer.chunk_count):
+                expected = digests[index * DIGEST_SIZE:(index + 1) * DIGEST_SIZE]
+                readback = (index * transfer.chunk_size, transfer.chunk_length(index))
+                writer.verify(index, expected, transfer.chunk_verified, readback)
+            writer.close()
+        finally:
+            try:
+                writer.close()
+            finally:
+                transfer.end_stream(metadata.get('session'))
+                self._release_transfer(transfer)
+
+    def _receive_tree(self, client, metadata):
+        """
+        Folder or batch stream: files are written as their entries arrive, with no archive
+        and no per-file handshake. A batch has an empty root and lands in the download dir.
+        """
+        root = os.path.basename(metadata.get('root', ''))
+        label = metadata.get('label', root)
+        total = metadata.get('total_size', 0)
+        chunk_size = metadata.get('chunk_size', CHUNK_SIZE)
+        base = safe_join(self._save_dir(), root) if root else self._save_dir()
+        os.makedirs(base, exist_ok=True)
+        progress = throttled(self.on_progress) if self.on_progress else None
+        stream = BufferedSocket(client)
+
+        buf = bytearray(RECV_BUFFER_SIZE)
+        view = memoryview(buf)
+        received = 0
+        corrupt = []
+        made_dir = base
+        while True:
+            kind, name_len, size = TREE_ENTRY.unpack(recv_exact(stream, TREE_ENTRY.size))
+            if kind == TREE_END:
+                break
+            path = safe_join(base, recv_exact(stream, name_len).decode('utf-8'))
+            if kind == TREE_DIR:
+                os.makedirs(path, exist_ok=True)
+                made_dir = path
+                continue
+            if os.path.dirname(path) != made_dir:
+                made_dir = os.path.dirname(path)
+                os.makedirs(made_dir, exist_ok=True)
+            digest = hashlib.sha256()
+            with open(path, "wb") as f:
+                remaining = size
+                while remaining:
+                    codec, wire_size = CHUNK_FRAME.unpack(recv_exact(stream, CHUNK_FRAME.size))
+                    if codec == CODEC_RAW:
+                        if wire_size > remaining:
+                            raise ValueError(f"Raw frame of {wire_size} bytes overruns {path}")
+                        frame_left = wire_size
+                        while frame_left:
+                            n = recv_fill(stream, view, min(len(buf), frame_left))
+                            f.write(view[:n])
+                            digest.update(view[:n])
+                            frame_left -= n
+                        n = wire_size
+                    else:
+                        n = min(chunk_size, remaining)
+                        data = decompress_chunk(codec, recv_exact(stream, wire_size), n)
+                        f.write(data)
+                        digest.update(data)
+                    remaining -= n
+                    received += n
+                    if progress and total:
+                        progress(label, received, total)
+            if recv_exact(stream, DIGEST_SIZE) != digest.digest():
+                print(f"{path} failed verification, will re-request it")
+                os.remove(path)
+                corrupt.append(os.path.relpath(path, base).replace(os.sep, "/"))
+
+        send_json(client, {"status": "complete", "corrupt": corrupt})
+
+    def _report_received(self, transfer, n):
+        with transfer.cond:
+            transfer.received += n
+            received = transfer.received
+        if self.on_progress:
+            self.on_progress(transfer.filename, min(received, transfer.filesize), transfer.filesize)
+
+    def send_file(self, target_ip, filepath, streams=None):
+        if not os.path.exists(filepath): return False
+        if os.path.isdir(filepath):
+            return self._with_retries(filepath, self._send_tree, target_ip, [filepath])
+        return self._with_retries(filepath, self._send_transfer, target_ip, filepath, streams)
+
+    def send_files(self, target_ip, paths):
+        """
+        Sends several files and folders at once. Files of DELTA_MIN_SIZE and up keep their own
+        resumable transfer; everything else shares one batch stream over a single connection.
+        """
+        paths = [path for path in paths if os.path.exists(path)]
+        large = [path for path in paths if os.path.isfile(path) and os.path.getsize(path) >= DELTA_MIN_SIZE]
+        batch = [path for path in paths if path not in large]
+        ok = bool(paths)
+        if batch:
+            ok = self._with_retries(batch[0], self._send_tree, target_ip, batch) and ok
+        for path in large:
+            ok = self.send_file(target_ip, path) and ok
+        return ok
+
+    def _with_retries(self, filepath, send, *args):
+        for attempt in range(TRANSFER_RETRIES):
+            try:
+                send(*args)
+                return True
+            except OSError as e:
+                # ConnectionError included: the next offer picks up from the manifest
+                print(f"Transfer interrupted ({e}), retry {attempt + 1}/{TRANSFER_RETRIES}")
+                time.sleep(attempt + 1)
+            except Exception as e:
+                print(f"Error sending file: {e}")
+                return False
+        print(f"Error sending file: giving up on {filepath}")
+        return False
+
+    def _send_tree(self, target_ip, paths):
+        """Streams folders and small files entry by entry, resending any the receiver failed to verify."""
+        entries = list(walk_batch(paths))
+        names = [os.path.basename(os.path.normpath(path)) for path in paths]
+        label = names[0] if len(names) == 1 else f"{names[0]} +{len(names) - 1}"
+        for _ in range(TRANSFER_RETRIES):
+            corrupt = set(self._stream_tree(target_ip, label, entries))
+            if not corrupt:
+                return
+            entries = [entry for entry in entries if entry[1] in corrupt]
+        raise ValueError(f"{len(entries)} files of {label} failed verification")
+
+    def _stream_tree(self, target_ip, label, entries):
+        """One batch stream, so the receiver materializes files while we read; returns corrupt paths."""
+        total = sum(size for _, _, _, size in entries)
+        progress = throttled(self.on_progress) if self.on_progress else None
+        sent = 0
+
+        def report(n):
+            nonlocal sent
+            sent += n
+            if progress and total:
+                progress(label, sent, total)
+
+        # Larger files are hashed a chunk at a time as _send_frames queues it, so the read
+        # that hashes it also warms the page cache for the sendfile() right behind it.
+        # One thread keeps each file's chunks in order.
+        hasher = ThreadPoolExecutor(max_workers=1)
+        hashing = collections.deque()
+        meter = LinkMeter()
 
-            metadata = {
+        def pieces():
+            for kind, rel, path, size in entries:
+                name = rel.encode('utf-8')
+                header = TREE_ENTRY.pack(kind, len(name), size) + name
+                if kind != TREE_FILE:
+                    yield None, 0, 0, header, None
+                elif size <= BATCH_INLINE_SIZE:
+                    # Small files are read, hashed and framed right here, with no per-file round trip
+                    with open(path, "rb") as f:
+                        data = f.read(size + 1)
+                    if len(data) != size:
+                        raise ConnectionError(f"{path} changed size while sending")
+                    frame = pack_frame(data, codecs, meter.rate) if size else b""
+                    yield None, 0, size, header + frame + hashlib.sha256(data).digest(), None
+                else:
+                    digest = hashlib.sha256()
+                    for offset in range(0, size, CHUNK_SIZE):
+                        length = min(CHUNK_SIZE, size - offset)
+                        hashed = hasher.submit(hash_range, path, offset, length, False, digest)
+                        hashing.append(hashed)
+                        while hashing and hashing[0].done():
+                            hashing.popleft()
+                        last = offset + length >= size
+                        yield path, offset, length, b"" if offset else header, hashed.result if last else None
+
+        names = SUPPORTED_CODECS if COMPRESSION else []
+        codecs = [CODEC_NAMES[name] for name in names]
+        s = socket.create_connection((target_ip, FILE_PORT))
+        try:
+            send_json(s, {"action": "tree", "root": "", "label": label, "total_size": total,
+                          "entries": len(entries), "chunk_size": CHUNK_SIZE, "codecs": names})
+            self._send_frames(s, pieces(), codecs, COMPRESS_WORKERS, report, meter)
+            s.sendall(TREE_ENTRY.pack(TREE_END, 0, 0))
+            reply = recv_json(s)
+            if reply.get('status') != 'complete':
+                raise ConnectionError(f"Receiver did not confirm {label}")
+            return reply.get('corrupt', [])
+        finally:
+            for future in hashing:
+                future.cancel()
+            hasher.shutdown(wait=False)
+            s.close()
+
+    def _send_transfer(self, target_ip, path, streams):
+        stat = os.stat(path)
+        filesize = stat.st_size
+        filename = os.path.basename(path)
+        file_id = hashlib.sha1(f"{filename}:{filesize}:{stat.st_mtime_ns}".encode('utf-8')).hexdigest()
+
+        hasher = None
+        control = socket.create_connection((target_ip, FILE_PORT))
+        try:
+            send_json(control, {
+                "action": "offer",
+                "file_id": file_id,
                 "filename": filename,
                 "filesize": filesize,
-                "is_zip": is_folder
-            }
-            meta_json = json.dumps(metadata).encode('utf-8')
-            meta_len = struct.pack("!I", len(meta_json))
+                "chunk_size": CHUNK_SIZE,
+                "delta": filesize >= DELTA_MIN_SIZE,
+                "codecs": SUPPORTED_CODECS if COMPRESSION else []
+            })
+            reply = recv_json(control)
+            codecs = [CODEC_NAMES[name] for name in reply.get('codecs', []) if name in CODEC_NAMES]
+            delta = reply.get('delta')
+            signatures = recv_exact(control, delta['blocks'] * SIGNATURE.size) if delta else None
+            first = [] if delta else self._stream_order(reply['missing'], streams)
+            hasher = ChunkHasher(path, filesize, first)
+            # Each commit says how many data streams this session has opened, so the
+            # receiver waits for all of them, even one it hasn't accepted yet
+            session = os.urandom(8).hex()
+            opened = 0
 
-            s.sendall(meta_len + meta_json)
+            progress = {"sent": filesize - sum(length for _, length in reply['missing'])}
+            progress_lock = threading.Lock()
 
-            with open(final_path, "rb") as f:
-                sent = 0
-                while True:
-                    chunk = f.read(BUFFER_SIZE)
-                    if not chunk: break
-                    s.sendall(chunk)
-                    sent += len(chunk)
-                    if self.on_progress:
-                        self.on_progress(filename, sent, filesize)
+            def report(n):
+                with progress_lock:
+                    progress['sent'] += n
+                    sent = min(progress['sent'], filesize)
+                if self.on_progress:
+                    self.on_progress(filename, sent, filesize)
+
+            if delta:
+                self._send_delta(target_ip, path, file_id, session, delta['block_size'], signatures, hasher, report)
+                opened += 1
+                send_json(control, {"action": "commit", "merkle_root": hasher.root(), "session": session, "streams": opened})
+                reply = recv_json(control)
+
+            for _ in range(TRANSFER_RETRIES):
+                if reply.get('status') == 'complete':
+                    break
+                groups = self._stream_groups(reply.get('missing', []), streams)
+                if groups:
+                    with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+                        futures = [
+                            pool.submit(self._send_ranges, target_ip, path,
+                                        {"action": "data", "file_id": file_id, "session": session, "ranges": group},
+                                        hasher, report, codecs, len(groups))
+                            for group in groups
+                        ]
+                        for future in futures:
+                            future.result()
+                    opened += len(groups)
+                send_json(control, {"action": "commit", "merkle_root": hasher.root(), "session": session, "streams": opened})
+                reply = recv_json(control)
+
+            if reply.get('status') != 'complete':
+                raise ConnectionError(f"Receiver still missing {len(reply.get('missing', []))} ranges")
+        finally:
+            if hasher:
+                hasher.cancel()
+            control.close()
+
+    def _stream_groups(self, missing, streams):
+        remaining = sum(length for _, length in missing)
+        parts = streams or (PARALLEL_STREAMS if remaining >= PARALLEL_MIN_SIZE else 1)
+        return split_ranges(missing, parts)
+
+    def _stream_order(self, missing, streams):
+        """Chunk indices interleaved across streams, the order in which they will be needed."""
+        queues = []
+        for group in self._stream_groups(missing, streams):
+            queues.append([i for offset, length in group
+                           for i in range(offset // CHUNK_SIZE, -(-(offset + length) // CHUNK_SIZE))])
+        order = []
+        for row in range(max((len(q) for q in queues), default=0)):
+            order.extend(q[row] for q in queues if row < len(q))
+        return order
+
+    def _send_delta(self, target_ip, path, file_id, session, block_size, signatures, hasher, report):
+        """Sends `path` as copy/literal ops against the receiver's block signatures."""
+        table = parse_signatures(signatures)
+        wire = len(signatures)
+        s = socket.create_connection((target_ip, FILE_PORT))
+        try:
+            send_json(s, {"action": "delta", "file_id": file_id, "session": session, "block_size": block_size})
+            out = bytearray()
+            for kind, arg, length in iter_delta(path, table, block_size):
+                if kind == OP_COPY:
+                    out += OP.pack(OP_COPY, arg)
+                else:
+                    out += OP.pack(OP_LITERAL, length)
+                    out += arg
+                    wire += length
+                wire += OP.size
+                if len(out) >= RECV_BUFFER_SIZE:
+                    s.sendall(out)
+                    out.clear()
+                report(length)
+            out += OP.pack(OP_END, 0)
+            s.sendall(out)
+            s.sendall(b"".join(hasher.digest(i) for i in range(hasher.chunk_count)))
+        finally:
+            s.close()
+        print(f"Delta sync {os.path.basename(path)}: {wire} bytes on the wire for {os.path.getsize(path)}")
+
+    def _send_ranges(self, target_ip, path, metadata, hasher, report, codecs=(), streams=1):
+        """Sends the chunks in `metadata` over their own connection, each followed by its digest."""
+        def pieces():
+            for offset, length in metadata['ranges']:
+                end = offset + length
+                while offset < end:
+                    size = min(CHUNK_SIZE, end - offset)
+                    yield path, offset, size, b"", functools.partial(hasher.digest, offset // CHUNK_SIZE)
+                    offset += size
 
+        s = socket.create_connection((target_ip, FILE_PORT))
+        try:
+            send_json(s, metadata)
+            self._send_frames(s, pieces(), codecs, max(1, COMPRESS_WORKERS // streams), report)
+        finally:
             s.close()
-            
-            if is_folder:
-                os.remove(final_path)
 
-        except Exception as e:
-            print(f"Error sending file: {e}")
+    def _compressor(self):
+        with self._lock:
+            if self._compress_pool is None:
+                self._compress_pool = ThreadPoolExecutor(max_workers=COMPRESS_WORKERS)
+            return self._compress_pool
+
+    def _send_frames(self, s, pieces, codecs, workers, report, meter=None):
+        """
+        Sends (path, offset, size, prefix, suffix) pieces: `prefix` bytes, then the file range
+        as one codec frame, then suffix() if given. With path None only prefix and suffix are
+        sent and `size` bytes reported, for entries framed up front (small files, folders).
+
+        The codec for each piece is chosen and applied on the shared compression pool, up to
+        COMPRESS_LOOKAHEAD chunks' worth of data ahead of the socket. Raw ranges keep the
+        sendfile path; everything else is coalesced into writes of about BATCH_FLUSH_SIZE.
+        """
+        meter = meter or LinkMeter()
+        pieces = iter(pieces)
+        pending = collections.deque()
+        ahead = [0] # bytes queued in `pending`
+        out = bytearray()
+        f = None
+
+        def fill():
+            while ahead[0] < COMPRESS_LOOKAHEAD * CHUNK_SIZE and len(pending) < BATCH_LOOKAHEAD:
+                piece = next(pieces, None)
+                if piece is None:
+                    return
+                path, offset, size = piece[:3]
+                packed = None
+                if path and codecs and size >= COMPRESS_MIN_SIZE:
+                    packed = self._compressor().submit(pack_chunk, path, offset, size, codecs, meter.rate, workers)
+                pending.append((piece, packed))
+                ahead[0] += size
+
+        def flush():
+            if out:
+                s.sendall(out)
+                out.clear()
+
+        try:
+            fill()
+            while pending:
+                (path, offset, size, prefix, suffix), packed = pending.popleft()
+                ahead[0] -= size
+                fill()
+                out += prefix
+                if path:
+                    codec, payload = packed.result() if packed else (CODEC_RAW, None)
+                    if codec == CODEC_RAW:
+                        if f is None or f.name != path:
+                            if f:
+                                f.close()
+                            f = open(path, "rb")
+                            fadvise(f.fileno(), 0, 0, "POSIX_FADV_SEQUENTIAL")
+                        out += CHUNK_FRAME.pack(CODEC_RAW, size)
+                        flush()
+                        start = time.perf_counter()
+                        if USE_SENDFILE:
+                            self._sendfile_range(s, f, offset, size, report)
+                        else:
+                            self._copy_range(s, f, offset, size, report)
+                        meter.update(size, time.perf_counter() - start)
+                    else:
+                        out += CHUNK_FRAME.pack(codec, len(payload))
+                        if len(payload) <= BATCH_INLINE_SIZE:
+                            out += payload
+                        else:
+                            flush()
+                            start = time.perf_counter()
+                            s.sendall(payload)
+                            meter.update(len(payload), time.perf_counter() - start)
+                        report(size)
+                elif size:
+                    report(size)
+                if suffix:
+                    out += suffix()
+                if len(out) >= BATCH_FLUSH_SIZE:
+                    flush()
+            flush()
+        finally:
+            if f:
+                f.close()
+            for _, packed in pending:
+                if packed:
+                    packed.cancel()
+
+    def _sendfile_range(self, s, f, offset, length, report):
+        """Zero-copy send; pages already sent are dropped so large files don't flush the page cache."""
+        pos = offset
+        end = offset + length
+        while pos < end:
+            sent = s.sendfile(f, pos, min(SENDFILE_SLICE, end - pos))
+            if not sent:
+                raise ConnectionError(f"{f.name} shrank while sending")
+            fadvise(f.fileno(), pos, sent, "POSIX_FADV_DONTNEED")
+            pos += sent
+            report(sent)
+
+    def _copy_range(self, s, f, offset, length, report):
+        f.seek(offset)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(BUFFER_SIZE, remaining))
+            if not chunk:
+                raise ConnectionError(f"{f.name} shrank while sending")
+            s.sendall(chunk)
+            remaining -= len(chunk)
+            report(len(chunk))
@@ -89,13 +89,14 @@ def check_dependencies():
 
 check_dependencies()
 
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import mss
 from PIL import Image
-import io
 import pyautogui
 
+from screen_frames import FRAME_EVENT, FrameDiffer, capture_time, encode_regions, pack_screen_frame
+
 # Configurar pyautogui para Mac
 pyautogui.FAILSAFE = False
 pyautogui.PAUSE = 0
@@ -116,10 +117,13 @@ server_state = {
     'clients_connected': 0,
     'frame_count': 0,
     'start_time': None,
+    'legacy_clients': set(),  # sid de clientes que solo entienden frames base64 en JSON
 }
 
 # Instancia de captura
 sct = mss.mss()
+# Qué partes de cada captura cambiaron desde la anterior
+differ = FrameDiffer()
 
 
 def get_local_ip():
@@ -137,12 +141,14 @@ def get_local_ip():
 def capture_and_encode_frame():
     """
     Captura pantalla usando mss y Pillow (sin OpenCV)
-    Retorna frame encoded en base64
+    Retorna (imagen, momento de la captura, es key frame, regiones en JPEG)
+    Solo se codifican las regiones que cambiaron desde la captura anterior
     """
     try:
         # Capturar pantalla principal
         monitor = sct.monitors[1]  # Monitor primario
         screenshot = sct.grab(monitor)
+        captured = capture_time()
         
         # Convertir a PIL Image
         img = Image.frombytes('RGB', screenshot.size, screenshot.bgra, 'raw', 'BGRX')
@@ -155,15 +161,12 @@ def capture_and_encode_frame():
             )
             img = img.resize(new_size, Image.Resampling.LANCZOS)
         
-        # Codificar como JPEG
-        buffer = io.BytesIO()
-        img.save(buffer, format='JPEG', quality=CONFIG['CAPTURE_QUALITY'], optimize=True)
-        
-        # Convertir a base64
-        encoded = base64.b64encode(buffer.getvalue()).decode('utf-8')
+        # Codificar como JPEG lo que cambió
+        key, rects = differ.regions(img)
+        regions = encode_regions(img, rects, CONFIG['CAPTURE_QUALITY'], optimize=True)
         
         server_state['frame_count'] += 1
-        return encoded
+        return img, captured, key, regions
         
     except Exception as e:
         if CONFIG['DEBUG']:
@@ -183,15 +186,24 @@ def capture_loop():
         start_time = time.time()
         
         # Capturar y enviar frame
-        frame_data = capture_and_encode_frame()
+        frame = capture_and_encode_frame()
         
-        if frame_data:
+        if frame:
+            img, captured, key, regions = frame
             try:
-                socketio.emit('frame', {
-                    'data': frame_data,
-                    'timestamp': datetime.now().isoformat(),
-                    'frame_number': server_state['frame_count']
-                }, room='screen-share-room')
+                # Binario: cabecera compacta + regiones cambiadas, sin base64 ni JSON
+                socketio.emit(FRAME_EVENT,
+                              pack_screen_frame(server_state['frame_count'], captured, img.size, regions, key),
+                              room='screen-share-room')
+                if server_state['legacy_clients']:
+                    # Los clientes anteriores necesitan la pantalla completa en cada frame
+                    jpeg = regions[0][4] if key else \
+                        encode_regions(img, [(0, 0, *img.size)], CONFIG['CAPTURE_QUALITY'], optimize=True)[0][4]
+                    socketio.emit('frame', {
+                        'data': base64.b64encode(jpeg).decode('utf-8'),
+                        'timestamp': datetime.now().isoformat(),
+                        'frame_number': server_state['frame_count']
+                    }, room='screen-share-legacy')
             except Exception as e:
                 if CONFIG['DEBUG']:
                     print(f"❌ Error enviando frame: {e}")
@@ -206,10 +218,16 @@ def capture_loop():
 
 
 @socketio.on('connect')
-def handle_connect():
+def handle_connect(auth=None):
     """Cliente conectado"""
     server_state['clients_connected'] += 1
-    join_room('screen-share-room')
+    # Los clientes nuevos piden frames binarios al conectar; el resto recibe los de siempre
+    if auth and auth.get('binary_frames'):
+        join_room('screen-share-room')
+        differ.request_key_frame()  # Su lienzo está vacío
+    else:
+        server_state['legacy_clients'].add(request.sid)
+        join_room('screen-share-legacy')
     print(f"✓ Cliente conectado. Total: {server_state['clients_connected']}")
     
     # Iniciar captura si no está corriendo
@@ -231,13 +249,21 @@ def handle_connect():
 def handle_disconnect():
     """Cliente desconectado"""
     server_state['clients_connected'] = max(0, server_state['clients_connected'] - 1)
+    server_state['legacy_clients'].discard(request.sid)
     leave_room('screen-share-room')
+    leave_room('screen-share-legacy')
     print(f"✗ Cliente desconectado. Total: {server_state['clients_connected']}")
     
     if server_state['clients_connected'] <= 0:
         server_state['capturing'] = False
 
 
+@socketio.on('key_frame_request')
+def handle_key_frame_request():
+    """El cliente perdió un frame o aún no tiene lienzo: pantalla completa en la próxima captura"""
+    differ.request_key_frame()
+
+
 @socketio.on('mouse_move')
 def handle_mouse_move(data):
     """Controlar movimiento del mouse"""
@@ -0,0 +1,241 @@
+"""
+Chat History Module
+Append-only message store in SQLite (WAL mode) so conversations survive restarts
+and the UI only has to hold the page of messages it is showing.
+
+Appends are queued and written by one writer thread, which commits everything
+that queued up during the previous commit as one transaction, so callers on the
+network or UI threads never wait on the disk. Messages get their id when they
+are queued, and reads merge the rows still queued into what is committed, so
+reading never waits on the writer either. Pages are read by message id
+through the (peer, id) index, which keeps opening a conversation constant-time
+regardless of how much history it has.
+
+Message bodies are also indexed with FTS5 as they are committed (an
+external-content table kept in step by a trigger), so search doesn't scan
+the history. SQLite builds without FTS5 fall back to a LIKE scan.
+"""
+
+import collections
+import queue
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+HISTORY_FILE = "chat_history.db" # Lives next to settings.json
+HISTORY_PAGE_SIZE = 50 # Messages loaded per page when a conversation is opened or scrolled
+HISTORY_BATCH_SIZE = 1000 # Cap on queued messages written per transaction
+SEARCH_LIMIT = 100 # Newest matches returned by a search
+
+# `peer` is the conversation: a peer's IP, or a group key whose messages name their `sender`
+Message = collections.namedtuple("Message", "id peer ts kind outgoing body sender")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    peer TEXT NOT NULL,
+    ts REAL NOT NULL,
+    kind INTEGER NOT NULL,
+    outgoing INTEGER NOT NULL,
+    body TEXT NOT NULL,
+    sender TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_peer ON messages (peer, id);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE messages_fts USING fts5 (body, content='messages', content_rowid='id');
+CREATE TRIGGER messages_index AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, body) VALUES (new.id, new.body);
+END;
+INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');
+"""
+
+
+def fts_query(text):
+    """
+    Turns what the user typed into an FTS5 query: every word must match, and a
+    trailing '*' makes a word a prefix (slower, every matching term is merged).
+    Words are quoted so characters such as ':' or '-' in a pasted URL are never
+    read as query syntax.
+    """
+    terms = []
+    for word in text.split():
+        stem = word.rstrip("*")
+        if stem:
+            terms.append('"' + stem.replace('"', '""') + '"' + ("*" if stem != word else ""))
+    return " ".join(terms)
+
+
+def fts_tokens(text):
+    """Words as FTS5's default tokenizer sees them: runs of letters and digits, case and accents folded."""
+    text = unicodedata.normalize("NFKD", text.casefold())
+    return re.findall(r"[^\W_]+", "".join(c for c in text if not unicodedata.combining(c)))
+
+
+def fts_match(text, body):
+    """Whether fts_query(text) matches `body`, for messages still queued and not indexed yet."""
+    tokens = fts_tokens(body)
+    for word in text.split():
+        stem = word.rstrip("*")
+        phrase = fts_tokens(stem)
+        if not phrase:
+            continue
+        n = len(phrase)
+        if not any(tokens[i:i + n - 1] == phrase[:-1] and
+                   (tokens[i + n - 1].startswith(phrase[-1]) if stem != word else tokens[i + n - 1] == phrase[-1])
+                   for i in range(len(tokens) - n + 1)):
+            return False
+    return True
+
+
+class HistoryStore:
+    def __init__(self, path=HISTORY_FILE):
+        self.path = path
+        self._queue = queue.Queue()
+        self._read_lock = threading.Lock()
+        self._db = self._connect()
+        self._db.executescript(SCHEMA)
+        if "sender" not in [column[1] for column in self._db.execute("PRAGMA table_info(messages)")]:
+            self._db.execute("ALTER TABLE messages ADD COLUMN sender TEXT") # Histories from before group chats
+        self.indexed = self._create_index()
+        self._pending_lock = threading.Lock()
+        self._pending = {} # peer -> deque of its queued Messages, oldest first
+        self._next_id = (self._db.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0) + 1
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL") # WAL stays consistent; a power cut loses at most the last batch
+        return db
+
+    def _create_index(self):
+        """Creates the full-text index on first use, indexing any existing history; False without FTS5."""
+        if self._db.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone():
+            return True
+        try:
+            with self._db:
+                self._db.executescript(FTS_SCHEMA)
+            return True
+        except sqlite3.OperationalError as e:
+            print(f"Chat search without full-text index: {e}")
+            return False
+
+    def append(self, peer, kind, body, outgoing=False, ts=None, sender=None):
+        """Queues one message for the writer thread and returns immediately."""
+        with self._pending_lock:
+            row = Message(self._next_id, peer, time.time() if ts is None else ts, kind, int(outgoing), body, sender)
+            self._next_id += 1
+            self._pending.setdefault(peer, collections.deque()).append(row)
+            self._queue.put(row) # Under the lock, so rows are written in id order
+
+    def flush(self):
+        """Blocks until everything appended so far is on disk."""
+        self._queue.join()
+
+    def _queued(self, peer, kind):
+        """Snapshot of the rows not written yet, of one peer (or all) and kind, oldest first."""
+        with self._pending_lock:
+            if peer is None:
+                rows = sorted(row for rows in self._pending.values() for row in rows)
+            else:
+                rows = list(self._pending.get(peer, ()))
+        return [row for row in rows if kind is None or row.kind == kind]
+
+    def page(self, peer, before=None, after=None, kind=None, limit=HISTORY_PAGE_SIZE):
+        """
+        Up to `limit` of the peer's messages (of one `kind` if given), oldest first.
+
+        With no bounds that is the latest page; `before`/`after` take a message id
+        and return the page right before or after it, for scrolling either way.
+        """
+        where = "peer = ?"
+        args = [peer]
+        if kind is not None:
+            where += " AND kind = ?"
+            args.append(kind)
+        if after is not None:
+            sql = f"SELECT * FROM messages WHERE {where} AND id > ? ORDER BY id LIMIT ?"
+            args += [after, limit]
+        elif before is not None:
+            sql = f"SELECT * FROM messages WHERE {where} AND id < ? ORDER BY id DESC LIMIT ?"
+            args += [before, limit]
+        else:
+            sql = f"SELECT * FROM messages WHERE {where} ORDER BY id DESC LIMIT ?"
+            args.append(limit)
+        queued = [row for row in self._queued(peer, kind)
+                  if (after is None or row.id > after) and (before is None or row.id < before)]
+        rows = self._merge(self._read(sql, args), queued)
+        return rows[:limit] if after is not None else rows[-limit:]
+
+    def search(self, text, peer=None, kind=None, limit=SEARCH_LIMIT):
+        """Messages containing every word of `text`, newest first."""
+        query = fts_query(text)
+        if not query:
+            return []
+        words = [word.rstrip("*") for word in text.split() if word.rstrip("*")]
+        if self.indexed:
+            queued = [row for row in self._queued(peer, kind) if fts_match(text, row.body)]
+            sql = ("SELECT messages.* FROM messages_fts JOIN messages ON messages.id = messages_fts.rowid "
+                   "WHERE messages_fts MATCH ?")
+            args = [query]
+        else:
+            queued = [row for row in self._queued(peer, kind)
+                      if all(word.casefold() in row.body.casefold() for word in words)]
+            sql = "SELECT * FROM messages WHERE " + " AND ".join(["body LIKE ?"] * len(words))
+            args = [f"%{word}%" for word in words]
+        if peer is not None:
+            sql += " AND peer = ?"
+            args.append(peer)
+        if kind is not None:
+            sql += " AND kind = ?"
+            args.append(kind)
+        sql += f" ORDER BY {'messages_fts.rowid' if self.indexed else 'id'} DESC LIMIT ?"
+        args.append(limit)
+        return self._merge(self._read(sql, args), queued)[::-1][:limit]
+
+    def _read(self, sql, args):
+        with self._read_lock:
+            return [Message(*row) for row in self._db.execute(sql, args)]
+
+    @staticmethod
+    def _merge(committed, queued):
+        """Committed and queued rows by id, oldest first; a row written since the snapshot appears once."""
+        return sorted({row.id: row for row in [*committed, *queued]}.values())
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._writer.join()
+        self._db.close()
+
+    def _write_loop(self):
+        db = self._connect()
+        while True:
+            batch = [self._queue.get()]
+            while batch[-1] is not None and len(batch) < HISTORY_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            rows = [row for row in batch if row is not None]
+            try:
+                with db:
+                    db.executemany("INSERT INTO messages (id, peer, ts, kind, outgoing, body, sender) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            except sqlite3.Error as e:
+                print(f"Error saving chat history: {e}")
+            with self._pending_lock:
+                for row in rows:
+                    pending = self._pending[row.peer]
+                    pending.popleft()
+                    if not pending:
+                        del self._pending[row.peer]
+            for _ in batch:
+                self._queue.task_done()
+            if batch[-1] is None:
+                db.close()
+                return
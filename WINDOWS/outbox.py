@@ -0,0 +1,181 @@
+"""
+Outbox Module
+Store-and-forward queue for chat messages and file sends to peers that are
+offline. Every send is written to outbox.db (SQLite, next to settings.json)
+before it goes out and removed once the peer has it (its link got the
+receiver's acknowledgement, or the transfer was confirmed); whatever is left
+is flushed when discovery sees the peer again, a few peers at a time.
+"""
+
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from p2p_core import Delivery
+
+OUTBOX_FILE = "outbox.db" # Lives next to settings.json
+OUTBOX_WORKERS = 4 # Peers flushed at the same time when several come back at once
+OUTBOX_MAX_AGE = 7 * 24 * 3600 # Seconds before an undelivered entry is dropped
+
+KIND_MESSAGE = "message" # payload: message text, msg_type: its chat message type
+KIND_FILES = "files" # payload: JSON list of paths
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    peer TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    msg_type INTEGER,
+    payload TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_peer ON outbox (peer, id);
+"""
+
+
+class Outbox:
+    def __init__(self, chat_service, file_service, path=OUTBOX_FILE, on_flushed=None):
+        self.chat_service = chat_service
+        self.file_service = file_service
+        self.on_flushed = on_flushed # (peer, entries delivered) after a flush sent something
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._db:
+            self._db.executescript(SCHEMA)
+            self._db.execute("DELETE FROM outbox WHERE created < ?", (time.time() - OUTBOX_MAX_AGE,))
+        self._waiting = {peer for (peer,) in self._db.execute("SELECT DISTINCT peer FROM outbox")}
+        self._inflight = set() # Entry ids handed to a link or a transfer, not yet confirmed
+        self._flushing = set() # Peers with a flush running
+        self._pool = ThreadPoolExecutor(max_workers=OUTBOX_WORKERS)
+
+    def _add(self, peer, kind, payload, msg_type=None):
+        return self._add_many([peer], kind, payload, msg_type)[0]
+
+    def _add_many(self, peers, kind, payload, msg_type=None):
+        """One entry per peer, in a single transaction; returns their ids in the same order."""
+        now = time.time()
+        with self._lock, self._db:
+            first = (self._db.execute("SELECT MAX(id) FROM outbox").fetchone()[0] or 0) + 1
+            ids = list(range(first, first + len(peers)))
+            self._db.executemany("INSERT INTO outbox (id, peer, kind, msg_type, payload, created) VALUES (?, ?, ?, ?, ?, ?)",
+                                 [(entry_id, peer, kind, msg_type, payload, now) for entry_id, peer in zip(ids, peers)])
+            self._waiting.update(peers)
+            self._inflight.update(ids)
+        return ids
+
+    def _done(self, entry_id, delivered):
+        """Drops a delivered entry; an undelivered one stays queued for the next flush."""
+        with self._lock:
+            self._inflight.discard(entry_id)
+            if delivered:
+                with self._db:
+                    self._db.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+
+    def pending(self, peer=None):
+        """Queued entries as (id, peer, kind, msg_type, payload, created), oldest first."""
+        with self._lock:
+            if peer is None:
+                return self._db.execute("SELECT * FROM outbox ORDER BY id").fetchall()
+            return self._db.execute("SELECT * FROM outbox WHERE peer = ? ORDER BY id", (peer,)).fetchall()
+
+    # --- Sending ---
+    def send_message(self, peer, msg_type, content, on_sent=None):
+        """Like ChatService.send_packet, but the message survives until the peer has it."""
+        return self._send_entry(self._add(peer, KIND_MESSAGE, content, msg_type), peer, msg_type, content, on_sent)
+
+    def _send_entry(self, entry_id, peer, msg_type, content, on_sent=None):
+        def sent(delivered):
+            self._done(entry_id, delivered)
+            if on_sent:
+                on_sent(delivered)
+
+        if not self.chat_service.send_packet(peer, msg_type, content, sent):
+            sent(False)
+        return entry_id
+
+    def broadcast(self, target_ips, message, group=None, on_update=None):
+        """ChatService.broadcast through the outbox: a peer that can't be reached gets it later."""
+        msg_type, content = self.chat_service.group_packet(message, group)
+        delivery = Delivery(target_ips, on_update)
+        peers = list(delivery.status)
+        for entry_id, ip in zip(self._add_many(peers, KIND_MESSAGE, content, msg_type), peers):
+            self._send_entry(entry_id, ip, msg_type, content, functools.partial(delivery.update, ip))
+        return delivery
+
+    def send_files(self, peer, paths):
+        """Blocking, like FileTransferService.send_files; on failure the send waits for the peer."""
+        entry_id = self._add(peer, KIND_FILES, json.dumps(paths))
+        ok = self.file_service.send_files(peer, paths)
+        self._done(entry_id, ok)
+        return ok
+
+    # --- Flushing ---
+    def peer_seen(self, peer):
+        """Called for every discovery beacon; cheap unless something is waiting for this peer."""
+        with self._lock:
+            if peer not in self._waiting or peer in self._flushing:
+                return
+            self._flushing.add(peer)
+        self._pool.submit(self._flush, peer)
+
+    def _flush(self, peer):
+        delivered = 0
+        entries = []
+        try:
+            with self._lock:
+                for entry in self._db.execute("SELECT * FROM outbox WHERE peer = ? ORDER BY id", (peer,)):
+                    if entry[0] not in self._inflight:
+                        self._inflight.add(entry[0])
+                        entries.append(entry)
+            messages = [entry for entry in entries if entry[2] == KIND_MESSAGE]
+            files = [entry for entry in entries if entry[2] == KIND_FILES]
+
+            # Messages go out together (the link keeps their order); files only once they made it
+            delivery = Delivery([entry_id for entry_id, *_ in messages])
+            for entry_id, _, _, msg_type, payload, _ in messages:
+                def sent(ok, entry_id=entry_id):
+                    self._done(entry_id, ok)
+                    delivery.update(entry_id, ok)
+                if not self.chat_service.send_packet(peer, msg_type, payload, sent):
+                    sent(False)
+            delivery.wait()
+            delivered = len(delivery.sent())
+            if delivery.failed():
+                for entry_id, *_ in files:
+                    self._done(entry_id, False)
+                return # Gone again; the next beacon retries
+
+            for index, (entry_id, _, _, _, payload, _) in enumerate(files):
+                paths = [path for path in json.loads(payload) if os.path.exists(path)]
+                if not paths:
+                    print(f"Outbox: files for {peer} no longer exist, dropping entry")
+                    self._done(entry_id, True)
+                    continue
+                ok = self.file_service.send_files(peer, paths)
+                self._done(entry_id, ok)
+                if not ok:
+                    for later_id, *_ in files[index + 1:]:
+                        self._done(later_id, False)
+                    return
+                delivered += 1
+        except Exception as e:
+            print(f"Outbox flush to {peer} failed: {e}")
+            with self._lock:
+                self._inflight.difference_update(entry_id for entry_id, *_ in entries)
+        finally:
+            with self._lock:
+                self._flushing.discard(peer)
+                if not self._db.execute("SELECT 1 FROM outbox WHERE peer = ? LIMIT 1", (peer,)).fetchone():
+                    self._waiting.discard(peer)
+            if delivered and self.on_flushed:
+                self.on_flushed(peer, delivered)
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,1307 @@
+"""
+P2P Benchmarks
+Repeatable micro-benchmarks for the transfer and networking paths.
+
+    python p2p_bench.py delta --size-mb 64
+    python p2p_bench.py batch --files 10000
+    python p2p_bench.py receive --size-mb 512 --disk-mbps 80
+    python p2p_bench.py hashing --size-mb 256
+    python p2p_bench.py link --messages 5000
+    python p2p_bench.py burst --clients 2000
+    python p2p_bench.py frames --frames 200000
+    python p2p_bench.py history --messages 1000000 --peers 20
+    python p2p_bench.py fanout --peers 40 --dead 2
+    python p2p_bench.py discovery --peers 50 200 1000
+    python p2p_bench.py rendezvous --peers 500 2000
+    python p2p_bench.py swarm --peers 50 200
+    python p2p_bench.py screen --frame-kb 250
+    python p2p_bench.py tiles --frames 300
+"""
+
+import argparse
+import asyncio
+import base64
+import bisect
+import collections
+import datetime
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import math
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import chat_history
+import net_core
+import p2p_core
+import rendezvous
+import screen_frames
+from delta_sync import OP, SIGNATURE, block_size_for, compute_signatures, parse_signatures, iter_delta
+
+
+def _edit_workloads(size):
+    """(name, function(bytearray) -> bytearray) pairs modelling typical re-sends."""
+    def in_place(data):
+        for _ in range(10):
+            offset = random.randrange(0, len(data) - 4096)
+            data[offset:offset + 4096] = os.urandom(4096)
+        return data
+
+    def rewrite_1mb(data):
+        offset = min(5 * 1024 * 1024, len(data) // 2)
+        data[offset:offset + 1024 * 1024] = os.urandom(1024 * 1024)
+        return data
+
+    def insert(data):
+        middle = len(data) // 2
+        return data[:middle] + bytearray(os.urandom(1024)) + data[middle:]
+
+    def append(data):
+        return data + bytearray(os.urandom(1024 * 1024))
+
+    def truncate(data):
+        return data[:len(data) - 1024 * 1024]
+
+    def rewrite(data):
+        return bytearray(os.urandom(len(data)))
+
+    return [("in-place 10x4KB", in_place), ("in-place 1MB", rewrite_1mb), ("insert 1KB", insert), ("append 1MB", append),
+            ("truncate 1MB", truncate), ("full rewrite", rewrite)]
+
+
+def bench_delta(args):
+    size = args.size_mb * 1024 * 1024
+    random.seed(args.seed)
+    print(f"{'workload':<18}{'full bytes':>14}{'delta bytes':>14}{'ratio':>9}{'time':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        basis_path = os.path.join(tmp, "basis.bin")
+        new_path = os.path.join(tmp, "new.bin")
+        basis = bytearray(os.urandom(size))
+        with open(basis_path, "wb") as f:
+            f.write(basis)
+
+        for name, edit in _edit_workloads(size):
+            with open(new_path, "wb") as f:
+                f.write(edit(bytearray(basis)))
+
+            start = time.perf_counter()
+            block_size = block_size_for(size)
+            signatures = compute_signatures(basis_path, block_size)
+            wire = len(signatures) + OP.size  # signatures + end marker
+            for kind, arg, length in iter_delta(new_path, parse_signatures(signatures), block_size):
+                wire += OP.size + (0 if isinstance(arg, int) else length)
+            elapsed = time.perf_counter() - start
+
+            full = os.path.getsize(new_path)
+            print(f"{name:<18}{full:>14,}{wire:>14,}{wire / full:>9.3%}{elapsed:>8.2f}s")
+        print(f"block size {block_size_for(size)} B, {SIGNATURE.size} B signature per block")
+
+
+class _DirSettings:
+    """Just enough of SettingsManager for a loopback FileTransferService."""
+
+    def __init__(self, download_dir):
+        self.download_dir = download_dir
+
+    def get(self, key):
+        return self.download_dir if key == "download_dir" else None
+
+
+def _loopback_services(tmp):
+    p2p_core.FILE_PORT = random.randint(20000, 60000)
+    receiver = p2p_core.FileTransferService(_DirSettings(os.path.join(tmp, "received")))
+    receiver.start_server()
+    sender = p2p_core.FileTransferService(_DirSettings(os.path.join(tmp, "unused")))
+    return sender, receiver
+
+
+def bench_batch(args):
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        tree = os.path.join(tmp, "tree")
+        paths = []
+        for i in range(args.files):
+            folder = os.path.join(tree, f"dir{i // 500}")
+            os.makedirs(folder, exist_ok=True)
+            paths.append(os.path.join(folder, f"file{i}.txt"))
+            with open(paths[-1], "wb") as f:
+                f.write(os.urandom(args.size_kb * 512).hex().encode())
+        sender, _ = _loopback_services(tmp)
+
+        print(f"{'mode':<22}{'files':>8}{'time':>9}{'files/s':>10}")
+        per_file = paths[:args.per_file]
+        start = time.perf_counter()
+        for path in per_file:
+            sender.send_file("127.0.0.1", path)
+        elapsed = time.perf_counter() - start
+        print(f"{'send_file per file':<22}{len(per_file):>8}{elapsed:>8.2f}s{len(per_file) / elapsed:>10.0f}")
+
+        start = time.perf_counter()
+        sender.send_files("127.0.0.1", [tree])
+        elapsed = time.perf_counter() - start
+        print(f"{'send_files batch':<22}{len(paths):>8}{elapsed:>8.2f}s{len(paths) / elapsed:>10.0f}")
+
+
+class _Pace:
+    """Holds a stream to `rate` bytes/s (0: unlimited), adding a `stall` of that many seconds
+    every `every` bytes, the way a USB stick or NAS behaves once its write cache is full.
+    Only `slack` seconds of time spent idle may be made up by later writes."""
+
+    def __init__(self, rate, stall=0.0, every=0, slack=0.0):
+        self.rate = rate
+        self.stall = stall
+        self.every = every
+        self.slack = slack
+        self.done = 0
+        self.due = 0.0
+
+    def add(self, n):
+        if not self.rate:
+            return
+        now = time.perf_counter()
+        self.due = max(self.due, now - self.slack) + n / self.rate
+        if self.every and (self.done + n) // self.every > self.done // self.every:
+            self.due += self.stall
+        self.done += n
+        if self.due > now:
+            time.sleep(self.due - now)
+
+
+class _SlowDiskWriter(p2p_core.DiskWriter):
+    """DiskWriter whose write stage runs at the pace of `disk`."""
+
+    def __init__(self, path, disk):
+        self.disk = disk
+        super().__init__(path)
+
+    def _pwrite(self, offset, view):
+        super()._pwrite(offset, view)
+        self.disk.add(len(view))
+
+
+class _NoDigest:
+    """A sha256() that does no work: every digest is zeros, so verification still passes."""
+
+    def __init__(self, data=b""):
+        pass
+
+    def update(self, data):
+        pass
+
+    def digest(self):
+        return bytes(p2p_core.DIGEST_SIZE)
+
+
+class _NoHashlib:
+    """Stands in for p2p_core's hashlib to time transfers with hashing taken out."""
+    sha1 = staticmethod(hashlib.sha1) # Transfer ids only
+    sha256 = _NoDigest
+
+
+def _peak_rss():
+    """Peak resident set of this process in bytes, or None where it cannot be read."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _receive_old(client, path, size, disk):
+    """The receive loop before DiskWriter: recv() a buffer, write() it, repeat."""
+    received = 0
+    with open(path, "wb") as f:
+        while received < size:
+            chunk = client.recv(min(p2p_core.BUFFER_SIZE, size - received))
+            if not chunk:
+                break
+            f.write(chunk)
+            disk.add(len(chunk))
+            received += len(chunk)
+    return received
+
+
+def _receive_writer(client, path, size, disk):
+    """The current receive loop: pooled buffers handed to the write and hash stages."""
+    with open(path, "wb"):
+        pass
+    writer = _SlowDiskWriter(path, disk)
+    pos = 0
+    try:
+        while pos < size:
+            chunk_end = min(pos + p2p_core.CHUNK_SIZE, size)
+            while pos < chunk_end:
+                buf = writer.acquire()
+                n = p2p_core.recv_fill(client, memoryview(buf), min(len(buf), chunk_end - pos))
+                writer.write(pos, buf, n)
+                pos += n
+            writer.verify(pos // p2p_core.CHUNK_SIZE, b"", lambda index, ok, digest: None)
+    finally:
+        writer.close()
+    return pos
+
+
+def _receive_unhashed(client, path, size, disk):
+    """DiskWriter with its hash stage doing no hashing, to price the SHA-256."""
+    p2p_core.hashlib = _NoHashlib
+    return _receive_writer(client, path, size, disk)
+
+
+RECEIVE_MODES = {"recv + write": _receive_old, "DiskWriter": _receive_writer, "DiskWriter, no hash": _receive_unhashed}
+
+
+def _receive_once(args):
+    """One receive mode in this process; prints its result as JSON for bench_receive."""
+    size = args.size_mb * 1024 * 1024
+    baseline = _peak_rss()
+    server = socket.create_server(("127.0.0.1", 0))
+    block = memoryview(os.urandom(1024 * 1024))
+
+    def send():
+        net = _Pace(args.net_mbps * 1024 * 1024, slack=0.05) # The socket buffer keeps the link busy
+        with socket.create_connection(server.getsockname()) as conn:
+            left = size
+            while left:
+                n = min(len(block), left)
+                conn.sendall(block[:n])
+                net.add(n)
+                left -= n
+
+    threading.Thread(target=send, daemon=True).start()
+    client, _ = server.accept()
+    disk = _Pace(args.disk_mbps * 1024 * 1024, args.stall_ms / 1000, args.stall_every_mb * 1024 * 1024)
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        cpu = time.process_time()
+        received = RECEIVE_MODES[args.mode](client, os.path.join(tmp, "received.bin"), size, disk)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+    client.close()
+    server.close()
+    peak = _peak_rss()
+    print(json.dumps({"received": received, "elapsed": elapsed, "cpu": cpu,
+                      "rss": None if peak is None else peak - baseline}))
+
+
+def bench_receive(args):
+    """
+    Receiving one stream into a disk slower than the network: the recv/write loop against
+    DiskWriter's write and hash stages. The sink is a real file held to --disk-mbps, with
+    --stall-ms pauses every --stall-every-mb; the sender is held to --net-mbps. Each mode runs
+    in its own process so its peak RSS can be read.
+    """
+    if args.mode:
+        return _receive_once(args)
+    def rate(mbps):
+        return f"{mbps} MB/s" if mbps else "unlimited"
+
+    print(f"net {rate(args.net_mbps)}, disk {rate(args.disk_mbps)}"
+          + (f", {args.stall_ms} ms stall every {args.stall_every_mb} MB" if args.stall_ms else ""))
+    print(f"{'receiver':<21}{'MB':>7}{'time':>9}{'MB/s':>9}{'CPU':>9}{'peak RSS':>11}")
+    options = ["--size-mb", str(args.size_mb), "--net-mbps", str(args.net_mbps), "--disk-mbps", str(args.disk_mbps),
+               "--stall-ms", str(args.stall_ms), "--stall-every-mb", str(args.stall_every_mb)]
+    for mode in RECEIVE_MODES:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "receive", "--mode", mode, *options],
+                             capture_output=True, text=True, check=True).stdout
+        result = json.loads(out)
+        mb = result["received"] / (1024 * 1024)
+        rss = "-" if result["rss"] is None else f"+{result['rss'] / (1024 * 1024):.1f} MB"
+        print(f"{mode:<21}{mb:>7.0f}{result['elapsed']:>8.2f}s{mb / result['elapsed']:>9.1f}"
+              f"{result['cpu']:>8.2f}s{rss:>11}")
+
+
+def bench_hashing(args):
+    """
+    What chunk hashing costs a whole transfer: send_file over loopback with SHA-256 on both
+    sides (ChunkHasher on the sender, DiskWriter's hash stage on the receiver) and with every
+    digest replaced by zeros. Loopback has no bandwidth limit, so this is the worst case: the
+    transfer is bound by CPU, which the hashing competes for.
+    """
+    size = args.size_mb * 1024 * 1024
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "source.bin")
+        with open(path, "wb") as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+        sender, receiver = _loopback_services(tmp)
+        received = os.path.join(tmp, "received", "source.bin")
+
+        def run():
+            best = None
+            for _ in range(args.rounds):
+                if os.path.exists(received):
+                    os.remove(received) # Otherwise the next round is sent as a delta
+                start = time.perf_counter()
+                ok = sender.send_file("127.0.0.1", path)
+                elapsed = time.perf_counter() - start
+                if not ok or os.path.getsize(received) != size:
+                    raise RuntimeError("transfer failed")
+                best = elapsed if best is None else min(best, elapsed)
+            return best
+
+        print(f"{'hashing':<10}{'MB':>7}{'best time':>11}{'MB/s':>9}")
+        results = {}
+        for name, module in [("SHA-256", p2p_core.hashlib), ("none", _NoHashlib)]:
+            saved, p2p_core.hashlib = p2p_core.hashlib, module
+            try:
+                results[name] = run()
+            finally:
+                p2p_core.hashlib = saved
+            print(f"{name:<10}{args.size_mb:>7}{results[name]:>10.2f}s{args.size_mb / results[name]:>9.1f}")
+        print(f"hashing costs {1 - results['none'] / results['SHA-256']:.1%} of loopback throughput "
+              f"on {os.cpu_count()} CPU(s)")
+
+
+def _connect_per_message(target_ip, msg_type, content, timeout=None):
+    """The pre-PeerLink send path: a fresh TCP connection for every message."""
+    data = content.encode('utf-8')
+    with socket.create_connection((target_ip, p2p_core.CHAT_PORT), timeout=timeout) as s:
+        s.sendall(bytes([msg_type]) + struct.pack("!I", len(data)) + data)
+
+
+def bench_link(args):
+    p2p_core.CHAT_PORT = random.randint(20000, 60000)
+    arrived = {}
+    done = threading.Event()
+
+    def on_message(ip, content):
+        arrived[content] = time.perf_counter()
+        if len(arrived) >= expected:
+            done.set()
+
+    receiver = p2p_core.ChatService(on_message)
+    receiver.start_server()
+    sender = p2p_core.ChatService(lambda ip, content: None)
+    sender.send_message("127.0.0.1", "warmup")
+    time.sleep(0.2)
+
+    modes = [("connect per message", _connect_per_message, args.legacy_messages),
+             ("peer link", sender.send_packet, args.messages)]
+    print(f"{'mode':<22}{'messages':>9}{'msg/s':>10}{'p50 ms':>9}{'p99 ms':>9}")
+    for name, send, count in modes:
+        # Throughput: fire everything, stop the clock when the last message is delivered
+        arrived.clear()
+        done.clear()
+        expected = count
+        start = time.perf_counter()
+        for i in range(count):
+            send("127.0.0.1", p2p_core.MSG_TYPE_CHAT, f"{name} {i}")
+        done.wait(60)
+        rate = len(arrived) / (max(arrived.values()) - start)
+
+        # Latency: one message in flight at a time
+        latencies = []
+        for i in range(args.pings):
+            arrived.clear()
+            done.clear()
+            expected = 1
+            start = time.perf_counter()
+            send("127.0.0.1", p2p_core.MSG_TYPE_CHAT, f"ping {i}")
+            done.wait(5)
+            latencies.append((arrived[f"ping {i}"] - start) * 1000)
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2]
+        p99 = latencies[int(len(latencies) * 0.99)]
+        print(f"{name:<22}{count:>9}{rate:>10.0f}{p50:>9.3f}{p99:>9.3f}")
+
+
+def bench_burst(args):
+    """Many peers connect at once and each sends one chat message."""
+    def run(start_server, clients):
+        p2p_core.CHAT_PORT = random.randint(20000, 30000)
+        arrived = []
+        done = threading.Event()
+
+        def on_message(ip, content):
+            arrived.append(content)
+            if len(arrived) == clients:
+                done.set()
+
+        chat = p2p_core.ChatService(on_message)
+        stop = start_server(chat)
+        start = time.perf_counter()
+        peak = threading.active_count()
+        conns = []
+        for i in range(clients):
+            conns.append(socket.create_connection(("127.0.0.1", p2p_core.CHAT_PORT)))
+            peak = max(peak, threading.active_count())
+        for i, conn in enumerate(conns):
+            data = f"peer {i}".encode('utf-8')
+            conn.sendall(bytes([p2p_core.MSG_TYPE_CHAT]) + struct.pack("!I", len(data)) + data)
+        while not done.wait(0.01):
+            peak = max(peak, threading.active_count())
+            if time.perf_counter() - start > 60:
+                break
+        elapsed = time.perf_counter() - start
+        for conn in conns:
+            conn.close()
+        stop()
+        return len(arrived), elapsed, peak
+
+    def thread_server(chat):
+        chat.start_server()
+        return chat.sock.close
+
+    def event_loop(chat):
+        core = net_core.NetworkCore(chat, use_uvloop=not args.no_uvloop)
+        core.start()
+        return core.stop
+
+    print(f"{'server':<22}{'clients':>9}{'delivered':>11}{'time':>9}{'peak threads':>14}")
+    for name, start_server, clients in [("thread per client", thread_server, args.legacy_clients),
+                                        ("asyncio core", event_loop, args.clients)]:
+        delivered, elapsed, peak = run(start_server, clients)
+        print(f"{name:<22}{clients:>9}{delivered:>11}{elapsed:>8.2f}s{peak:>14}")
+
+
+def _legacy_decode(sock, count):
+    """The pre-FrameDecoder read loop: type, length and payload each read separately.
+
+    Uses recv_exact for the last two; the original bare recv(length) desyncs the stream
+    as soon as a payload arrives split across segments.
+    """
+    for _ in range(count):
+        sock.recv(1)
+        length = struct.unpack("!I", p2p_core.recv_exact(sock, 4))[0]
+        p2p_core.recv_exact(sock, length)
+    return 3 * count
+
+
+def _decoder_decode(sock, count):
+    decoder = p2p_core.FrameDecoder()
+    decoded = 0
+    calls = 0
+    while decoded < count:
+        decoder.advance(sock.recv_into(decoder.get_buffer()))
+        calls += 1
+        for msg_type, payload in decoder.frames():
+            decoded += 1
+    return calls
+
+
+def bench_frames(args):
+    payload = b"x" * args.payload
+    blob = (bytes([p2p_core.MSG_TYPE_CHAT]) + struct.pack("!I", len(payload)) + payload) * args.frames
+    print(f"{'decoder':<22}{'frames':>9}{'frames/s':>12}{'recv calls':>12}")
+    for name, decode in [("read per field", _legacy_decode), ("FrameDecoder", _decoder_decode)]:
+        reader, writer = socket.socketpair()
+        sender = threading.Thread(target=writer.sendall, args=(blob,), daemon=True)
+        start = time.perf_counter()
+        sender.start()
+        calls = decode(reader, args.frames)
+        elapsed = time.perf_counter() - start
+        sender.join()
+        reader.close()
+        writer.close()
+        print(f"{name:<22}{args.frames:>9}{args.frames / elapsed:>12.0f}{calls:>12}")
+
+
+def bench_history(args):
+    random.seed(args.seed)
+    peers = [f"10.0.0.{i}" for i in range(1, args.peers + 1)]
+    # Zipf-ish vocabulary: a few words are in most messages, most words are rare
+    vocabulary = ["".join(random.choices("abcdefghijklmnopqrstuvwxyz", k=random.randint(3, 9)))
+                  for _ in range(args.vocabulary)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(args.vocabulary)))
+    with tempfile.TemporaryDirectory() as tmp:
+        store = chat_history.HistoryStore(os.path.join(tmp, "history.db"))
+        start = time.perf_counter()
+        for i in range(args.messages):
+            body = " ".join(random.choices(vocabulary, cum_weights=cum_weights, k=args.words))
+            store.append(random.choice(peers), p2p_core.MSG_TYPE_CHAT, body, outgoing=i % 2 == 0)
+        queued = time.perf_counter() - start
+        store.flush()
+        written = time.perf_counter() - start
+        print(f"append {args.messages:,} messages: {queued * 1e6 / args.messages:.1f} us each on the caller, "
+              f"{args.messages / written:,.0f} msg/s to disk")
+
+        # Reopen, as after a restart, and page through the busiest conversation
+        store.close()
+        start = time.perf_counter()
+        store = chat_history.HistoryStore(os.path.join(tmp, "history.db"))
+        latest = store.page(peers[0])
+        opened = time.perf_counter() - start
+        start = time.perf_counter()
+        rows = latest
+        pages = 0
+        while rows and pages < args.pages: # Shorter conversations run out of pages first
+            rows = store.page(peers[0], before=rows[0].id)
+            pages += 1
+        paged = (time.perf_counter() - start) / max(pages, 1)
+        print(f"open conversation ({len(latest)} messages): {opened * 1000:.2f} ms, "
+              f"each of {pages} older pages: {paged * 1000:.2f} ms")
+
+        queries = [("common word", vocabulary[0]), ("rare word", vocabulary[-1]),
+                   ("two words", f"{vocabulary[5]} {vocabulary[50]}"), ("prefix", vocabulary[100][:3] + "*")]
+        for name, query in queries:
+            start = time.perf_counter()
+            for _ in range(args.searches):
+                found = store.search(query)
+            elapsed = (time.perf_counter() - start) / args.searches
+            print(f"search {name:<12} {query!r:<22}{len(found):>5} results {elapsed * 1000:>8.2f} ms")
+        store.close()
+
+
+class _FanoutPeer:
+    """A chat listener on its own loopback address; a dead one never accepts and drops new SYNs."""
+
+    def __init__(self, ip, dead=False):
+        self.ip = ip
+        self.dead = dead
+        self.arrived = threading.Event()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind((ip, p2p_core.CHAT_PORT))
+        if dead:
+            self.sock.listen(0)
+            self._stuck = [] # Fill the accept queue so later connects hang like an asleep host
+            for _ in range(2):
+                stuck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                stuck.setblocking(False)
+                stuck.connect_ex((ip, p2p_core.CHAT_PORT))
+                self._stuck.append(stuck)
+        else:
+            self.sock.listen(16)
+            threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._read, args=(conn,), daemon=True).start()
+
+    def _read(self, conn):
+        decoder = p2p_core.FrameDecoder()
+        while True:
+            try:
+                n = conn.recv_into(decoder.get_buffer())
+            except OSError:
+                n = 0
+            if not n:
+                conn.close()
+                return
+            decoder.advance(n)
+            for msg_type, _ in decoder.frames():
+                if msg_type == p2p_core.MSG_TYPE_CHAT:
+                    self.arrived.set()
+
+
+def bench_fanout(args):
+    """One message to many peers, some of them asleep. Needs 127.0.0.x aliases (Linux has them)."""
+    p2p_core.CHAT_PORT = random.randint(20000, 30000)
+    peers = [_FanoutPeer(f"127.0.0.{i + 2}", dead=i < args.dead) for i in range(args.peers)]
+    live = [peer for peer in peers if not peer.dead]
+
+    def sequential(ips):
+        for ip in ips:
+            try:
+                _connect_per_message(ip, p2p_core.MSG_TYPE_CHAT, "announcement", timeout=args.timeout)
+            except OSError:
+                pass
+
+    def fan_out(ips):
+        return chat.broadcast(ips, "announcement")
+
+    chat = p2p_core.ChatService(lambda ip, content: None)
+    print(f"{'mode':<22}{'peers':>7}{'dead':>6}{'caller blocked':>16}{'all live received':>19}")
+    for name, send in [("sequential connects", sequential), ("fan-out, new links", fan_out),
+                       ("fan-out, links open", fan_out)]:
+        for peer in peers:
+            peer.arrived.clear()
+        start = time.perf_counter()
+        send([peer.ip for peer in peers])
+        blocked = time.perf_counter() - start
+        for peer in live:
+            peer.arrived.wait(60)
+        received = time.perf_counter() - start
+        print(f"{name:<22}{len(peers):>7}{args.dead:>6}{blocked * 1000:>14.1f}ms{received * 1000:>17.1f}ms")
+
+
+class _BenchSettings:
+    def __init__(self, nick):
+        self.nick = nick
+
+    def get(self, key):
+        return {"nickname": self.nick, "avatar": "👤"}[key]
+
+
+def _fixed_schedule(starts, seconds):
+    """Packet times of the JSON beacons: every BROADCAST_INTERVAL from each peer's start."""
+    step = p2p_core.BROADCAST_INTERVAL
+    return [start + step * i for start in starts for i in range(int((seconds - start) // step) + 1)]
+
+
+def _trickle_schedule(starts, seconds):
+    """
+    Packet times under BeaconTimer on a virtual clock: every peer's broadcasts plus the
+    unicast replies its hello beacons get from settled peers, following the same reply
+    limit and early-broadcast rule as DiscoveryService.handle_beacon.
+    """
+    rounds = p2p_core.BEACON_HELLO_ROUNDS
+    order = sorted(range(len(starts)), key=starts.__getitem__)
+    started = sorted(starts)
+    timers = [p2p_core.BeaconTimer(now=start) for start in starts]
+    sent = [0] * len(starts)
+    replied = [{} for _ in starts]
+    windows = [(0, 0)] * len(starts)
+    versions = [0] * len(starts)
+    events = [(timer.next_at, 0, peer) for peer, timer in enumerate(timers)]
+    heapq.heapify(events)
+    packets = []
+    while events:
+        now, version, peer = heapq.heappop(events)
+        if now >= seconds:
+            break
+        if version != versions[peer]:
+            continue # Moved by an early broadcast
+        packets.append(now)
+        hello = sent[peer] < rounds
+        sent[peer] += 1
+        timers[peer].sent(now)
+        heapq.heappush(events, (timers[peer].next_at, versions[peer], peer))
+        if not hello:
+            continue
+        for other in order[:bisect.bisect_right(started, now)]:
+            if other == peer or sent[other] < rounds:
+                continue
+            if now - replied[other].get(peer, -p2p_core.BEACON_MAX_INTERVAL) < p2p_core.BEACON_MAX_INTERVAL:
+                continue
+            replied[other][peer] = now
+            window, count = windows[other]
+            if now - window >= 1:
+                window, count = now, 0
+            if count >= p2p_core.BEACON_REPLY_RATE:
+                before = timers[other].next_at
+                timers[other].hurry(p2p_core.BROADCAST_INTERVAL, now)
+                if timers[other].next_at != before:
+                    versions[other] += 1
+                    heapq.heappush(events, (timers[other].next_at, versions[other], other))
+                continue
+            windows[other] = (window, count + 1)
+            packets.append(now)
+    return packets
+
+
+def _beacon_cost(payloads, rounds):
+    """CPU seconds a listener spends per received beacon, with all senders already known."""
+    listener = p2p_core.DiscoveryService(_BenchSettings("listener"), lambda event, info: None)
+    for payload in payloads:
+        listener.handle_beacon(payload)
+    start = time.process_time()
+    for _ in range(rounds):
+        for payload in payloads:
+            listener.handle_beacon(payload)
+    return (time.process_time() - start) / (rounds * len(payloads))
+
+
+def bench_discovery(args):
+    """
+    Discovery chatter on a simulated LAN where every peer hears every broadcast:
+    JSON beacons every BROADCAST_INTERVAL vs binary beacons on the adaptive timer.
+    Send times are simulated on a virtual clock; the listener's CPU per beacon is measured.
+    """
+    random.seed(args.seed)
+    print(f"{'beacons':<16}{'peers':>6}{'startup total':>15}{'peak':>10}{'steady':>10}{'steady bytes':>14}"
+          f"{'us/beacon':>11}{'listener CPU':>14}")
+    for count in args.peers:
+        starts = [random.uniform(0, args.startup) for _ in range(count)]
+        ips = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(1, count + 1)]
+        json_payloads = [json.dumps({"type": "discovery", "ip": ip, "nick": f"User_{ip.split('.')[-1]}",
+                                     "avatar": "👤"}).encode('utf-8') for ip in ips]
+        binary_payloads = [p2p_core.pack_beacon(ip, f"User_{ip.split('.')[-1]}", "👤", p2p_core.BEACON_MAX_INTERVAL)
+                           for ip in ips]
+        rounds = max(1, args.samples // count)
+
+        modes = [("JSON every 3 s", _fixed_schedule(starts, args.seconds), json_payloads),
+                 ("binary, Trickle", _trickle_schedule(starts, args.seconds), binary_payloads)]
+        for name, packets, payloads in modes:
+            per_second = collections.Counter(int(t) for t in packets)
+            steady = sum(1 for t in packets if t >= args.settle) / (args.seconds - args.settle)
+            size = sum(len(payload) + 28 for payload in payloads) / len(payloads) # + IPv4 and UDP headers
+            cost = _beacon_cost(payloads, rounds)
+            startup = sum(1 for t in packets if t < args.settle)
+            peak = max(per_second[second] for second in range(int(args.settle)))
+            print(f"{name:<16}{count:>6}{startup:>11} pkt{peak:>6} p/s{steady:>6.0f} p/s{steady * size / 1024:>9.1f} KB/s"
+                  f"{cost * 1e6:>11.1f}{steady * cost * 100:>13.2f}%")
+
+
+class _RendezvousPeer:
+    """A bare asyncio client: registers, then keeps the server's list of peers."""
+
+    def __init__(self, index):
+        self.ip = f"127.{(index + 2) >> 16 & 255}.{(index + 2) >> 8 & 255}.{(index + 2) & 255}"
+        self.listed = set()
+        self.received = 0
+        self.writer = None
+
+    async def run(self, port, on_change):
+        reader, self.writer = await asyncio.open_connection("127.0.0.1", port, local_addr=(self.ip, 0))
+        self.writer.write(rendezvous.encode({"op": "hello", "nick": self.ip, "avatar": "👤"}))
+        try:
+            while True:
+                size = rendezvous.FRAME.unpack(await reader.readexactly(rendezvous.FRAME.size))[0]
+                msg = json.loads(await reader.readexactly(size))
+                self.received += rendezvous.FRAME.size + size
+                if msg["op"] == "snapshot":
+                    self.listed = {info["ip"] for info in msg["peers"]}
+                elif msg["op"] == "update":
+                    self.listed |= {info["ip"] for info in msg["peers"]}
+                    self.listed -= set(msg["removed"])
+                on_change(self)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+
+def bench_rendezvous(args):
+    """
+    Thousands of peers registering with one rendezvous server (run as a separate
+    process, so its CPU time can be read) over loopback addresses. Linux/macOS.
+    The simulated peers all run in this process; with few cores their own CPU
+    time, not the server's, bounds the times measured.
+    """
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 2 * max(args.peers) + 256
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+    async def wait_for(condition, limit=120):
+        start = time.perf_counter()
+        while not condition() and time.perf_counter() - start < limit:
+            await asyncio.sleep(0.01)
+        return time.perf_counter() - start
+
+    async def run(count, port):
+        peers = [_RendezvousPeer(i) for i in range(count)]
+        expected = {peer.ip for peer in peers}
+        complete = set() # Peers whose list matches `expected`
+
+        def on_change(peer):
+            if peer.listed == expected:
+                complete.add(peer)
+            else:
+                complete.discard(peer)
+
+        tasks = [asyncio.ensure_future(peer.run(port, on_change)) for peer in peers]
+        joined = await wait_for(lambda: len(complete) == count)
+        received = sum(peer.received for peer in peers)
+
+        # A tenth of the peers quit; everyone else should see them go
+        leaving = peers[:max(1, count // 10)]
+        staying = peers[len(leaving):]
+        expected = expected - {peer.ip for peer in leaving}
+        complete.clear()
+        for peer in leaving:
+            peer.writer.close()
+        left = await wait_for(lambda: len(complete) == len(staying))
+        for peer in staying:
+            peer.writer.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return joined, left, received / count
+
+    print(f"{'peers':>6}{'all listed':>12}{'10% leave seen':>16}{'received/peer':>15}{'server CPU':>12}{'clients CPU':>13}")
+    for count in args.peers:
+        port = random.randint(20000, 30000)
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        server = subprocess.Popen([sys.executable, "rendezvous.py", "--host", "127.0.0.1", "--port", str(port)],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL)
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        clients_cpu = time.process_time()
+        joined, left, per_peer = asyncio.run(run(count, port))
+        clients_cpu = time.process_time() - clients_cpu
+        server.terminate()
+        server.wait()
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime)
+        print(f"{count:>6}{joined:>11.2f}s{left:>15.2f}s{per_peer / 1024:>12.1f} KB{cpu:>11.2f}s{clients_cpu:>12.2f}s")
+
+
+LOOPBACK_BROADCAST = "127.255.255.255"
+
+
+class _LoopbackInterfaces(p2p_core.LocalInterfaces):
+    """A virtual peer's one interface: its own loopback address, broadcasting to all of 127/8."""
+
+    def __init__(self, ip):
+        self.interfaces = [(ip, LOOPBACK_BROADCAST)]
+        self.addresses = frozenset([ip])
+
+    def refresh(self):
+        return False
+
+    def invalidate(self):
+        pass
+
+
+class _SwarmPeer(asyncio.DatagramProtocol):
+    """One virtual peer: a real DiscoveryService on its own loopback address, driven the way NetworkCore drives it."""
+
+    def __init__(self, swarm, ip, max_interval):
+        self.swarm = swarm
+        self.ip = ip
+        self.discovery = p2p_core.DiscoveryService(_BenchSettings(f"User_{ip}"),
+                                                   lambda event, info: swarm.on_event(ip, event, info))
+        self.discovery.local = _LoopbackInterfaces(ip)
+        self.discovery.timer = p2p_core.BeaconTimer(high=max_interval)
+        self.transports = []
+        self.task = None
+
+    async def start(self, port):
+        loop = asyncio.get_running_loop()
+        # Unicast replies and probes arrive on the peer's own address, broadcasts on a socket every peer shares
+        for address in (self.ip, LOOPBACK_BROADCAST):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.bind((address, port))
+            transport, _ = await loop.create_datagram_endpoint(lambda: self, sock=sock)
+            self.transports.append(transport)
+        self.task = asyncio.ensure_future(self._beacons())
+
+    def stop(self):
+        """Vanishes without a word, like a laptop closing its lid."""
+        self.task.cancel()
+        for transport in self.transports:
+            transport.close()
+
+    async def _beacons(self):
+        while True:
+            start = time.perf_counter()
+            beacons, delay = self.discovery.beacon_round()
+            self.swarm.busy += time.perf_counter() - start
+            self.send(beacons)
+            await asyncio.sleep(delay)
+
+    def send(self, datagrams):
+        for payload, address in datagrams:
+            self.transports[0].sendto(payload, address)
+            self.swarm.sent[int(self.swarm.elapsed())] += 1
+
+    def datagram_received(self, data, addr):
+        start = time.perf_counter()
+        replies = self.discovery.handle_beacon(data)
+        self.swarm.busy += time.perf_counter() - start
+        self.swarm.received += 1
+        self.send(replies)
+
+
+class _Swarm:
+    """
+    Virtual peers joining and leaving, plus the bookkeeping that tells, from the
+    peer events alone, when every live peer's list is right again.
+    """
+
+    def __init__(self, port, max_interval):
+        self.port = port
+        self.max_interval = max_interval
+        self.started = time.monotonic()
+        self.peers = {} # IP -> live _SwarmPeer
+        self.views = collections.defaultdict(set) # IP -> IPs that peer lists
+        self.listed_by = collections.defaultdict(set) # IP -> peers listing it
+        self.joining = {} # IP -> start, until it lists every live peer and all of them list it
+        self.leaving = {} # IP -> stop, until no live peer lists it
+        self.joined = [] # (IP, start, seconds until everyone agreed)
+        self.left = []
+        self.sent = collections.Counter() # Second -> packets sent
+        self.events = collections.Counter() # Second -> peer events, i.e. sidebar updates
+        self.peer_events = collections.Counter() # (IP, second) -> peer events
+        self.received = 0
+        self.false_drops = 0 # Live peers removed from someone's list
+        self.busy = 0.0 # Seconds spent inside DiscoveryService
+        self._index = 0
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    async def join(self):
+        self._index += 1
+        ip = f"127.1.{self._index >> 8 & 255}.{self._index & 255}"
+        peer = _SwarmPeer(self, ip, self.max_interval)
+        self.peers[ip] = peer
+        self.joining[ip] = self.elapsed()
+        await peer.start(self.port)
+
+    def leave(self, ip):
+        self.peers.pop(ip).stop()
+        self.joining.pop(ip, None)
+        self.leaving[ip] = self.elapsed()
+        for other in self.views.pop(ip, ()):
+            self.listed_by[other].discard(ip)
+        self._check_left(ip)
+        for other in list(self.joining):
+            self._check_joined(other)
+
+    def on_event(self, observer, event, info):
+        if observer not in self.peers:
+            return
+        second = int(self.elapsed())
+        self.events[second] += 1
+        self.peer_events[observer, second] += 1
+        ip = info['ip']
+        if event in (p2p_core.PEER_ADDED, p2p_core.PEER_CHANGED):
+            self.views[observer].add(ip)
+            self.listed_by[ip].add(observer)
+            self._check_joined(ip)
+            self._check_joined(observer)
+        elif event == p2p_core.PEER_REMOVED:
+            self.views[observer].discard(ip)
+            self.listed_by[ip].discard(observer)
+            if ip in self.peers:
+                self.false_drops += 1
+            self._check_left(ip)
+
+    def _check_joined(self, ip):
+        if ip not in self.joining:
+            return
+        others = len(self.peers) - 1
+        if len(self.views[ip]) < others or len(self.listed_by[ip]) < others:
+            return # Cheap test first; the full one runs only when it can pass
+        if all(other in self.views[ip] and other in self.listed_by[ip] for other in self.peers if other != ip):
+            start = self.joining.pop(ip)
+            self.joined.append((ip, start, self.elapsed() - start))
+
+    def _check_left(self, ip):
+        if ip in self.leaving and not self.listed_by[ip]:
+            start = self.leaving.pop(ip)
+            self.left.append((ip, start, self.elapsed() - start))
+            del self.listed_by[ip]
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float("nan")
+
+
+def bench_swarm(args):
+    """
+    Discovery end to end: virtual peers, each a real DiscoveryService with its own
+    127.1.x.y address, beacon over loopback (broadcasts go to 127.255.255.255, which
+    every peer listens on). They start spread over --startup seconds; after --settle
+    a peer vanishes and a new one appears --churn times a minute for --churn-for
+    seconds. Reported: time until every list is right after the start, after each
+    join and after each leave; packets; peer events, which are what redraws the
+    sidebar; and CPU. Linux (macOS lacks 127.0.0.0/8 beyond 127.0.0.1 unless aliased).
+
+    The whole swarm shares this process, so "discovery CPU" is the time spent inside
+    DiscoveryService per peer, and with many peers on few cores the delays include
+    waiting for the loop.
+    """
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 2 * (max(args.peers) + int(args.churn * args.churn_for / 60)) + 256
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+    async def run(count, port):
+        scenario = random.Random(args.seed)
+        swarm = _Swarm(port, args.max_interval)
+        starts = sorted(scenario.uniform(0, args.startup) for _ in range(count))
+        for start in starts:
+            await asyncio.sleep(max(0, start - swarm.elapsed()))
+            await swarm.join()
+        initial = set(swarm.peers)
+        if args.churn:
+            step = 60 / args.churn
+            for i in range(int(args.churn_for / step)):
+                await asyncio.sleep(max(0, args.settle + i * step - swarm.elapsed()))
+                swarm.leave(scenario.choice(sorted(swarm.peers)))
+                await swarm.join()
+        await asyncio.sleep(max(0, args.seconds - swarm.elapsed()))
+        for peer in swarm.peers.values():
+            peer.stop()
+        return swarm, initial
+
+    original = (p2p_core.DISCOVERY_PORT, p2p_core.BEACON_MAX_INTERVAL)
+    print(f"{'peers':>6}{'converged':>11}{'join p95':>10}{'leave p95':>11}{'unfinished':>12}{'startup pkt':>13}"
+          f"{'steady':>12}{'UI ev/s/peer':>14}{'UI peak':>9}{'false drops':>13}{'CPU/peer':>10}")
+    for count in args.peers:
+        random.seed(args.seed)
+        # Replies and probes go to DISCOVERY_PORT, so the swarm gets a port of its own
+        p2p_core.DISCOVERY_PORT = random.randint(20000, 30000)
+        p2p_core.BEACON_MAX_INTERVAL = args.max_interval
+        cpu = time.process_time()
+        try:
+            swarm, initial = asyncio.run(run(count, p2p_core.DISCOVERY_PORT))
+        finally:
+            p2p_core.DISCOVERY_PORT, p2p_core.BEACON_MAX_INTERVAL = original
+        cpu = time.process_time() - cpu
+        first = [(start, start + seconds) for ip, start, seconds in swarm.joined if ip in initial]
+        converged = float("nan") # Not every starting peer was seen by all
+        if len(first) == count:
+            converged = max(end for _, end in first) - max(start for start, _ in first)
+        churned = [seconds for ip, start, seconds in swarm.joined if ip not in initial]
+        unfinished = len(swarm.joining) + len(swarm.leaving)
+        startup = sum(swarm.sent[second] for second in range(int(args.settle)))
+        steady = sum(swarm.sent[second] for second in range(int(args.settle), int(args.seconds)))
+        steady /= args.seconds - args.settle
+        total = len(swarm.peers) # Live at the end; the population stays the same size throughout
+        ui = sum(swarm.events[second] for second in range(int(args.settle), int(args.seconds)))
+        ui /= (args.seconds - args.settle) * total
+        peak = max(swarm.peer_events.values(), default=0)
+        print(f"{count:>6}{converged:>10.2f}s{_percentile(churned, 0.95):>9.2f}s"
+              f"{_percentile([seconds for _, _, seconds in swarm.left], 0.95):>10.2f}s{unfinished:>12}"
+              f"{startup:>13}{steady:>6.1f} pkt/s{ui:>14.3f}{peak:>7}/s{swarm.false_drops:>13}"
+              f"{swarm.busy / args.seconds / total * 100:>9.3f}%")
+        print(f"{'':>6}{len(churned)} joins, {len(swarm.left)} leaves; {swarm.received} beacons received; "
+              f"process CPU {cpu:.1f}s over {args.seconds:.0f}s")
+
+
+def _websocket_size(payload):
+    """A server-to-client WebSocket message: unmasked header plus payload."""
+    return 2 + (8 if payload >= 65536 else 2 if payload >= 126 else 0) + payload
+
+
+def _legacy_screen_send(jpeg, seq):
+    """What screen_server.py did per frame: base64 into a JSON event, sent as one text message."""
+    data = {"data": base64.b64encode(jpeg).decode('utf-8'), "timestamp": datetime.datetime.now().isoformat(),
+            "frame_number": seq}
+    return [("42" + json.dumps(["frame", data], separators=(',', ':'))).encode('utf-8')]
+
+
+def _legacy_screen_receive(messages):
+    msg = json.loads(messages[0][2:])
+    return base64.b64decode(msg[1]["data"])
+
+
+def _binary_screen_send(jpeg, seq):
+    """A binary Socket.IO event: a small text message naming it, then the frame as one binary message."""
+    placeholder = "451-" + json.dumps([screen_frames.FRAME_EVENT, {"_placeholder": True, "num": 0}],
+                                      separators=(',', ':'))
+    return [placeholder.encode('utf-8'),
+            screen_frames.pack_screen_frame(seq, screen_frames.capture_time(), (1920, 1080),
+                                            [(0, 0, 1920, 1080, jpeg)], key=True)]
+
+
+def _binary_screen_receive(messages):
+    json.loads(messages[0][4:])
+    return screen_frames.unpack_screen_frame(messages[1])[4][0][4]
+
+
+def bench_screen(args):
+    """
+    Wire bytes and CPU per screen frame, base64-in-JSON vs binary, for one 1080p JPEG.
+    Socket.IO 5 over WebSocket, encoded the way python-socketio does; the JPEG encode
+    and decode are the same either way and left out.
+    """
+    if args.jpeg:
+        with open(args.jpeg, "rb") as f:
+            jpeg = f.read()
+    else:
+        jpeg = os.urandom(args.frame_kb * 1024) # Compressed data; only its size matters here
+    print(f"JPEG: {len(jpeg) / 1024:.1f} KB")
+    print(f"{'frames':<18}{'bytes/frame':>13}{'overhead':>10}{'server us/frame':>17}{'client us/frame':>17}")
+    for name, send, receive in [("base64 in JSON", _legacy_screen_send, _legacy_screen_receive),
+                                ("binary", _binary_screen_send, _binary_screen_receive)]:
+        messages = send(jpeg, 0)
+        assert receive(messages) == jpeg
+        size = sum(_websocket_size(len(message)) for message in messages)
+        start = time.process_time()
+        for seq in range(args.frames):
+            send(jpeg, seq)
+        sent = (time.process_time() - start) / args.frames
+        start = time.process_time()
+        for _ in range(args.frames):
+            receive(messages)
+        received = (time.process_time() - start) / args.frames
+        print(f"{name:<18}{size:>13}{(size - len(jpeg)) / len(jpeg) * 100:>9.1f}%"
+              f"{sent * 1e6:>17.0f}{received * 1e6:>17.0f}")
+
+
+def _office_screen(width, height):
+    """A desktop to share: a menu bar with a clock, a sidebar and a document window full of text."""
+    from PIL import Image, ImageDraw
+    img = Image.new("RGB", (width, height), (58, 110, 165))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((0, 0, width, 28), fill=(236, 236, 236))
+    draw.rectangle((80, 60, width - 80, height - 60), fill=(255, 255, 255), outline=(160, 160, 160))
+    draw.rectangle((80, 60, 380, height - 60), fill=(245, 245, 247))
+    rng = random.Random(1)
+    for i in range(40):
+        draw.text((100, 90 + i * 22), f"Carpeta {i:02d}", fill=(60, 60, 60))
+    for i in range(40):
+        line = " ".join("".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 9)))
+                        for _ in range(18))
+        draw.text((420, 90 + i * 22), line, fill=(20, 20, 20))
+    return img
+
+
+def bench_tiles(args):
+    """
+    Encoding an office screen: a clock ticking, a cursor moving and someone typing.
+    A full JPEG every frame vs only the changed tiles (screen_frames.FrameDiffer), with
+    a key frame every KEY_FRAME_INTERVAL. Needs NumPy and Pillow.
+    """
+    from PIL import Image, ImageChops, ImageDraw, ImageStat
+    if screen_frames.np is None:
+        sys.exit("NumPy is needed for tile diffing")
+    base = _office_screen(args.width, args.height)
+    draw = ImageDraw.Draw(base)
+    differ = screen_frames.FrameDiffer()
+    canvas = Image.new("RGB", base.size)
+    full_bytes = tile_bytes = keys = regions_sent = 0
+    full_cpu = tile_cpu = 0.0
+    text = ""
+    for i in range(args.frames):
+        now = i / args.fps
+        if i % args.fps == 0:
+            draw.rectangle((args.width - 90, 4, args.width - 10, 24), fill=(236, 236, 236))
+            draw.text((args.width - 80, 8), f"10:{i // args.fps // 60:02d}:{i // args.fps % 60:02d}", fill=(0, 0, 0))
+        if i % 3 == 0:
+            text += random.choice("abcdefghijklmnopqrstuvwxyz ")
+            draw.text((420, 90 + 41 * 22), text[-90:], fill=(20, 20, 20))
+        frame = base.copy()
+        x, y = 600 + int(400 * math.sin(i / 20)), 400 + int(200 * math.cos(i / 15))
+        ImageDraw.Draw(frame).polygon([(x, y), (x, y + 18), (x + 5, y + 14), (x + 12, y + 14)], fill=(0, 0, 0))
+
+        start = time.process_time()
+        full = screen_frames.encode_regions(frame, [(0, 0, *frame.size)], args.quality)
+        full_bytes += len(screen_frames.pack_screen_frame(i, 0, frame.size, full, True))
+        full_cpu += time.process_time() - start
+
+        start = time.process_time()
+        key, rects = differ.regions(frame, now)
+        regions = screen_frames.encode_regions(frame, rects, args.quality)
+        tile_bytes += len(screen_frames.pack_screen_frame(i, 0, frame.size, regions, key))
+        tile_cpu += time.process_time() - start
+        keys += key
+        regions_sent += len(regions)
+        for rx, ry, _, _, jpeg in regions:
+            canvas.paste(Image.open(io.BytesIO(jpeg)), (rx, ry))
+
+    # What a client shows in the end, against the screen itself and against a full JPEG of it
+    full_image = Image.open(io.BytesIO(full[0][4])).convert("RGB")
+    composite_error = sum(ImageStat.Stat(ImageChops.difference(canvas, frame)).mean) / 3
+    full_error = sum(ImageStat.Stat(ImageChops.difference(full_image, frame)).mean) / 3
+    print(f"{args.width}x{args.height}, {args.frames} frames at {args.fps} fps, quality {args.quality}: "
+          f"{keys} key frames, {regions_sent / args.frames:.1f} regions/frame")
+    print(f"{'encoding':<16}{'KB/frame':>10}{'ms CPU/frame':>14}{'mean error':>12}")
+    print(f"{'full JPEG':<16}{full_bytes / args.frames / 1024:>10.1f}{full_cpu / args.frames * 1000:>14.2f}"
+          f"{full_error:>12.2f}")
+    print(f"{'changed tiles':<16}{tile_bytes / args.frames / 1024:>10.1f}{tile_cpu / args.frames * 1000:>14.2f}"
+          f"{composite_error:>12.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="P2P performance benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    delta = sub.add_parser("delta", help="bytes on the wire for delta sync vs a full send")
+    delta.add_argument("--size-mb", type=int, default=64)
+    delta.add_argument("--seed", type=int, default=1)
+    delta.set_defaults(func=bench_delta)
+
+    batch = sub.add_parser("batch", help="files per second for many small files, batched vs one by one")
+    batch.add_argument("--files", type=int, default=10000)
+    batch.add_argument("--size-kb", type=int, default=4)
+    batch.add_argument("--per-file", type=int, default=300, help="files sent one transfer at a time")
+    batch.add_argument("--seed", type=int, default=1)
+    batch.set_defaults(func=bench_batch)
+
+    receive = sub.add_parser("receive", help="MB/s and peak RSS receiving into a slow disk, recv/write loop vs DiskWriter")
+    receive.add_argument("--size-mb", type=int, default=512)
+    receive.add_argument("--net-mbps", type=int, default=110, help="sender rate; 110 is about gigabit Ethernet")
+    receive.add_argument("--disk-mbps", type=int, default=80, help="sink write rate, 0 for the real disk unthrottled")
+    receive.add_argument("--stall-ms", type=int, default=200, help="sink pause every --stall-every-mb")
+    receive.add_argument("--stall-every-mb", type=int, default=32)
+    receive.add_argument("--mode", choices=RECEIVE_MODES, help=argparse.SUPPRESS)
+    receive.set_defaults(func=bench_receive)
+
+    hashing = sub.add_parser("hashing", help="send_file MB/s over loopback with and without chunk hashing")
+    hashing.add_argument("--size-mb", type=int, default=256)
+    hashing.add_argument("--rounds", type=int, default=3)
+    hashing.set_defaults(func=bench_hashing)
+
+    link = sub.add_parser("link", help="chat message rate and latency, peer link vs connect per message")
+    link.add_argument("--messages", type=int, default=5000)
+    link.add_argument("--legacy-messages", type=int, default=200, help="messages sent connect-per-message")
+    link.add_argument("--pings", type=int, default=200)
+    link.set_defaults(func=bench_link)
+
+    burst = sub.add_parser("burst", help="concurrent connects: thread-per-client server vs the asyncio core")
+    burst.add_argument("--clients", type=int, default=2000)
+    burst.add_argument("--legacy-clients", type=int, default=200, help="clients for the thread server")
+    burst.add_argument("--no-uvloop", action="store_true")
+    burst.set_defaults(func=bench_burst)
+
+    frames = sub.add_parser("frames", help="chat frame decoding rate over a socketpair")
+    frames.add_argument("--frames", type=int, default=200000)
+    frames.add_argument("--payload", type=int, default=64, help="payload bytes per frame")
+    frames.set_defaults(func=bench_frames)
+
+    hist = sub.add_parser("history", help="chat history append rate, page load and search time")
+    hist.add_argument("--messages", type=int, default=100000)
+    hist.add_argument("--peers", type=int, default=1, help="conversations the messages are spread over")
+    hist.add_argument("--words", type=int, default=12, help="words per message")
+    hist.add_argument("--vocabulary", type=int, default=20000)
+    hist.add_argument("--pages", type=int, default=100, help="older pages loaded after opening")
+    hist.add_argument("--searches", type=int, default=20, help="repetitions of each timed query")
+    hist.add_argument("--seed", type=int, default=1)
+    hist.set_defaults(func=bench_history)
+
+    fanout = sub.add_parser("fanout", help="one message to many peers: sequential connects vs concurrent fan-out")
+    fanout.add_argument("--peers", type=int, default=40)
+    fanout.add_argument("--dead", type=int, default=2, help="peers that never answer a connect")
+    fanout.add_argument("--timeout", type=float, default=3, help="connect timeout of the sequential sends")
+    fanout.set_defaults(func=bench_fanout)
+
+    disc = sub.add_parser("discovery", help="beacon packets/s and listener CPU, JSON every 3 s vs adaptive binary")
+    disc.add_argument("--peers", type=int, nargs="+", default=[50, 200, 1000])
+    disc.add_argument("--seconds", type=float, default=600, help="simulated time")
+    disc.add_argument("--startup", type=float, default=10, help="peers start spread over this many seconds")
+    disc.add_argument("--settle", type=float, default=120, help="seconds before the steady-state window")
+    disc.add_argument("--samples", type=int, default=100000, help="beacons decoded to time the listener")
+    disc.add_argument("--seed", type=int, default=1)
+    disc.set_defaults(func=bench_discovery)
+
+    rdv = sub.add_parser("rendezvous", help="peers registering with a rendezvous server: time until all are listed")
+    rdv.add_argument("--peers", type=int, nargs="+", default=[500, 2000])
+    rdv.set_defaults(func=bench_rendezvous)
+
+    swarm = sub.add_parser("swarm", help="virtual peers on loopback: convergence, churn, packets, UI events, CPU")
+    swarm.add_argument("--peers", type=int, nargs="+", default=[100])
+    swarm.add_argument("--seconds", type=float, default=160, help="length of each run")
+    swarm.add_argument("--startup", type=float, default=5, help="peers start spread over this many seconds")
+    swarm.add_argument("--settle", type=float, default=30, help="seconds before churn and the steady-state window")
+    swarm.add_argument("--churn", type=float, default=6, help="peers replaced per minute")
+    swarm.add_argument("--churn-for", type=float, default=60, help="seconds of churn")
+    swarm.add_argument("--max-interval", type=float, default=p2p_core.BEACON_MAX_INTERVAL,
+                       help="beacon interval cap; lower it for quicker runs")
+    swarm.add_argument("--seed", type=int, default=1)
+    swarm.set_defaults(func=bench_swarm)
+
+    screen = sub.add_parser("screen", help="bytes and CPU per 1080p screen frame, base64 in JSON vs binary")
+    screen.add_argument("--jpeg", help="a real 1080p JPEG to send instead of --frame-kb of random bytes")
+    screen.add_argument("--frame-kb", type=int, default=250, help="size of one 1080p frame as JPEG")
+    screen.add_argument("--frames", type=int, default=500)
+    screen.set_defaults(func=bench_screen)
+
+    tiles = sub.add_parser("tiles", help="screen frame encoding: full JPEG every frame vs changed tiles only")
+    tiles.add_argument("--frames", type=int, default=300)
+    tiles.add_argument("--fps", type=int, default=15)
+    tiles.add_argument("--width", type=int, default=1920)
+    tiles.add_argument("--height", type=int, default=1080)
+    tiles.add_argument("--quality", type=int, default=80)
+    tiles.set_defaults(func=bench_tiles)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+"""
+Rendezvous Module
+Optional meeting point for sites split over several subnets, where discovery
+broadcasts don't reach everyone. Anyone can run the server:
+
+    python rendezvous.py --port 5004
+
+Peers with a server set in their settings keep one TCP connection to it. On
+connect they register (nick and avatar; the IP is the address the server sees)
+and get the peer list, then only changes as they happen, batched every
+RENDEZVOUS_PUSH_INTERVAL and encoded once for all subscribers. A peer is
+listed for as long as its connection lives. Listed peers go into the same
+PeerTable as the ones found by broadcast, so the UI doesn't tell them apart.
+
+Messages are length-prefixed JSON (like the file transfer control messages):
+    client: {"op": "hello", "nick", "avatar", "register", "epoch", "since"}, {"op": "ping"}
+    server: {"op": "snapshot", "epoch", "version", "peers": [info, ...]}
+            {"op": "update", "epoch", "version", "peers": [info, ...], "removed": [ip, ...]}
+            {"op": "pong"}
+A client that reconnects with the epoch and version it last saw gets only the
+changes since then, as long as the server still remembers them.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+from p2p_core import PEER_TTL, send_json
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+RENDEZVOUS_PORT = 5004
+RENDEZVOUS_PUSH_INTERVAL = 0.5 # Seconds changes are collected before one update goes to every subscriber
+RENDEZVOUS_LOG_SIZE = 100000 # Changes remembered for clients resuming with `since`
+RENDEZVOUS_HEARTBEAT = 15 # Seconds between client pings; the server drops a peer silent for 3 of them
+RENDEZVOUS_RETRY = 5 # Seconds between connection attempts (and checks for a server being configured)
+RENDEZVOUS_MAX_FRAME = 64 * 1024 # Larger client messages are treated as a broken connection
+RENDEZVOUS_MAX_BUFFER = 16 * 1024 * 1024 # Subscribers this far behind are disconnected
+
+FRAME = struct.Struct("!I")
+
+
+def encode(msg):
+    data = json.dumps(msg).encode('utf-8')
+    return FRAME.pack(len(data)) + data
+
+
+def parse_address(value):
+    """(host, port) from "host" or "host:port"; None when no server is configured."""
+    value = (value or "").strip()
+    if not value:
+        return None
+    host, _, port = value.rpartition(":") if ":" in value else (value, "", "")
+    return host, int(port) if port else RENDEZVOUS_PORT
+
+
+class RendezvousServer:
+    def __init__(self):
+        self.epoch = os.urandom(8).hex() # Versions only compare within one server run
+        self.version = 0
+        self.peers = {} # IP -> info
+        self._owners = {} # IP -> writer of the connection that registered it
+        self._subscribers = set()
+        self._log = collections.deque(maxlen=RENDEZVOUS_LOG_SIZE) # (version, ip) of every change
+        self._dirty = set() # IPs changed since the last push
+        self._push_handle = None
+        self._joining = [] # (writer, epoch, since) of new subscribers waiting for their first list
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self._handle, host, port, backlog=1024)
+        print(f"Rendezvous server on {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        ip = writer.get_extra_info('peername')[0]
+        try:
+            while True:
+                header = await asyncio.wait_for(reader.readexactly(FRAME.size), 3 * RENDEZVOUS_HEARTBEAT)
+                size = FRAME.unpack(header)[0]
+                if size > RENDEZVOUS_MAX_FRAME:
+                    break
+                msg = json.loads(await reader.readexactly(size))
+                if msg.get("op") == "hello":
+                    self._hello(ip, writer, msg)
+                elif msg.get("op") == "ping":
+                    writer.write(encode({"op": "pong"}))
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError, AttributeError):
+            pass
+        finally:
+            self._drop(ip, writer)
+            writer.close()
+
+    def _hello(self, ip, writer, msg):
+        if msg.get("register", True):
+            owner = self._owners.get(ip)
+            if owner is not None and owner is not writer:
+                owner.close() # Same peer reconnected; the old connection is stale
+            self._owners[ip] = writer
+            info = {"type": "discovery", "ip": ip, "nick": str(msg.get("nick") or ip), "avatar": str(msg.get("avatar") or "👤")}
+            if self.peers.get(ip) != info:
+                self.peers[ip] = info
+                self._changed(ip)
+        if writer not in self._subscribers:
+            self._subscribers.add(writer)
+            if not self._joining:
+                asyncio.get_running_loop().call_soon(self._welcome)
+            self._joining.append((writer, msg.get("epoch"), msg.get("since")))
+
+    def _welcome(self):
+        """
+        First list for everyone who subscribed during this loop iteration. When many
+        peers connect at once they share one encoded snapshot instead of each getting its own.
+        """
+        snapshot = None
+        for writer, epoch, since in self._joining:
+            if writer.is_closing():
+                continue
+            if self._can_resume(epoch, since):
+                writer.write(encode(self._update({ip for version, ip in self._log if version > since})))
+                continue
+            if snapshot is None:
+                snapshot = encode({"op": "snapshot", "epoch": self.epoch, "version": self.version,
+                                   "peers": list(self.peers.values())})
+            writer.write(snapshot)
+        self._joining = []
+
+    def _can_resume(self, epoch, since):
+        """Whether the log still holds every change after `since`."""
+        return epoch == self.epoch and isinstance(since, int) and since <= self.version and \
+            (since == self.version or bool(self._log and self._log[0][0] <= since + 1))
+
+    def _update(self, ips):
+        return {"op": "update", "epoch": self.epoch, "version": self.version,
+                "peers": [self.peers[ip] for ip in ips if ip in self.peers],
+                "removed": [ip for ip in ips if ip not in self.peers]}
+
+    def _drop(self, ip, writer):
+        self._subscribers.discard(writer)
+        if self._owners.get(ip) is writer:
+            del self._owners[ip]
+            del self.peers[ip]
+            self._changed(ip)
+
+    def _changed(self, ip):
+        self.version += 1
+        self._log.append((self.version, ip))
+        self._dirty.add(ip)
+        if self._push_handle is None:
+            self._push_handle = asyncio.get_running_loop().call_later(RENDEZVOUS_PUSH_INTERVAL, self._push)
+
+    def _push(self):
+        self._push_handle = None
+        frame = encode(self._update(self._dirty))
+        self._dirty = set()
+        for writer in list(self._subscribers):
+            if writer.is_closing():
+                continue
+            if writer.transport.get_write_buffer_size() > RENDEZVOUS_MAX_BUFFER:
+                writer.close() # Not reading; it resyncs with `since` when it reconnects
+                continue
+            writer.write(frame)
+
+
+class RendezvousClient:
+    """Keeps this peer registered with the configured server and feeds the peers it lists into discovery."""
+
+    def __init__(self, settings_manager, discovery_service, source=None):
+        self.settings_manager = settings_manager
+        self.discovery = discovery_service
+        self.source = source # Local address to connect from (tests run many clients on loopback)
+        self.running = False
+        self.connected = False
+        self._listed = set() # IPs the server currently lists, kept across a dropped connection for resuming
+        self._epoch = None
+        self._version = None
+        self._resuming = False # The session asked for changes since _version, not a snapshot
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        while self.running:
+            try:
+                address = parse_address(self.settings_manager.get("rendezvous"))
+            except ValueError:
+                address = None
+            if address:
+                try:
+                    self._session(address)
+                except (OSError, ValueError) as e:
+                    print(f"Rendezvous server {address[0]}:{address[1]}: {e}")
+                finally:
+                    self.connected = False
+                    # Listed peers fall back to beacons, with a grace period for the reconnect
+                    for ip in self._listed:
+                        self.discovery.peers.release(ip, PEER_TTL)
+            time.sleep(RENDEZVOUS_RETRY)
+
+    def _own(self):
+        return self.settings_manager.get("nickname"), self.settings_manager.get("avatar")
+
+    def _session(self, address):
+        sock = socket.create_connection(address, timeout=RENDEZVOUS_RETRY,
+                                        source_address=(self.source, 0) if self.source else None)
+        try:
+            own = self._own()
+            # A resumed session doesn't list unchanged peers again, so it can only pick up
+            # where the last one stopped while every peer listed then is still in the table
+            self._resuming = all(ip in self.discovery.peers or ip in self.discovery.local.addresses
+                                 for ip in self._listed)
+            send_json(sock, {"op": "hello", "nick": own[0], "avatar": own[1], "register": True,
+                             "epoch": self._epoch, "since": self._version if self._resuming else None})
+            self.connected = True
+            sock.settimeout(1) # Wakes up to notice settings changes and send heartbeats
+            buf = bytearray()
+            last_sent = last_heard = time.monotonic()
+            while self.running and parse_address(self.settings_manager.get("rendezvous")) == address:
+                now = time.monotonic()
+                if self._own() != own:
+                    own = self._own()
+                    send_json(sock, {"op": "hello", "nick": own[0], "avatar": own[1], "register": True})
+                    last_sent = now
+                elif now - last_sent >= RENDEZVOUS_HEARTBEAT:
+                    send_json(sock, {"op": "ping"})
+                    last_sent = now
+                if now - last_heard > 3 * RENDEZVOUS_HEARTBEAT:
+                    raise OSError("server stopped answering")
+                try:
+                    data = sock.recv(256 * 1024)
+                except socket.timeout:
+                    continue
+                if not data:
+                    raise OSError("server closed the connection")
+                last_heard = time.monotonic()
+                buf += data
+                while len(buf) >= FRAME.size:
+                    size = FRAME.unpack_from(buf)[0]
+                    if len(buf) < FRAME.size + size:
+                        break
+                    self.handle(json.loads(bytes(buf[FRAME.size:FRAME.size + size])))
+                    del buf[:FRAME.size + size]
+        finally:
+            sock.close()
+
+    def handle(self, msg):
+        """Applies one snapshot or update from the server."""
+        if msg.get("op") not in ("snapshot", "update"):
+            return
+        peers = msg.get("peers", [])
+        listed = {info['ip'] for info in peers}
+        if msg["op"] == "snapshot":
+            gone = self._listed - listed
+        else:
+            gone = set(msg.get("removed", []))
+            kept = self._listed - gone - listed
+            if self._resuming:
+                # Released when the last session dropped; the server still lists them
+                for ip in list(kept):
+                    info = self.discovery.peers.get(ip)
+                    if info:
+                        self.discovery.remote_peer(info)
+                    else:
+                        kept.discard(ip)
+            listed |= kept
+        self._resuming = False
+        for info in peers:
+            self.discovery.remote_peer(info)
+        for ip in gone:
+            self.discovery.peers.release(ip) # Removed now, unless its beacons still reach us
+        if gone:
+            self.discovery.peers.expire()
+        self._listed = listed
+        self._epoch = msg.get("epoch")
+        self._version = msg.get("version")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="P2P rendezvous server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=RENDEZVOUS_PORT)
+    args = parser.parse_args()
+    loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(RendezvousServer().serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
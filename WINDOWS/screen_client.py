@@ -50,10 +50,12 @@ from PyQt6.QtWidgets import (
     QLineEdit, QSpinBox, QGroupBox, QFormLayout,
     QMessageBox
 )
-from PyQt6.QtGui import QPixmap, QFont, QCursor
+from PyQt6.QtGui import QPixmap, QFont, QCursor, QImage, QPainter
 from PyQt6.QtCore import Qt, pyqtSignal, QObject, QTimer
 from socketio import Client
 
+from screen_frames import FRAME_EVENT, unpack_screen_frame
+
 # Cargar configuración desde .env si existe
 def load_config():
     """Cargar configuración - prioridad: env vars > client.env > defaults"""
@@ -99,6 +101,7 @@ CONFIG = load_config()
 class SignalBridge(QObject):
     """Bridge para signals PyQt desde threads de socket.io"""
     frame_received = pyqtSignal(QPixmap)
+    tiles_received = pyqtSignal(bool, object, object)  # key frame, (ancho, alto), [(x, y, QImage)]
     connected = pyqtSignal()
     disconnected = pyqtSignal()
     error_occurred = pyqtSignal(str)
@@ -121,6 +124,9 @@ class ScreenShareClient:
         self.signals = SignalBridge()
         self._connected = False
         self._should_reconnect = True
+        self.last_seq = None
+        self.dropped = 0  # Frames perdidos según los huecos en la secuencia
+        self._need_key = True  # Sin key frame el lienzo no se puede completar
         self.setup_socket_events()
     
     @property
@@ -150,9 +156,37 @@ class ScreenShareClient:
             self.signals.error_occurred.emit(f"Error de conexión: {data}")
             self.signals.connection_status.emit(f"Error: {data}")
         
+        @self.sio.on(FRAME_EVENT)
+        def on_binary_frame(data):
+            """Recibir frame binario: cabecera + regiones JPEG que cambiaron"""
+            try:
+                seq, _, key, size, regions = unpack_screen_frame(data)
+                if self.last_seq is not None and seq > self.last_seq + 1:
+                    self.dropped += seq - self.last_seq - 1
+                    self.request_key_frame()  # Al lienzo le falta lo que traía ese frame
+                self.last_seq = seq
+                if key:
+                    self._need_key = False
+                elif self._need_key:
+                    return  # Esperando la pantalla completa que ya se pidió
+                
+                tiles = []
+                for x, y, _, _, jpeg in regions:
+                    image = QImage.fromData(bytes(jpeg))
+                    if image.isNull():
+                        print("⚠️ No se pudo cargar el frame")
+                        self.request_key_frame()
+                        return
+                    tiles.append((x, y, image))
+                self.signals.tiles_received.emit(key, size, tiles)
+                
+            except Exception as e:
+                if CONFIG['DEBUG']:
+                    print(f"❌ Error decodificando frame: {e}")
+        
         @self.sio.on('frame')
         def on_frame(data):
-            """Recibir frame codificado"""
+            """Recibir frame codificado en base64 (servidores anteriores)"""
             try:
                 frame_data = data['data']
                 
@@ -200,6 +234,7 @@ class ScreenShareClient:
             self.sio.connect(
                 url,
                 transports=['websocket', 'polling'],
+                auth={'binary_frames': True},
                 wait_timeout=10
             )
             return True
@@ -246,6 +281,12 @@ class ScreenShareClient:
             else:
                 self.sio.emit('keyboard_press', {'key': key})
     
+    def request_key_frame(self):
+        """Pedir la pantalla completa; mientras llega se ignoran los frames parciales"""
+        self._need_key = True
+        if self.connected:
+            self.sio.emit('key_frame_request')
+    
     def request_stats(self):
         """Solicitar estadísticas del servidor"""
         if self.connected:
@@ -264,6 +305,7 @@ class ScreenShareWindow(QMainWindow):
         self.frame_count = 0
         self.last_fps_time = time.time()
         self.current_fps = 0
+        self.canvas = None  # Pantalla remota; los frames parciales se pintan encima
         
         self.setup_ui()
         self.setup_fps_timer()
@@ -363,7 +405,8 @@ class ScreenShareWindow(QMainWindow):
     def update_fps(self):
         """Actualizar contador de FPS"""
         self.current_fps = self.frame_count
-        self.fps_label.setText(f"FPS: {self.current_fps}")
+        dropped = self.client.dropped if self.client else 0
+        self.fps_label.setText(f"FPS: {self.current_fps}" + (f" · {dropped} perdidos" if dropped else ""))
         self.frame_count = 0
     
     def create_client(self):
@@ -377,6 +420,7 @@ class ScreenShareWindow(QMainWindow):
     def connect_signals(self):
         """Conectar señales de socket.io a PyQt"""
         self.client.signals.frame_received.connect(self.display_frame)
+        self.client.signals.tiles_received.connect(self.display_tiles)
         self.client.signals.connected.connect(self.on_connected)
         self.client.signals.disconnected.connect(self.on_disconnected)
         self.client.signals.error_occurred.connect(self.on_error)
@@ -457,6 +501,21 @@ class ScreenShareWindow(QMainWindow):
             self.remote_width = pixmap.width()
             self.remote_height = pixmap.height()
     
+    def display_tiles(self, key, size, tiles):
+        """Pintar las regiones recibidas sobre el lienzo y mostrarlo"""
+        width, height = size
+        if key or self.canvas is None or (self.canvas.width(), self.canvas.height()) != (width, height):
+            self.canvas = QImage(width, height, QImage.Format.Format_RGB32)
+            self.canvas.fill(Qt.GlobalColor.black)
+        if not tiles:
+            self.frame_count += 1  # Nada cambió en la pantalla remota
+            return
+        painter = QPainter(self.canvas)
+        for x, y, image in tiles:
+            painter.drawImage(x, y, image)
+        painter.end()
+        self.display_frame(QPixmap.fromImage(self.canvas))
+    
     def get_remote_coordinates(self, event):
         """Calcular coordenadas en pantalla remota"""
         # Obtener posición relativa en el label
@@ -0,0 +1,138 @@
+"""
+Screen Frames Module
+Wire format of the screen share frames, shared by screen_server.py and screen_client.py.
+
+A frame is one binary Socket.IO event ("screen_frame"): a FRAME_HEADER followed
+by the JPEG of every region that changed since the previous frame, each after
+a TILE_HEADER with its position. Key frames carry the whole screen as one region;
+the others only the tiles that differ, found by comparing the captured pixels
+with NumPy, so a clock ticking or a cursor moving costs a few KB instead of a
+full JPEG. The client paints the regions onto a canvas it keeps.
+
+Clients that don't say they understand this when connecting get the older
+base64-in-JSON "frame" event with the whole screen.
+"""
+
+import io
+import struct
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None # Without NumPy every frame is a key frame
+
+FRAME_EVENT = "screen_frame"
+FRAME_VERSION = 2
+# Version, sequence number, capture time in microseconds on the server's monotonic clock,
+# FRAME_* flags, screen width and height, number of regions
+FRAME_HEADER = struct.Struct("!BIQBHHH")
+TILE_HEADER = struct.Struct("!HHHHI") # x, y, width, height, JPEG size
+FRAME_KEY = 1 # The regions cover the whole screen; the client's canvas starts over
+
+TILE_SIZE = 64 # Pixels per side of the squares compared; a multiple of 16 so JPEG blocks line up
+KEY_FRAME_INTERVAL = 5 # Seconds between key frames, which repair anything a client missed
+KEY_FRAME_RATIO = 0.5 # When more than this share of the screen changed, a key frame is cheaper
+
+
+def capture_time():
+    """Timestamp for FRAME_HEADER; only differences between frames of one server mean anything."""
+    return time.monotonic_ns() // 1000
+
+
+def pack_screen_frame(seq, captured, size, regions, key=False):
+    """`regions` are (x, y, width, height, jpeg) on a screen of `size` (width, height)."""
+    parts = [FRAME_HEADER.pack(FRAME_VERSION, seq & 0xFFFFFFFF, captured, FRAME_KEY if key else 0,
+                               size[0], size[1], len(regions))]
+    for x, y, width, height, jpeg in regions:
+        parts.append(TILE_HEADER.pack(x, y, width, height, len(jpeg)))
+        parts.append(jpeg)
+    return b"".join(parts)
+
+
+def unpack_screen_frame(data):
+    """(seq, captured, key, (width, height), regions) from a "screen_frame" payload; ValueError if it isn't one."""
+    if len(data) < FRAME_HEADER.size:
+        raise ValueError("Short screen frame")
+    version, seq, captured, flags, width, height, count = FRAME_HEADER.unpack_from(data)
+    if version != FRAME_VERSION:
+        raise ValueError(f"Unknown screen frame version {version}")
+    view = memoryview(data)
+    offset = FRAME_HEADER.size
+    regions = []
+    for _ in range(count):
+        if len(data) < offset + TILE_HEADER.size:
+            raise ValueError("Truncated screen frame")
+        x, y, w, h, size = TILE_HEADER.unpack_from(data, offset)
+        offset += TILE_HEADER.size
+        if len(data) < offset + size:
+            raise ValueError("Truncated screen frame")
+        regions.append((x, y, w, h, view[offset:offset + size]))
+        offset += size
+    return seq, captured, bool(flags & FRAME_KEY), (width, height), regions
+
+
+def encode_regions(img, rects, quality, optimize=False):
+    """JPEG of each (x, y, width, height) of a PIL image, as pack_screen_frame regions."""
+    regions = []
+    for x, y, width, height in rects:
+        buffer = io.BytesIO()
+        img.crop((x, y, x + width, y + height)).save(buffer, format='JPEG', quality=quality, optimize=optimize)
+        regions.append((x, y, width, height, buffer.getvalue()))
+    return regions
+
+
+class FrameDiffer:
+    """
+    Decides what each captured frame sends: the whole screen every KEY_FRAME_INTERVAL,
+    when asked (a client joined or lost a frame), when the size changed or when most
+    of it changed; otherwise the rows of adjacent tiles that differ from the last frame.
+    """
+
+    def __init__(self, tile=TILE_SIZE, key_interval=KEY_FRAME_INTERVAL):
+        self.tile = tile
+        self.key_interval = key_interval
+        self._previous = None
+        self._key_at = None
+        self._want_key = True
+
+    def request_key_frame(self):
+        self._want_key = True
+
+    def regions(self, img, now=None):
+        """(key, [(x, y, width, height)]) for a PIL RGB image; no rects when nothing changed."""
+        now = time.monotonic() if now is None else now
+        width, height = img.size
+        if np is None:
+            return True, [(0, 0, width, height)]
+        current = np.asarray(img)
+        previous, self._previous = self._previous, current
+        key = self._want_key or previous is None or previous.shape != current.shape or \
+            now - self._key_at >= self.key_interval
+        if not key:
+            rects = self._changed(current, previous)
+            if sum(w * h for _, _, w, h in rects) <= KEY_FRAME_RATIO * width * height:
+                return False, rects
+        self._want_key = False
+        self._key_at = now
+        return True, [(0, 0, width, height)]
+
+    def _changed(self, current, previous):
+        tile = self.tile
+        height, width = current.shape[:2]
+        diff = current.reshape(height, -1) != previous.reshape(height, -1)
+        # Rows first, which is cheap, so only bands of tiles that changed are split into columns
+        bands = np.logical_or.reduceat(diff.any(axis=1), np.arange(0, height, tile))
+        rects = []
+        for band in np.flatnonzero(bands):
+            y = int(band) * tile
+            h = min(tile, height - y)
+            columns = np.logical_or.reduceat(diff[y:y + h].any(axis=0), np.arange(0, diff.shape[1], tile * 3))
+            for col in np.flatnonzero(columns):
+                x = int(col) * tile
+                w = min(tile, width - x)
+                if rects and rects[-1][1] == y and rects[-1][0] + rects[-1][2] == x:
+                    rects[-1] = (rects[-1][0], y, rects[-1][2] + w, h) # Runs along a row become one region
+                else:
+                    rects.append((x, y, w, h))
+        return rects
@@ -5,7 +5,6 @@ Version robusta con mejor manejo de errores
 """
 
 import os
-import io
 import base64
 import threading
 import time
@@ -82,13 +81,15 @@ def check_dependencies():
 
 check_dependencies()
 
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import mss
 import mss.tools
 from PIL import Image
 import pyautogui
 
+from screen_frames import FRAME_EVENT, FrameDiffer, capture_time, encode_regions, pack_screen_frame
+
 # Configurar pyautogui
 pyautogui.FAILSAFE = False
 pyautogui.PAUSE = 0
@@ -113,8 +114,12 @@ server_state = {
     'frame_count': 0,
     'errors': 0,
     'start_time': None,
+    'legacy_clients': set(),  # sid de clientes que solo entienden frames base64 en JSON
 }
 
+# Qué partes de cada captura cambiaron desde la anterior
+differ = FrameDiffer()
+
 def get_local_ip():
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -127,12 +132,16 @@ def get_local_ip():
 
 
 def capture_and_encode_frame():
-    """Captura pantalla usando mss y Pillow (sin OpenCV)"""
+    """
+    Captura pantalla usando mss y Pillow (sin OpenCV)
+    Retorna (imagen, momento de la captura, es key frame, regiones en JPEG); solo codifica lo que cambió
+    """
     try:
         with mss.mss() as sct:
             # Capturar monitor primario
             monitor = sct.monitors[1]
             screenshot = sct.grab(monitor)
+            captured = capture_time()
             
             # Convertir a PIL Image
             img = Image.frombytes('RGB', screenshot.size, screenshot.bgra, 'raw', 'BGRX')
@@ -145,15 +154,12 @@ def capture_and_encode_frame():
                 )
                 img = img.resize(new_size, Image.Resampling.LANCZOS)
             
-            # Codificar como JPEG
-            buffer = io.BytesIO()
-            img.save(buffer, format='JPEG', quality=CONFIG['CAPTURE_QUALITY'])
-            
-            # Convertir a base64
-            encoded = base64.b64encode(buffer.getvalue()).decode('utf-8')
+            # Codificar como JPEG lo que cambió
+            key, rects = differ.regions(img)
+            regions = encode_regions(img, rects, CONFIG['CAPTURE_QUALITY'])
             
             server_state['frame_count'] += 1
-            return encoded
+            return img, captured, key, regions
             
     except Exception as e:
         server_state['errors'] += 1
@@ -173,18 +179,28 @@ def capture_loop():
         start_time = time.time()
         
         try:
-            frame_data = capture_and_encode_frame()
+            frame = capture_and_encode_frame()
             
-            if frame_data:
+            if frame:
                 consecutive_errors = 0
-                socketio.emit('frame', {
-                    'data': frame_data,
-                    'timestamp': datetime.now().isoformat(),
-                    'frame_number': server_state['frame_count']
-                }, room='screen-share-room')
+                img, captured, key, regions = frame
+                # Binario: cabecera compacta + regiones cambiadas, sin base64 ni JSON
+                socketio.emit(FRAME_EVENT,
+                              pack_screen_frame(server_state['frame_count'], captured, img.size, regions, key),
+                              room='screen-share-room')
+                if server_state['legacy_clients']:
+                    # Los clientes anteriores necesitan la pantalla completa en cada frame
+                    jpeg = regions[0][4] if key else \
+                        encode_regions(img, [(0, 0, *img.size)], CONFIG['CAPTURE_QUALITY'])[0][4]
+                    socketio.emit('frame', {
+                        'data': base64.b64encode(jpeg).decode('utf-8'),
+                        'timestamp': datetime.now().isoformat(),
+                        'frame_number': server_state['frame_count']
+                    }, room='screen-share-legacy')
                 
                 if CONFIG['DEBUG'] and server_state['frame_count'] % 30 == 0:
-                    print(f"📤 Frame #{server_state['frame_count']} enviado ({len(frame_data)//1024}KB)")
+                    size = sum(len(region[4]) for region in regions)
+                    print(f"📤 Frame #{server_state['frame_count']} enviado ({size//1024}KB, {len(regions)} regiones)")
             else:
                 consecutive_errors += 1
                 if consecutive_errors > 10:
@@ -208,10 +224,16 @@ def capture_loop():
 
 
 @socketio.on('connect')
-def handle_connect():
+def handle_connect(auth=None):
     server_state['clients_connected'] += 1
-    join_room('screen-share-room')
-    print(f"✓ Cliente conectado desde {request.remote_addr if 'request' in dir() else 'unknown'}")
+    # Los clientes nuevos piden frames binarios al conectar; el resto recibe los de siempre
+    if auth and auth.get('binary_frames'):
+        join_room('screen-share-room')
+        differ.request_key_frame()  # Su lienzo está vacío
+    else:
+        server_state['legacy_clients'].add(request.sid)
+        join_room('screen-share-legacy')
+    print(f"✓ Cliente conectado desde {request.remote_addr}")
     print(f"  Total clientes: {server_state['clients_connected']}")
     
     if not server_state['capturing']:
@@ -231,13 +253,21 @@ def handle_connect():
 @socketio.on('disconnect')
 def handle_disconnect():
     server_state['clients_connected'] = max(0, server_state['clients_connected'] - 1)
+    server_state['legacy_clients'].discard(request.sid)
     leave_room('screen-share-room')
+    leave_room('screen-share-legacy')
     print(f"✗ Cliente desconectado. Restantes: {server_state['clients_connected']}")
     
     if server_state['clients_connected'] <= 0:
         server_state['capturing'] = False
 
 
+@socketio.on('key_frame_request')
+def handle_key_frame_request():
+    """El cliente perdió un frame o aún no tiene lienzo: pantalla completa en la próxima captura"""
+    differ.request_key_frame()
+
+
 @socketio.on('mouse_move')
 def handle_mouse_move(data):
     try:
@@ -11,7 +11,6 @@ import threading
 import socket
 import time
 import json
-import struct
 
 # Screen share port - Changed to 5050 to avoid macOS AirPlay conflict on port 5000
 SCREEN_PORT = 5050
@@ -221,73 +220,43 @@ class ScreenShareProtocol:
     
     def send_screen_request(self, target_ip):
         """Request to view target's screen."""
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(5)
-            s.connect((target_ip, 5003))  # CHAT_PORT
-            
-            msg_type = bytes([MSG_TYPE_SCREEN_REQUEST])
-            content = json.dumps({
-                "ip": get_local_ip(),
-                "port": SCREEN_PORT,
-                "action": "request"
-            }).encode('utf-8')
-            length = struct.pack("!I", len(content))
-            
-            s.sendall(msg_type + length + content)
-            s.close()
-            
-            self.pending_requests[target_ip] = time.time()
-            return True
-        except Exception as e:
-            print(f"Error sending screen request: {e}")
+        content = json.dumps({
+            "ip": get_local_ip(),
+            "port": SCREEN_PORT,
+            "action": "request"
+        })
+        # Queued on the peer link shared with chat, so this never blocks on connect()
+        if not self.chat_service.send_packet(target_ip, MSG_TYPE_SCREEN_REQUEST, content):
+            print("Error sending screen request: peer link unavailable")
             return False
+        self.pending_requests[target_ip] = time.time()
+        return True
     
     def send_screen_accept(self, target_ip):
         """Accept screen share request - start server and notify requester."""
         # Start local server first
         if self.screen_manager.start_server():
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(5)
-                s.connect((target_ip, 5003))
-                
-                msg_type = bytes([MSG_TYPE_SCREEN_ACCEPT])
-                content = json.dumps({
-                    "ip": get_local_ip(),
-                    "port": SCREEN_PORT,
-                    "action": "accept"
-                }).encode('utf-8')
-                length = struct.pack("!I", len(content))
-                
-                s.sendall(msg_type + length + content)
-                s.close()
+            content = json.dumps({
+                "ip": get_local_ip(),
+                "port": SCREEN_PORT,
+                "action": "accept"
+            })
+            if self.chat_service.send_packet(target_ip, MSG_TYPE_SCREEN_ACCEPT, content):
                 return True
-            except Exception as e:
-                print(f"Error sending accept: {e}")
-                self.screen_manager.stop_server()
+            print("Error sending accept: peer link unavailable")
+            self.screen_manager.stop_server()
         return False
     
     def send_screen_reject(self, target_ip):
         """Reject screen share request."""
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(5)
-            s.connect((target_ip, 5003))
-            
-            msg_type = bytes([MSG_TYPE_SCREEN_REJECT])
-            content = json.dumps({
-                "ip": get_local_ip(),
-                "action": "reject"
-            }).encode('utf-8')
-            length = struct.pack("!I", len(content))
-            
-            s.sendall(msg_type + length + content)
-            s.close()
-            return True
-        except Exception as e:
-            print(f"Error sending reject: {e}")
+        content = json.dumps({
+            "ip": get_local_ip(),
+            "action": "reject"
+        })
+        if not self.chat_service.send_packet(target_ip, MSG_TYPE_SCREEN_REJECT, content):
+            print("Error sending reject: peer link unavailable")
             return False
+        return True
     
     def handle_message(self, msg_type, sender_ip, content):
         """Handle incoming screen share protocol messages."""